@@ -1,5 +1,302 @@
 import tornado.web
+import tornado.escape
 import asyncio
+import bisect
+import copy
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from tornado.log import app_log
+from tornado.web import GZipContentEncoding
+from elasticsearch.exceptions import TransportError
+from util import shape_levels, get_shape_level_for_zoom
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def negotiate_encoding(accept_encoding):
+    """
+    Content encoding to answer an Accept-Encoding header with: "br" when
+    brotli is installed and accepted, else "gzip" when accepted, else None.
+    """
+    accepted = set()
+    for i in accept_encoding.split(","):
+        name, _, params = i.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip().lower())
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted or "*" in accepted:
+        return "gzip"
+    return None
+
+
+class ContentEncoding(GZipContentEncoding):
+    """
+    GZipContentEncoding that negotiates brotli as well.
+
+    Brotli is only offered when the brotli package is installed, otherwise
+    responses are gzipped as before. NDJSON is compressed too, streamed
+    responses chunk by chunk.
+    """
+
+    CONTENT_TYPES = GZipContentEncoding.CONTENT_TYPES | {"application/x-ndjson"}
+    BROTLI_QUALITY = 5
+
+    def __init__(self, request):
+        self._encoding = negotiate_encoding(request.headers.get("Accept-Encoding", ""))
+        self._gzipping = self._encoding == "gzip"
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        if self._encoding != "br":
+            return super().transform_first_chunk(status_code, headers, chunk, finishing)
+        if "Vary" in headers:
+            headers["Vary"] += ", Accept-Encoding"
+        else:
+            headers["Vary"] = "Accept-Encoding"
+        ctype = headers.get("Content-Type", "").split(";")[0]
+        if not self._compressible_type(ctype) or (finishing and len(chunk) < self.MIN_LENGTH) or "Content-Encoding" in headers:
+            self._encoding = None
+            return status_code, headers, chunk
+        headers["Content-Encoding"] = "br"
+        self._compressor = brotli.Compressor(quality = self.BROTLI_QUALITY)
+        chunk = self.transform_chunk(chunk, finishing)
+        if "Content-Length" in headers:
+            if finishing:
+                headers["Content-Length"] = str(len(chunk))
+            else:
+                del headers["Content-Length"]
+        return status_code, headers, chunk
+
+    def transform_chunk(self, chunk, finishing):
+        if self._encoding != "br":
+            return super().transform_chunk(chunk, finishing)
+        return self._compressor.process(chunk) + (self._compressor.finish() if finishing else self._compressor.flush())
+
+
+class ResponseCache:
+    """
+    Size-bounded LRU cache with TTL for encoded responses.
+
+    Handlers cache the JSON body they wrote, keyed on the data version, route
+    and parameters, and the Elasticsearch responses behind it, keyed on the
+    data version, index and canonicalized query body. Both hold encoded bytes,
+    so handlers that mutate a decoded response never corrupt a cached copy.
+    The whole cache is dropped when the data version (the ingest @timestamp
+    reported by MetadataHandler) changes, and the version in the key keeps a
+    response fetched before the change from being served after it.
+    """
+
+    def __init__(self, max_entries = 2048, max_bytes = 256 * 1024 * 1024, ttl = 600, version_ttl = 30):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.version_ttl = version_ttl
+        self.version = None
+        self.version_checked = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    @staticmethod
+    def make_key(*parts):
+        return json.dumps(parts, sort_keys = True, separators = (",", ":"))
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.max_entries <= 0 or len(value) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._bytes += len(value)
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key):
+        _, value = self._entries.pop(key)
+        self._bytes -= len(value)
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def version_is_stale(self):
+        return self.version_checked is None or time.monotonic() - self.version_checked > self.version_ttl
+
+    def set_version(self, version):
+        self.version_checked = time.monotonic()
+        if version != self.version:
+            if self.version is not None:
+                self.invalidations += 1
+            self.clear()
+            self.version = version
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "version": self.version
+        }
+
+
+class MsearchBatcher:
+    """
+    Collects the searches of concurrently running handlers into one msearch.
+
+    search() has the signature of AsyncElasticsearch.search and returns a
+    future. The queue is sent once idle_iterations event loop iterations pass
+    without a new search, so handlers resuming from the previous msearch get
+    to queue their next query first. Per-item errors are raised as
+    TransportError in the handler that issued the search.
+    """
+
+    def __init__(self, es, idle_iterations = 3):
+        self.es = es
+        self.idle_iterations = idle_iterations
+        self.pending = []
+        self.scheduled = False
+        self.msearches = 0
+        self.searches = 0
+        self.errors = 0
+
+    def search(self, index, body):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((index, body, future))
+        if not self.scheduled:
+            self.scheduled = True
+            asyncio.get_running_loop().call_soon(self._wait_idle, len(self.pending), 0)
+        return future
+
+    def _wait_idle(self, seen, idle):
+        loop = asyncio.get_running_loop()
+        if len(self.pending) != seen:
+            loop.call_soon(self._wait_idle, len(self.pending), 0)
+        elif idle < self.idle_iterations:
+            loop.call_soon(self._wait_idle, seen, idle + 1)
+        else:
+            self.scheduled = False
+            pending, self.pending = self.pending, []
+            loop.create_task(self._flush(pending))
+
+    async def _flush(self, pending):
+        body = []
+        for index, query, future in pending:
+            body.extend([{"index": index}, query])
+        self.msearches += 1
+        self.searches += len(pending)
+        try:
+            resp = await self.es.msearch(body=body)
+        except Exception as e:
+            for index, query, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (index, query, future), item in zip(pending, resp["responses"]):
+            if future.done():
+                continue
+            if "error" in item:
+                self.errors += 1
+                error = item["error"]
+                future.set_exception(TransportError(item.get("status", 500), error.get("type", "error") if isinstance(error, dict) else error, error))
+            else:
+                item.pop("status", None)
+                future.set_result(item)
+
+    def stats(self):
+        return {
+            "msearches": self.msearches,
+            "searches": self.searches,
+            "errors": self.errors
+        }
+
+
+class LatencyMetrics:
+    """
+    Per route histograms of where request time goes, rendered in the
+    Prometheus text format.
+
+    A request is split into the wall time with at least one ES request in
+    flight, JSON serialization, and the rest of the handler's time, which is
+    mostly pandas/util post-processing. The took ES reports, the response
+    size and the pages of composite aggregation loops are recorded as well.
+    """
+
+    seconds_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    bytes_buckets = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+    pages_buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+    prefix = "outbreak_api_"
+    definitions = {
+        "request_duration_seconds": ("Total time of the request.", seconds_buckets),
+        "es_wait_seconds": ("Wall time with at least one ES request in flight.", seconds_buckets),
+        "es_took_seconds": ("Sum of the took ES reports for the searches of the request, cached responses excluded.", seconds_buckets),
+        "processing_seconds": ("Time outside ES waits and JSON serialization, mostly pandas/util post-processing.", seconds_buckets),
+        "serialization_seconds": ("Time serializing the response to JSON.", seconds_buckets),
+        "response_bytes": ("Size of the uncompressed response body.", bytes_buckets),
+        "composite_pages": ("Pages fetched by composite aggregation loops, for requests running one.", pages_buckets),
+    }
+
+    def __init__(self):
+        self.histograms = {} # (name, route) -> [counts per bucket and +Inf, sum]
+
+    def observe(self, name, route, value):
+        buckets = self.definitions[name][1]
+        histogram = self.histograms.get((name, route))
+        if histogram is None:
+            histogram = self.histograms[(name, route)] = [[0] * (len(buckets) + 1), 0.0]
+        histogram[0][bisect.bisect_left(buckets, value)] += 1
+        histogram[1] += value
+
+    def render(self, labels = {}):
+        lines = []
+        for name, (description, buckets) in self.definitions.items():
+            metric = self.prefix + name
+            lines.append("# HELP {} {}".format(metric, description))
+            lines.append("# TYPE {} histogram".format(metric))
+            for (histogram_name, route), (counts, total) in sorted(self.histograms.items()):
+                if histogram_name != name:
+                    continue
+                label = ",".join('{}="{}"'.format(k, v.replace("\\", "\\\\").replace('"', '\\"')) for k, v in dict(labels, route = route).items())
+                cumulative = 0
+                for le, count in zip([str(i) for i in buckets] + ["+Inf"], counts):
+                    cumulative += count
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(metric, label, le, cumulative))
+                lines.append("{}_sum{{{}}} {}".format(metric, label, repr(float(total))))
+                lines.append("{}_count{{{}}} {}".format(metric, label, cumulative))
+        return "\n".join(lines) + "\n"
 
 
 class BaseHandler(tornado.web.RequestHandler):
@@ -11,37 +308,352 @@ class BaseHandler(tornado.web.RequestHandler):
         self.set_header('Access-Control-Allow-Methods', 'POST, GET, OPTIONS, PATCH, PUT')
 
     size = 10000
+    # Cache-Control max-age of GET responses, None sends no-store and skips ETags.
+    cache_max_age = 600
+    date_intervals = ["day", "week", "month"]
+    cache = ResponseCache()
+    metrics = LatencyMetrics()
+    es_pool_stats = None
+    composite_parallelism = 4
+    composite_partitions = 8
+    # Per process counters, every worker started with --workers keeps its own.
+    worker_id = None
+    requests_started = 0
+    requests_finished = 0
 
-    def initialize(self, db, db2):
+    # Fallback for indices without _meta.last_updated, the @timestamp of a fixed random document is used as the data version.
+    metadata_query = {
+        "size": 1,
+        "query": {
+            "function_score": {
+                "functions": [
+                    {
+                        "random_score": {
+                            "seed": "1477072619038"
+                        }
+                    }
+                ]
+            }
+        }
+    }
+
+    def initialize(self, db):
         self.es = db
-        self.na = db2
+        self.batch = None # MsearchBatcher when run as part of a batch request
+        self.batch_output = None
+        self.composite_stats = []
+        self.request_counted = False # Set once prepare counted the request as started
+        # Key and data version the written body is cached under when the request finishes
+        self.response_key = None
+        self.response_version = None
+        self.response_chunks = []
+        # Where the time of this request went, recorded into metrics when it finishes
+        self.es_in_flight = 0
+        self.es_wait_start = None
+        self.es_wait = 0.0
+        self.es_took = 0.0
+        self.serialization_time = 0.0
+        self.response_bytes = 0
+        self.composite_pages = 0
+
+    def write(self, chunk):
+        if self.batch_output is not None:
+            self.batch_output.append(chunk)
+            return
+        if isinstance(chunk, dict):
+            start = time.monotonic()
+            chunk = tornado.escape.json_encode(chunk)
+            self.serialization_time += time.monotonic() - start
+            self.set_header("Content-Type", "application/json; charset=UTF-8")
+        if isinstance(chunk, str):
+            chunk = tornado.escape.utf8(chunk)
+        if isinstance(chunk, bytes):
+            self.response_bytes += len(chunk)
+            if self.response_key is not None:
+                self.response_chunks.append(chunk)
+        super().write(chunk)
+
+    def get_date_interval(self):
+        # Bucket size of date series, set with ?interval=day|week|month
+        interval = self.get_argument("interval", "day")
+        if interval not in self.date_intervals:
+            raise tornado.web.HTTPError(400, reason = "interval has to be one of {}".format(", ".join(self.date_intervals)))
+        return interval
+
+    def get_shape_level(self):
+        # Level of detail of shapes, set with ?resolution=0..4 (coarsest first) or a web map ?zoom, None for full resolution
+        resolution = self.get_argument("resolution", None)
+        zoom = self.get_argument("zoom", None)
+        try:
+            if resolution is not None:
+                level = int(resolution)
+                if not 0 <= level < len(shape_levels):
+                    raise ValueError(resolution)
+                return level
+            if zoom is not None:
+                return get_shape_level_for_zoom(max(float(zoom), 0))
+        except (ValueError, OverflowError):
+            raise tornado.web.HTTPError(400, reason = "resolution has to be an integer from 0 to {} and zoom a number".format(len(shape_levels) - 1))
+        return None
+
+    async def prepare(self):
+        BaseHandler.requests_started += 1
+        self.request_counted = True
+        if self.request.method != "GET":
+            return
+        if self.cache_max_age is None:
+            self.set_header("Cache-Control", "no-store")
+            return
+        # Responses only change with the data, so If-None-Match is answered before any query runs
+        version = await self.get_data_version()
+        self.set_header("Etag", self.compute_request_etag(version))
+        self.set_header("Cache-Control", "public, max-age={}".format(self.cache_max_age))
+        if self.check_etag_header():
+            self.set_status(304)
+            self.finish()
+            return
+        if self.is_streaming():
+            return
+        # The body written for this version, route and parameters is served as is, skipping the queries and post-processing
+        key = self.cache.make_key("response", version, self.request.path, self.get_request_params())
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.set_header("Content-Type", "application/json; charset=UTF-8")
+            self.write(cached)
+            self.finish()
+            return
+        self.response_key = key
+        self.response_version = version
+
+    def get_request_params(self):
+        return sorted((k, [i.decode("utf-8", "replace") for i in v]) for k, v in self.request.query_arguments.items())
+
+    def compute_request_etag(self, version):
+        # Strong ETag over data version, route, parameters and the negotiated content encoding
+        encoding = negotiate_encoding(self.request.headers.get("Accept-Encoding", ""))
+        key = json.dumps([version, self.request.path, self.get_request_params(), encoding])
+        return '"{}"'.format(hashlib.sha1(key.encode()).hexdigest())
+
+    def on_finish(self):
+        # Requests finished before prepare ran were never counted as started
+        if self.request_counted:
+            BaseHandler.requests_finished += 1
+        # Only JSON bodies of successful requests are cached, and only if the data version did not change meanwhile
+        if self.response_key is not None and self.get_status() == 200 and self._headers.get("Content-Type") == "application/json; charset=UTF-8" and self.cache.version == self.response_version:
+            self.cache.put(self.response_key, b"".join(self.response_chunks))
+        self.record_metrics(self.request.request_time())
+
+    def record_metrics(self, elapsed):
+        # Called with the total time of the request, by on_finish or by the batch handler for its sub-requests
+        route = self.request.path
+        metrics = self.metrics
+        metrics.observe("request_duration_seconds", route, elapsed)
+        metrics.observe("es_wait_seconds", route, self.es_wait)
+        metrics.observe("es_took_seconds", route, self.es_took)
+        metrics.observe("processing_seconds", route, max(elapsed - self.es_wait - self.serialization_time, 0))
+        metrics.observe("serialization_seconds", route, self.serialization_time)
+        metrics.observe("response_bytes", route, self.response_bytes)
+        if self.composite_pages > 0:
+            metrics.observe("composite_pages", route, self.composite_pages)
+
+    async def wait_es(self, request):
+        # Wall time with at least one ES request in flight, so concurrent composite pages are not counted twice
+        if self.es_in_flight == 0:
+            self.es_wait_start = time.monotonic()
+        self.es_in_flight += 1
+        try:
+            response = await request
+        finally:
+            self.es_in_flight -= 1
+            if self.es_in_flight == 0:
+                self.es_wait += time.monotonic() - self.es_wait_start
+        if isinstance(response, dict) and "took" in response:
+            self.es_took += response["took"] / 1000
+        return response
+
+    @classmethod
+    def worker_stats(cls):
+        return {
+            "worker_id": cls.worker_id,
+            "pid": os.getpid(),
+            "requests": cls.requests_finished,
+            "active_requests": cls.requests_started - cls.requests_finished
+        }
+
+    async def get_data_version(self):
+        cache = self.cache
+        if cache.version_is_stale():
+            cache.version_checked = time.monotonic() # Concurrent requests keep using the old version meanwhile
+            # Delta ingests only touch changed documents, so the time of the last ingest is stored in the mapping
+            response = await self.wait_es(self.es.indices.get_mapping(index='hcov19'))
+            version = None
+            for mapping in response.values():
+                version = mapping["mappings"].get("_meta", {}).get("last_updated")
+            if version is None:
+                response = await self.wait_es(self.es.search(index='hcov19', body=self.metadata_query))
+                hits = response['hits']['hits']
+                version = hits[0]["_source"]["@timestamp"] if len(hits) > 0 else None
+            cache.set_version(version)
+        return cache.version
+
+    async def cached_search(self, index, query, operation = "search"):
+        version = await self.get_data_version()
+        key = self.cache.make_key(version, index, operation, query)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return json.loads(cached)
+        if operation == "count":
+            response = await self.wait_es(self.es.count(index=index, body=query))
+        elif self.batch is not None:
+            response = await self.wait_es(self.batch.search(index=index, body=query))
+        else:
+            response = await self.wait_es(self.es.search(index=index, body=query))
+        if self.cache.version == version: # A response fetched across a version change may hold the old data
+            self.cache.put(key, json.dumps(response).encode())
+        return response
+
     async def asynchronous_fetch_sdzipcode(self, query):
-        response = await self.es.search(index='zipcodes', body=query)
+        response = await self.cached_search('zipcodes', query)
         return response
 
     async def asynchronous_fetch_epi(self, query):
-        response = await self.es.search(index='epi', body=query)
+        response = await self.cached_search('epi', query)
         return response
 
     async def asynchronous_fetch_shape(self, query):
-        response = await self.es.search(index='shape', body=query)
+        response = await self.cached_search('shape', query)
         return response
 
     async def asynchronous_fetch(self, query):
-        response = await self.es.search(index='hcov19', body=query)
+        response = await self.cached_search('hcov19', query)
+        return response
+
+    async def asynchronous_fetch_rollup(self, query):
+        response = await self.cached_search('hcov19_rollup', query)
+        return response
+
+    async def asynchronous_fetch_lineage_mutations(self, query):
+        response = await self.cached_search('lineage_mutations', query)
         return response
 
-    
     async def asynchronous_fetch_count(self, query):
-        response = await self.es.count(
-            index="hcov19",
-            body=query)
+        response = await self.cached_search('hcov19', query, operation = "count")
         return response
 
+    async def asynchronous_fetch_composite(self, query, agg_name, fetch = None, partitions = None):
+        """
+        Fetch every page of the composite aggregation agg_name.
+
+        partitions is a list of filter clauses splitting the key space of the
+        first composite source into contiguous, ascending ranges. Each
+        partition is paged independently and concurrently, with at most
+        composite_parallelism requests in flight, and the buckets are merged
+        in partition order so they come back in the same order as a single
+        sequential after_key loop.
+
+        Returns a dict with the merged buckets, the hits of the first pages,
+        the number of pages and the timings.
+        """
+        fetch = fetch if fetch is not None else self.asynchronous_fetch
+        partitions = partitions if partitions else [None]
+        semaphore = asyncio.Semaphore(self.composite_parallelism)
+        page_times = []
+        start = time.monotonic()
+
+        async def fetch_partition(partition_filter):
+            partition_query = copy.deepcopy(query)
+            if partition_filter is not None:
+                partition_query["query"] = {
+                    "bool": {
+                        "filter": [partition_filter] + ([partition_query["query"]] if "query" in partition_query else [])
+                    }
+                }
+            buckets = []
+            hits = None
+            while True:
+                async with semaphore:
+                    page_start = time.monotonic()
+                    resp = await fetch(partition_query)
+                    page_times.append(time.monotonic() - page_start)
+                if hits is None:
+                    hits = resp["hits"]["hits"]
+                agg = resp["aggregations"][agg_name]
+                buckets.extend(agg["buckets"])
+                if "after_key" not in agg or len(agg["buckets"]) == 0:
+                    return buckets, hits
+                partition_query["aggs"][agg_name]["composite"]["after"] = agg["after_key"]
+
+        results = await asyncio.gather(*[fetch_partition(i) for i in partitions])
+        stats = {
+            "agg": agg_name,
+            "partitions": len(partitions),
+            "pages": len(page_times),
+            "elapsed": time.monotonic() - start,
+            "page_time_total": sum(page_times),
+            "page_time_max": max(page_times)
+        }
+        self.composite_stats.append(stats)
+        self.composite_pages += stats["pages"]
+        app_log.debug("Composite %s: %d pages over %d partitions in %.3fs", agg_name, stats["pages"], stats["partitions"], stats["elapsed"])
+        buckets = []
+        hits = []
+        for partition_buckets, partition_hits in results:
+            buckets.extend(partition_buckets)
+            hits.extend(partition_hits)
+        return dict(stats, buckets = buckets, hits = hits[:query.get("size", 10)])
+
+    async def iter_composite_pages(self, query, agg_name, fetch = None, partitions = None):
+        """
+        Yield the buckets of the composite aggregation agg_name one page at a
+        time, in the same order as asynchronous_fetch_composite.
+
+        Partitions are paged one after the other. The next page is requested
+        before the current one is handed out, so at most two pages are held
+        in memory while the caller writes the current one to the client.
+        """
+        fetch = fetch if fetch is not None else self.asynchronous_fetch
+        for partition_filter in (partitions if partitions else [None]):
+            partition_query = copy.deepcopy(query)
+            if partition_filter is not None:
+                partition_query["query"] = {
+                    "bool": {
+                        "filter": [partition_filter] + ([partition_query["query"]] if "query" in partition_query else [])
+                    }
+                }
+            next_page = asyncio.ensure_future(fetch(copy.deepcopy(partition_query)))
+            try:
+                while next_page is not None:
+                    resp = await next_page
+                    next_page = None
+                    self.composite_pages += 1
+                    agg = resp["aggregations"][agg_name]
+                    if "after_key" in agg and len(agg["buckets"]) > 0:
+                        partition_query["aggs"][agg_name]["composite"]["after"] = agg["after_key"]
+                        next_page = asyncio.ensure_future(fetch(copy.deepcopy(partition_query)))
+                    yield agg["buckets"]
+            finally:
+                if next_page is not None:
+                    next_page.cancel()
+
+    def is_streaming(self):
+        # format=ndjson streams records as they are computed, batch sub-requests always get the JSON document
+        return self.get_argument("format", None) == "ndjson" and self.batch_output is None
+
+    async def write_ndjson(self, records):
+        # One JSON document per line, flushed so the client gets each page as soon as it is transformed
+        if not self._headers_written:
+            self.set_header("Content-Type", "application/x-ndjson")
+        if len(records) > 0:
+            start = time.monotonic()
+            chunk = "".join(json.dumps(i) + "\n" for i in records)
+            self.serialization_time += time.monotonic() - start
+            self.write(chunk)
+        await self.flush()
+
     async def get_mapping(self):
-        response = self.na.indices.get_mapping("hcov19")
+        response = await self.es.indices.get_mapping(index="hcov19")
         return response
 
     def post(self):
         pass
-    
+
@@ -0,0 +1,102 @@
+"""
+Benchmark the hcov19 ingest stages of elastic_search.py on a bjorn-style
+JSONL file, such as one written by generate_bjorn_dataset.py.
+
+Stages are timed separately: JSON decoding, transform_row, the parallel
+parser feeding the bulk sender, and parallel_bulk itself. Bulk requests go
+to a local Elasticsearch (--hostname), into a scratch index that is deleted
+afterwards. Without --hostname they go to a stand-in HTTP server that
+acknowledges every document, which measures the client side of sending.
+"""
+import json
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import parallel_bulk
+from elastic_search import get_json_loads, transform_row, generate_actions_parallel, create_index
+
+class BulkStandIn(BaseHTTPRequestHandler):
+    """Answers _bulk requests as if every document was indexed."""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        lines = body.count(b"\n") // 2
+        items = [{"index": {"_index": "hcov19", "_id": str(i), "status": 201}} for i in range(lines)]
+        response = json.dumps({"took": 1, "errors": False, "items": items}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+def report(stage, count, elapsed, nbytes = None):
+    rate = "%.0f docs/s" %(count / elapsed)
+    if nbytes is not None:
+        rate += ", %.1f MB/s" %(nbytes / elapsed / 1e6)
+    print("%-14s %9s docs in %7.2fs, %s" %(stage, count, elapsed, rate))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark hcov19 ingest stages.')
+    parser.add_argument('-j', '--json', help='bjorn-style JSONL file.', required=True)
+    parser.add_argument('--limit', type=int, default=100000, help='Records kept in memory for the decode, transform and bulk stages.')
+    parser.add_argument('--json-decoder', choices=['auto', 'json', 'orjson'], default='auto')
+    parser.add_argument('--workers', type=int, default=0, help='Processes of the parallel parser, 0 starts one per CPU.')
+    parser.add_argument('--hostname', help='Elasticsearch host, a stand-in server is used without it.', required=False)
+    parser.add_argument('--index', default='hcov19_benchmark', help='Scratch index on --hostname, deleted afterwards.')
+    parser.add_argument('--thread-count', type=int, default=8, help='parallel_bulk threads.')
+    parser.add_argument('--chunk-size', type=int, default=5000, help='parallel_bulk documents per request.')
+    args = parser.parse_args()
+
+    lines = []
+    with open(args.json, 'rb') as f:
+        for line in f:
+            lines.append(line)
+            if len(lines) >= args.limit:
+                break
+    nbytes = sum(len(i) for i in lines)
+
+    loads = get_json_loads(args.json_decoder)
+    start = time.perf_counter()
+    rows = [loads(i) for i in lines]
+    report("decode", len(rows), time.perf_counter() - start, nbytes)
+
+    start = time.perf_counter()
+    docs = [transform_row(row, i) for i, row in enumerate(rows)]
+    report("transform", len(docs), time.perf_counter() - start)
+    del rows, lines
+
+    stats = {}
+    start = time.perf_counter()
+    count = sum(1 for i in generate_actions_parallel(args.json, workers=args.workers, decoder=args.json_decoder, stats=stats))
+    report("parallel parse", count, time.perf_counter() - start)
+
+    server = None
+    if args.hostname is None:
+        server = ThreadingHTTPServer(("127.0.0.1", 0), BulkStandIn)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        client = Elasticsearch(hosts=[{'host': '127.0.0.1', 'port': server.server_address[1]}])
+        index = "hcov19"
+    else:
+        client = Elasticsearch(hosts=[{'host': '%s' %args.hostname}], retry_on_timeout=True)
+        index = args.index
+        client.indices.delete(index=index, ignore=404)
+        create_index(client, index)
+    try:
+        start = time.perf_counter()
+        sent = 0
+        for ok, action in parallel_bulk(client=client, index=index, actions=iter(docs), thread_count=args.thread_count, chunk_size=args.chunk_size, queue_size=5):
+            sent += ok
+        report("bulk send", sent, time.perf_counter() - start)
+    finally:
+        if server is not None:
+            server.shutdown()
+        else:
+            client.indices.delete(index=index, ignore=404)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Compare hcov19 query latency across index layouts on a local Elasticsearch.
+
+The same records of a bjorn-style JSONL file (e.g. from
+generate_bjorn_dataset.py) are loaded into one scratch index per layout:
+the former fixed 100 shards, the shard count from plan_shards, and the
+planned count with eager global ordinals and index sorting added. Each index
+is force-merged, then the aggregations the busiest handlers send are run
+against it. The first run after loading is reported separately from the
+median and 95th percentile of the following runs, since eager global
+ordinals move work from the first aggregation to the refresh.
+"""
+import os
+import time
+import argparse
+import numpy as np
+from collections import Counter
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import parallel_bulk
+from elastic_search import get_json_loads, transform_row, create_index, plan_shards, estimate_jsonl, get_data_nodes
+from util import create_nested_mutation_query, create_date_histogram_agg
+
+def create_queries(lineage):
+    lineage_query = create_nested_mutation_query(lineages = [lineage])
+    return {
+        "lineage-by-country": {
+            "size": 0,
+            "aggs": {"prevalence": {"filter": lineage_query, "aggs": {"country": {"terms": {"field": "country", "size": 10000}}}}}
+        },
+        "global-prevalence": {
+            "size": 0,
+            "aggs": {"prevalence": dict(create_date_histogram_agg("day"), aggs = {"lineage_count": {"filter": lineage_query}})}
+        },
+        "sequence-count-by-date": {
+            "size": 0,
+            "aggs": {"date": {"terms": {"field": "date_collected", "size": 10000}}}
+        },
+        "lineage-mutations": {
+            "size": 0,
+            "track_total_hits": True,
+            "query": lineage_query,
+            "aggs": {"mutations": {"nested": {"path": "mutations"}, "aggs": {"mutations": {"terms": {"field": "mutations.mutation", "size": 10000}}}}}
+        },
+        "lineage-by-sub-admin": {
+            "size": 0,
+            "query": {"bool": {"filter": [{"term": {"country_id": "USA"}}]}},
+            "aggs": {"sub_date_buckets": {"composite": {"size": 10000, "sources": [
+                {"sub_id": {"terms": {"field": "division_id"}}},
+                {"lineage": {"terms": {"field": "pangolin_lineage"}}},
+                {"date_collected": {"date_histogram": {"field": "date_collected_dt", "calendar_interval": "day", "format": "yyyy-MM-dd"}}}
+            ]}}}
+        },
+    }
+
+def load(client, index, docs, thread_count):
+    start = time.perf_counter()
+    for ok, action in parallel_bulk(client=client, index=index, actions=iter(docs), thread_count=thread_count, chunk_size=5000, queue_size=5):
+        pass
+    load_time = time.perf_counter() - start
+    start = time.perf_counter()
+    client.indices.refresh(index=index)
+    client.indices.forcemerge(index=index, max_num_segments=1, request_timeout=3600)
+    return load_time, time.perf_counter() - start
+
+def run_queries(client, index, queries, runs):
+    timings = {}
+    for name, query in queries.items():
+        took = []
+        for i in range(runs + 1):
+            start = time.perf_counter()
+            client.search(index=index, body=query, request_cache=False)
+            took.append(1000 * (time.perf_counter() - start))
+        timings[name] = took
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark hcov19 query latency across index layouts.')
+    parser.add_argument('-j', '--json', help='bjorn-style JSONL file.', required=True)
+    parser.add_argument('--hostname', default='localhost', help='Elasticsearch host.')
+    parser.add_argument('--limit', type=int, default=1000000, help='Records loaded into each index.')
+    parser.add_argument('--runs', type=int, default=20, help='Timed runs of each query after the first.')
+    parser.add_argument('--thread-count', type=int, default=4, help='parallel_bulk threads.')
+    parser.add_argument('--keep', action='store_true', help='Keep the scratch indices.')
+    args = parser.parse_args()
+
+    loads = get_json_loads()
+    docs = []
+    with open(args.json, 'rb') as f:
+        for line in f:
+            docs.append(transform_row(loads(line), len(docs)))
+            if len(docs) >= args.limit:
+                break
+    lineage = Counter(i["pangolin_lineage"] for i in docs).most_common(1)[0][0]
+    queries = create_queries(lineage)
+
+    client = Elasticsearch(hosts=[{'host': '%s' %args.hostname}], retry_on_timeout=True, timeout=600)
+    records, nested = estimate_jsonl(args.json)
+    num_bytes = os.path.getsize(args.json) * len(docs) / max(records, 1)
+    planned = plan_shards(len(docs) * (1 + nested), num_bytes, get_data_nodes(client))
+    layouts = [
+        ("100-shards", dict(number_of_shards=100, sort=False, eager_global_ordinals=False)),
+        ("planned-%s" %planned, dict(number_of_shards=planned, sort=False, eager_global_ordinals=False)),
+        ("planned-eager", dict(number_of_shards=planned, sort=False, eager_global_ordinals=True)),
+        ("planned-eager-sorted", dict(number_of_shards=planned, sort=True, eager_global_ordinals=True)),
+    ]
+    print("%s records, most common lineage %s, %s runs per query" %(len(docs), lineage, args.runs))
+
+    results = {}
+    for name, layout in layouts:
+        index = "hcov19_layout_%s" %name
+        client.indices.delete(index=index, ignore=404)
+        try:
+            create_index(client, index, **layout)
+            load_time, merge_time = load(client, index, docs, args.thread_count)
+            sorted_fields = client.indices.get_settings(index=index)[index]["settings"]["index"].get("sort")
+            print("%-22s loaded in %6.1fs, merged in %5.1fs%s" %(name, load_time, merge_time, "" if sorted_fields or not layout["sort"] else " (sorting refused)"))
+            results[name] = run_queries(client, index, queries, args.runs)
+        finally:
+            if not args.keep:
+                client.indices.delete(index=index, ignore=404)
+
+    print("%-24s %-22s %9s %9s %9s" %("query", "layout", "first ms", "p50 ms", "p95 ms"))
+    for query in queries:
+        for name, layout in layouts:
+            took = results[name][query]
+            print("%-24s %-22s %9.1f %9.1f %9.1f" %(query, name, took[0], np.percentile(took[1:], 50), np.percentile(took[1:], 95)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Benchmark util.transform_prevalence_all_lineages against the groupby/apply
+pipeline PrevalenceAllLineagesByLocationHandler used before.
+
+Buckets are generated like a date_collected x pangolin_lineage terms
+aggregation ending today: each lineage circulates for a random stretch of
+days with a random daily count, and a few dates are left without sequences.
+"""
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from datetime import timedelta, datetime as dt
+from util import transform_prevalence_all_lineages, get_major_lineage_prevalence, compute_rolling_mean_all_lineages, compute_total_count, expand_dates
+
+def generate_buckets(rng, num_lineages, num_days):
+    today = pd.Timestamp(dt.today().date())
+    lineage_names = ["L.{}".format(i) for i in range(num_lineages)] + ["none"]
+    start = rng.integers(0, num_days, len(lineage_names))
+    length = rng.geometric(1 / 120, len(lineage_names))
+    scale = rng.lognormal(1, 1.5, len(lineage_names))
+    dates = []
+    lineages = []
+    lineage_counts = []
+    for name, s, l, c in zip(lineage_names, start, length, scale):
+        days = np.arange(s, min(s + l, num_days))
+        counts = rng.poisson(c, days.shape[0])
+        for d, n in zip(days[counts > 0], counts[counts > 0]):
+            dates.append((today - pd.Timedelta(days = num_days - 1 - int(d))).strftime("%Y-%m-%d"))
+            lineages.append(name)
+            lineage_counts.append(int(n))
+    daily_total = pd.Series(lineage_counts).groupby(dates).sum()
+    total_counts = [int(daily_total[i]) for i in dates]
+    return dates, total_counts, lineages, lineage_counts
+
+def groupby_prevalence(dates, total_counts, lineages, lineage_counts, window, keep_lineages, prevalence_threshold, nday_threshold, ndays, cumulative):
+    df_response = (
+        pd.DataFrame({"date": dates, "total_count": total_counts, "lineage_count": lineage_counts, "lineage": lineages})
+        .assign(
+            date = lambda x: pd.to_datetime(x["date"], format="%Y-%m-%d"),
+            prevalence = lambda x: x["lineage_count"]/x["total_count"]
+        )
+        .sort_values("date")
+    )
+    if window is not None:
+        df_response = df_response[df_response["date"] >= (dt.now() - timedelta(days = window))]
+    df_response = get_major_lineage_prevalence(df_response, "date", keep_lineages, prevalence_threshold, nday_threshold, ndays)
+    if not cumulative:
+        df_response = df_response.groupby("lineage").apply(compute_rolling_mean_all_lineages, "date", "lineage_count", "lineage_count_rolling", "lineage").reset_index()
+        df_response = df_response.groupby("date").apply(compute_total_count, "lineage_count_rolling", "total_count_rolling")
+        df_response.loc[:, "prevalence_rolling"] = df_response["lineage_count_rolling"]/df_response["total_count_rolling"]
+        df_response.loc[df_response["prevalence_rolling"].isna(), "prevalence_rolling"] = 0
+        df_response.loc[:,"date"] = df_response["date"].apply(lambda x: x.strftime("%Y-%m-%d"))
+        df_response = df_response.fillna("None")
+        df_response = df_response[["date", "total_count", "lineage_count", "lineage", "prevalence", "prevalence_rolling"]]
+    else:
+        df_response = df_response.groupby("lineage").apply(expand_dates, df_response["date"].min(), df_response["date"].max(), "date", "lineage").reset_index()
+        df_response = df_response.groupby("date").apply(compute_total_count, "lineage_count", "total_count").reset_index()
+        df_response = df_response.groupby("lineage").agg({"total_count": "sum", "lineage_count": "sum"}).reset_index()
+        df_response.loc[:,"prevalence"] = df_response["lineage_count"]/df_response["total_count"]
+    return df_response.to_dict(orient="records")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark all-lineages prevalence.')
+    parser.add_argument('--lineages', type=int, default=2000, help='Number of distinct lineages.')
+    parser.add_argument('--days', type=int, default=1000, help='Number of collection dates.')
+    parser.add_argument('--other-threshold', type=float, default=0.05)
+    parser.add_argument('--nday-threshold', type=float, default=10)
+    parser.add_argument('--ndays', type=int, default=180)
+    parser.add_argument('--window', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    buckets = generate_buckets(rng, args.lineages, args.days)
+    print("%s lineages x %s days, %s buckets" %(args.lineages, args.days, len(buckets[0])))
+
+    # Kept lineages that only occur outside a short window must not come back as empty columns
+    cases = [(args.window, [], cumulative) for cumulative in [False, True]] + [(20, ["L.1", "none"], cumulative) for cumulative in [False, True]]
+    for window, keep_lineages, cumulative in cases:
+        params = (window, keep_lineages, args.other_threshold, args.nday_threshold, args.ndays, cumulative)
+        start = time.perf_counter()
+        expected = groupby_prevalence(*buckets, *params)
+        groupby_time = time.perf_counter() - start
+        start = time.perf_counter()
+        result = transform_prevalence_all_lineages(*buckets, *params)
+        matrix_time = time.perf_counter() - start
+        assert result == expected
+        print("window=%s, keep=%s, cumulative=%s, %s records" %(window, keep_lineages, cumulative, len(result)))
+        print("  groupby/apply: %.3fs" %groupby_time)
+        print("  dense matrix:  %.3fs (%.1fx)" %(matrix_time, groupby_time/matrix_time))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Benchmark util.calculate_proportion against calling beta.interval on every row.
+
+Counts are drawn to look like prevalence responses: most (x, n) pairs are
+small integers and repeat heavily across rows and requests.
+"""
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from scipy.stats import beta
+from util import JeffreysIntervalTable
+
+def generate_counts(rng, rows):
+    total_count = rng.negative_binomial(1, 0.02, rows) + 1
+    lineage_count = rng.binomial(total_count, rng.beta(0.5, 5, rows))
+    return pd.Series(lineage_count, dtype = float), pd.Series(total_count, dtype = float)
+
+def direct_interval(x, n):
+    return beta.interval(1 - 0.05, x + 0.5, n - x + 0.5)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Jeffreys interval computation.')
+    parser.add_argument('--rows', type=int, default=5000, help='Rows per simulated response.')
+    parser.add_argument('--requests', type=int, default=200, help='Number of simulated responses.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    responses = [generate_counts(rng, args.rows) for i in range(args.requests)]
+    unique_pairs = len(set(zip(*[np.concatenate(i) for i in zip(*responses)])))
+    print("%s responses x %s rows, %s unique (x, n) pairs" %(args.requests, args.rows, unique_pairs))
+
+    start = time.perf_counter()
+    direct = [direct_interval(x, n) for x, n in responses]
+    direct_time = time.perf_counter() - start
+
+    table = JeffreysIntervalTable()
+    start = time.perf_counter()
+    cached = [table.interval(x, n) for x, n in responses]
+    cached_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for x, n in responses:
+        table.interval(x, n)
+    warm_time = time.perf_counter() - start
+
+    for (d_low, d_upp), (c_low, c_upp) in zip(direct, cached):
+        assert np.array_equal(d_low, c_low, equal_nan = True) and np.array_equal(d_upp, c_upp, equal_nan = True)
+
+    print("beta.interval per row: %.3fs" %direct_time)
+    print("interval table, cold:  %.3fs (%.1fx)" %(cached_time, direct_time/cached_time))
+    print("interval table, warm:  %.3fs (%.1fx)" %(warm_time, direct_time/warm_time))
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@ Script ingests data into an ElasticSearch database.
 """
 import os
 import io
+import gzip
 import sys
 import ast
 import json
@@ -15,11 +16,17 @@ import tqdm
 import urllib3
 import requests
 import zipfile
+import time
+import hashlib
+import math
 import pandas as pd
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from elasticsearch import Elasticsearch
-from elasticsearch.helpers import streaming_bulk, parallel_bulk
+from elasticsearch.helpers import streaming_bulk, parallel_bulk, scan
 from shapely.geometry import shape as sh
 from shapely.geometry import GeometryCollection
+from util import parse_mutation, shape_levels
 
 countries = []
 def test_epi_availability(epi_location, zipcodes):
@@ -135,20 +142,174 @@ def create_snapshot(es):
     }
     es.snapshot.create(repository='backup', snapshot='test_snapshot', body=index_body)
 
-def get_gpkg(countries):
+gadm_url = 'https://biogeo.ucdavis.edu/data/gadm3.6/shp/gadm36_%s_shp.zip'
+
+def hash_files(paths, extra = ""):
+    # sha256 over the bytes of paths in order, followed by extra
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    digest.update(extra.encode())
+    return digest.hexdigest()
+
+def write_atomic(path, content):
+    tmp = "%s.%s.tmp" %(path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+def fetch_gadm_zip(country, cache_dir, offline = False):
     """
     Parameters
     ----------
     country : str
-        The name of the country to download information for.
+        ISO3 code of the country.
+    cache_dir : str
+        Directory of the artifact cache.
+    offline : bool
+        Only use the cache, never touch the network.
+
+    Returns the path of the cached GADM zip, stored under its sha256. The
+    manifest gadm/<country>.json records the hash with the ETag and
+    Last-Modified of the download, so the zip is only downloaded again when
+    the server reports a change or does not report either.
+    """
+    url = gadm_url %country
+    manifest_path = os.path.join(cache_dir, "gadm", "%s.json" %country)
+    manifest = None
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    cached = os.path.join(cache_dir, "blobs", "%s.zip" %manifest["sha256"]) if manifest is not None else None
+    if cached is not None and not os.path.isfile(cached):
+        cached = None
+    if offline:
+        if cached is None:
+            raise RuntimeError("%s is not in the cache at %s, run once without --offline" %(url, cache_dir))
+        return cached
+    try:
+        head = requests.head(url, allow_redirects=True, timeout=60)
+        validators = {"etag": head.headers.get("ETag"), "last_modified": head.headers.get("Last-Modified")}
+    except requests.RequestException as e:
+        if cached is None:
+            raise
+        print("%s: %s, using the cached copy" %(country, e))
+        return cached
+    if cached is not None and any(validators[i] is not None and validators[i] == manifest.get(i) for i in validators):
+        return cached
+    response = requests.get(url, timeout=600)
+    response.raise_for_status()
+    sha256 = hashlib.sha256(response.content).hexdigest()
+    path = os.path.join(cache_dir, "blobs", "%s.zip" %sha256)
+    if not os.path.isfile(path):
+        write_atomic(path, response.content)
+    write_atomic(manifest_path, json.dumps(dict(validators, url=url, sha256=sha256)).encode())
+    return path
+
+def extract_cached_zip(path, cache_dir):
+    # Extracted once per zip hash into shapefiles/<sha256>
+    sha256 = os.path.splitext(os.path.basename(path))[0]
+    target = os.path.join(cache_dir, "shapefiles", sha256)
+    if not os.path.isdir(target):
+        tmp = "%s.%s.tmp" %(target, os.getpid())
+        with zipfile.ZipFile(path) as z:
+            z.extractall(tmp)
+        os.replace(tmp, target)
+    return target
+
+def get_gpkg(countries, cache_dir = None, offline = False, download_workers = 4, location = './shapefiles'):
+    """
+    Parameters
+    ----------
+    countries : list
+        ISO3 codes of the countries to download information for.
+    cache_dir : str
+        Artifact cache for the GADM zips and their extracted shapefiles.
+        Without it every zip is downloaded and extracted into ./shapefiles.
+    offline : bool
+        Take every zip from cache_dir, fails for countries not cached yet.
+    download_workers : int
+        Number of countries fetched concurrently.
+    location : str
+        Directory simplify_gpkg reads, the cached files are linked into it.
+    """
+    if cache_dir is None:
+        for country in countries:
+            print(country)
+            response = requests.get(gadm_url %country)
+            z = zipfile.ZipFile(io.BytesIO(response.content))
+            z.extractall(location)
+        return
+    for i in ["gadm", "blobs", "shapefiles", "shapes"]:
+        os.makedirs(os.path.join(cache_dir, i), exist_ok=True)
+    os.makedirs(location, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=download_workers) as executor:
+        paths = list(executor.map(lambda country: fetch_gadm_zip(country, cache_dir, offline), countries))
+    for country, path in zip(countries, paths):
+        print(country, os.path.basename(path))
+        extracted = extract_cached_zip(path, cache_dir)
+        for filename in os.listdir(extracted):
+            link = os.path.join(location, filename)
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(os.path.abspath(os.path.join(extracted, filename)), link)
+
+def quantize_ring(ring, decimals):
+    # Rounded ring without repeated points, None when it collapses below a closed triangle
+    quantized = []
+    for x, y in ring:
+        point = [round(x, decimals), round(y, decimals)]
+        if len(quantized) == 0 or point != quantized[-1]:
+            quantized.append(point)
+    return quantized if len(quantized) >= 4 else None
+
+def quantize_polygon(rings, decimals):
+    rings = [quantize_ring(i, decimals) for i in rings]
+    if rings[0] is None:
+        return None
+    return [i for i in rings if i is not None]
+
+def quantize_geometry(geometry, decimals):
+    """
+    GeoJSON geometry with coordinates rounded to decimals.
+
+    Rings and polygons that collapse are dropped, None is returned when
+    nothing is left. Other geometry types are returned unchanged.
+    """
+    if geometry["type"] == "Polygon":
+        coordinates = quantize_polygon(geometry["coordinates"], decimals)
+    elif geometry["type"] == "MultiPolygon":
+        coordinates = [quantize_polygon(i, decimals) for i in geometry["coordinates"]]
+        coordinates = [i for i in coordinates if i is not None]
+    else:
+        return geometry
+    if coordinates is None or len(coordinates) == 0:
+        return None
+    return {"type": geometry["type"], "coordinates": coordinates}
+
+def generate_shape_levels(geom):
+    """
+    Parameters
+    ----------
+    geom : shapely geometry
+        Full resolution geometry of a feature.
+
+    Returns a dict with the GeoJSON feature string of every level in
+    util.shape_levels, keyed by level. A level where the feature collapses
+    reuses the next finer one.
     """
-    for country in countries:
-        print(country)
-        response = requests.get('https://biogeo.ucdavis.edu/data/gadm3.6/shp/gadm36_%s_shp.zip' %country)
-        z = zipfile.ZipFile(io.BytesIO(response.content))
-        z.extractall("./shapefiles/")
-        #find and delete all non shape files
-        #os.system("find ./shapefiles -type f  ! -name '*.shp'  -delete")
+    levels = {}
+    finer = None
+    for level in reversed(range(len(shape_levels))):
+        tolerance, decimals = shape_levels[level]
+        geometry = quantize_geometry(shapely.geometry.mapping(geom.simplify(tolerance, preserve_topology=True)), decimals)
+        if geometry is None:
+            geometry = finer
+        levels[str(level)] = json.dumps({"type": "Feature", "geometry": geometry}, separators=(',', ':'))
+        finer = geometry
+    return levels
 
 def simplify_gpk_zipcode(location):   
     count=0
@@ -217,90 +378,196 @@ def simplify_gpk_zipcode(location):
         goejson_temp={}
         geojson_temp['geometry'] = shapely.geometry.mapping(s)
         new_dict['shape'] = json.dumps(geojson_temp,separators=(',', ':'))
+        new_dict['shapes'] = generate_shape_levels(shp_geom)
          
         yield new_dict
      
-def simplify_gpkg():
-    location = './shapefiles'
-    all_shp_files = os.listdir(location)
-    all_shp_files = [os.path.join(location,filename) for filename in all_shp_files if filename.endswith(".shp")]
-    #print(all_shp_files)
+def recursive_len(item):
+    # Number of leaves below nested lists, counted without a Python call per coordinate
+    if type(item) != list:
+        return 1
+    total = 0
+    stack = [item]
+    while stack:
+        for i in stack.pop():
+            if type(i) == list:
+                stack.append(i)
+            else:
+                total += 1
+    return total
 
-    count=0
+def simplify_shape_record(shp, feature):
+    """
+    Parameters
+    ----------
+    shp : str
+        Path of the GADM shapefile, its admin level is read from the name.
+    feature : shapefile.ShapeRecord
+        Record and geometry of one feature.
+
+    Returns the shape document of the feature without its _id.
+    """
+    new_dict = {}
+    geojson = { "type": "Feature"}
+
+    country=feature.record[1]
+    try:
+        if '1' in shp or '2' in shp:
+            division=feature.record[3]
+            division_id=feature.record[-1].split('.')[1]
+        else:
+            division='None'
+            division_id='None'
+    except:
+        division='None'
+        division_id='None'
+    try:
+        if '2' in shp:
+            location=feature.record[6]
+        else:
+            location='None'
+    except:
+        location='None'
+
+    first = feature.shape.__geo_interface__
+    total_coordinates = recursive_len(first['coordinates'])
+
+    if total_coordinates > 80000:
+        sim = 0.4
+    elif 10000 < total_coordinates <= 80000:
+        sim = 0.019
+    elif 1500 < total_coordinates <= 10000:
+        sim = 0.01
+    elif 500 < total_coordinates <= 1500:
+        sim = 0.01
+    elif 250 < total_coordinates <= 500:
+        sim = 0.005
+    else:
+        sim = 0.0001
+
+    shp_geom = sh(first)
+    if sim != None:
+        s = shp_geom.simplify(sim, preserve_topology=False)
+    else:
+        s = shp_geom
+    new_dict['country'] = country
+    new_dict['country_lower'] = country.lower()
+    new_dict['country_id'] = feature.record[0]
+    new_dict['division'] = division
+    new_dict['division_lower'] = division.lower()
+    new_dict['division_id']=division_id
+    new_dict['location'] = location
+    new_dict['location_lower'] = location.lower()
+    new_dict['location_id'] = 'None'
+    geojson['geometry'] = shapely.geometry.mapping(s)
+    new_dict['shape'] = json.dumps(geojson)
+    new_dict['shapes'] = generate_shape_levels(shp_geom)
+    return new_dict
+
+def simplify_shapefile_chunk(shp, start, stop):
+    """
+    Simplify features start to stop of one shapefile, run in a worker process.
+
+    Documents get the id <file name>_<feature index>, so they do not depend
+    on the order chunks finish in. Returns the path, the number of features,
+    the documents and the CPU time spent.
+    """
+    began = time.process_time()
+    name = os.path.splitext(os.path.basename(shp))[0]
+    reader = shapefile.Reader(shp)
+    docs = []
+    for i in range(start, stop):
+        doc = simplify_shape_record(shp, reader.shapeRecord(i))
+        doc['_id'] = "%s_%s" %(name, i)
+        docs.append(doc)
+    reader.close()
+    return shp, stop - start, docs, time.process_time() - began
+
+# Bump when simplify_shape_record changes, so cached shape documents are rebuilt
+shape_simplify_version = 1
+
+def get_shape_cache_path(shp, cache_dir):
+    # Cached documents are keyed by the shapefile contents, its name (used in the ids) and the simplification parameters
+    base = os.path.splitext(shp)[0]
+    sources = [base + i for i in [".shp", ".shx", ".dbf"] if os.path.isfile(base + i)]
+    key = hash_files(sources, json.dumps([os.path.basename(base), shape_simplify_version, shape_levels]))
+    return os.path.join(cache_dir, "shapes", "%s.jsonl.gz" %key)
+
+def simplify_gpkg(location = './shapefiles', workers = None, chunk_size = 100, cache_dir = None):
+    """
+    Simplify the features of every shapefile in location on a pool of
+    workers processes (one per CPU by default) and yield the documents.
+
+    Files are split into chunks of chunk_size features so large countries
+    are spread over the pool too. At most two chunks per worker are pending
+    at a time and chunks are yielded in the order they finish, so memory
+    stays bounded by the chunks in flight. Prints the wall and CPU time of
+    each file once all its chunks are done.
+
+    With cache_dir the documents of each file are written to
+    shapes/<key>.jsonl.gz, and files whose key is already cached are read
+    from there instead of being simplified again.
+    """
+    all_shp_files = sorted(os.path.join(location,filename) for filename in os.listdir(location) if filename.endswith(".shp"))
+    workers = workers if workers else os.cpu_count()
+    started = time.monotonic()
+    files = {}
+    uncached = []
     for shp in all_shp_files:
-        shape = shapefile.Reader(shp)
-        for c,feature in enumerate(shape.shapeRecords()): 
-            new_dict = {}
-            geojson = { "type": "Feature"}
-             
-            #print(feature.record, shp) 
-            country=feature.record[1]
-            try:
-                if '1' in shp or '2' in shp:
-                    division=feature.record[3]
-                    division_id=feature.record[-1].split('.')[1]
-                else:
-                    division='None'
-                    division_id='None'
-            except:
-                division='None'
-                division_id='None'
-            try:
-                if '2' in shp:
-                    location=feature.record[6]
-                else:
-                    location='None'
-            except:
-                location='None'
+        cache_path = get_shape_cache_path(shp, cache_dir) if cache_dir is not None else None
+        if cache_path is not None and os.path.isfile(cache_path):
+            with gzip.open(cache_path, "rt") as f:
+                for line in f:
+                    yield json.loads(line)
+            print("%s: cached" %shp)
+        else:
+            uncached.append((shp, cache_path))
 
-            #print(country, division, location)
-            first = feature.shape.__geo_interface__  
-            
-            def recursive_len(item):
-                if type(item) == list:
-                    return sum(recursive_len(subitem) for subitem in item)
-                else:
-                    return 1
-            total_coordinates = recursive_len(first['coordinates'])
-            #print(total_coordinates) 
-
-            if total_coordinates > 80000:
-                sim = 0.4
-            elif 10000 < total_coordinates <= 80000:
-                sim = 0.019
-            elif 1500 < total_coordinates <= 10000:
-                sim = 0.01
-            elif 500 < total_coordinates <= 1500:
-                sim = 0.01
-            elif 250 < total_coordinates <= 500:
-                sim = 0.005
-            else:
-                sim = 0.0001
+    def tasks():
+        for shp, cache_path in uncached:
+            with shapefile.Reader(shp) as reader:
+                num_features = len(reader)
+            files[shp] = {"remaining": num_features, "cpu": 0, "start": time.monotonic(), "cache_path": cache_path}
+            if cache_path is not None:
+                files[shp]["cache_tmp"] = "%s.%s.tmp" %(cache_path, os.getpid())
+                files[shp]["cache"] = gzip.open(files[shp]["cache_tmp"], "wt")
+            if num_features == 0:
+                finish_file(shp)
+            for start in range(0, num_features, chunk_size):
+                yield shp, start, min(start + chunk_size, num_features)
 
-            shp_geom = sh(first)
-            #print('shp', shp_geom.__dict__)
-            if sim != None:
-                s = shp_geom.simplify(sim, preserve_topology=False)
-            else:
-                s = shp_geom
-            new_dict['_id']=count
-            #print(count)
-            count += 1
-            new_dict['country'] = country
-            new_dict['country_lower'] = country.lower()
-            new_dict['country_id'] = feature.record[0]
-            new_dict['division'] = division
-            new_dict['division_lower'] = division.lower()
-            new_dict['division_id']=division_id
-            new_dict['location'] = location
-            new_dict['location_lower'] = location.lower()
-            new_dict['location_id'] = 'None'
-            geojson['geometry'] = shapely.geometry.mapping(s)
-            #print(geojson)
-            new_dict['shape'] = json.dumps(geojson)
-            #print(new_dict)
+    def finish_file(shp):
+        timing = files[shp]
+        if "cache" in timing:
+            timing["cache"].close()
+            os.replace(timing["cache_tmp"], timing["cache_path"])
+        print("%s: %.1fs wall, %.1fs cpu" %(shp, time.monotonic() - timing["start"], timing["cpu"]))
 
-            yield new_dict
+    def finish(future):
+        shp, num_features, docs, cpu_time = future.result()
+        timing = files[shp]
+        timing["remaining"] -= num_features
+        timing["cpu"] += cpu_time
+        if "cache" in timing:
+            timing["cache"].writelines(json.dumps(i) + "\n" for i in docs)
+        if timing["remaining"] == 0:
+            finish_file(shp)
+        return docs
+
+    if len(uncached) > 0:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            for task in tasks():
+                if len(pending) >= 2 * workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield from finish(future)
+                pending.add(executor.submit(simplify_shapefile_chunk, *task))
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from finish(future)
+    print("Simplified %s of %s shapefiles in %.1fs on %s workers" %(len(uncached), len(all_shp_files), time.monotonic() - started, workers))
 
 
 def download_dataset(json_filename):
@@ -310,11 +577,76 @@ def download_dataset(json_filename):
             data.append(json.loads(line))
     return(data)
 
-def create_zipcode(client):
+target_shard_bytes = 30 * 1024 ** 3
+max_shard_docs = 200000000
+
+def plan_shards(num_docs, num_bytes, data_nodes = 1):
+    """
+    Parameters
+    ----------
+    num_docs : int
+        Lucene documents in the index, nested documents included.
+    num_bytes : int
+        Expected size of the index on disk.
+    data_nodes : int
+        Data nodes of the cluster.
+
+    Returns
+    -------
+    number_of_shards : int
+        Fewest primary shards keeping each under target_shard_bytes and
+        max_shard_docs, rounded up to a multiple of data_nodes when more
+        than one is needed. Every shard is searched by every aggregation,
+        so small indices get a single shard.
+    """
+    shards = max(1, math.ceil(num_bytes / target_shard_bytes), math.ceil(num_docs / max_shard_docs))
+    if shards > 1 and data_nodes > 1:
+        shards = math.ceil(shards / data_nodes) * data_nodes
+    return shards
+
+def estimate_jsonl(json_filename, sample_lines = 1000):
+    """
+    Returns
+    -------
+    records, nested : int, float
+        Estimated number of records of the bjorn json metadata, from its
+        size and the mean length of the first sample_lines lines, and the
+        mean number of mutations (nested documents) per record.
+    """
+    sizes = []
+    mutations = 0
+    with open(json_filename, "rb") as f:
+        for line in f:
+            if len(sizes) >= sample_lines:
+                break
+            if not line.strip():
+                continue
+            sizes.append(len(line))
+            mutations += len(json.loads(line).get("mutations") or [])
+    if len(sizes) == 0:
+        return 0, 0
+    records = math.ceil(os.path.getsize(json_filename) / np.mean(sizes))
+    return records, mutations / len(sizes)
+
+def get_data_nodes(client):
+    return client.cluster.health()["number_of_data_nodes"]
+
+def get_max_buckets(client):
+    # search.max_buckets of the cluster, the ES 7 default if it is not reported
+    settings = client.cluster.get_settings(include_defaults=True, flat_settings=True)
+    for level in ["transient", "persistent", "defaults"]:
+        if "search.max_buckets" in settings.get(level, {}):
+            return int(settings[level]["search.max_buckets"])
+    return 65536
+
+def get_directory_size(location):
+    return sum(os.path.getsize(os.path.join(root, i)) for root, dirs, files in os.walk(location) for i in files)
+
+def create_zipcode(client, number_of_shards = 1):
     client.indices.create(
         index="zipcodes",
         body={
-            "settings": {"number_of_shards": 100,
+            "settings": {"number_of_shards": number_of_shards,
                 "analysis": {
                     "normalizer": {
                         "keyword_lowercase": {
@@ -329,17 +661,18 @@ def create_zipcode(client):
                 "zipcode" : {"type":"keyword"},
                 "zipcode_name" : {"type":"keyword"},
                 "shape": {"type": "keyword"},
+                "shapes": {"type": "object", "enabled": False},
                 },
             },
         },
         ignore=400,)
 
 
-def create_polygon(client):
+def create_polygon(client, number_of_shards = 1, index = "shape"):
     client.indices.create(
-        index="shape",
+        index=index,
         body={
-            "settings": {"number_of_shards": 100,
+            "settings": {"number_of_shards": number_of_shards,
                 "analysis": {
                     "normalizer": {
                         "keyword_lowercase": {
@@ -361,16 +694,35 @@ def create_polygon(client):
                 "location_lower": {"type":"keyword", "normalizer":"keyword_lowercase"},
                 "location_id" : {"type":"keyword"},
                 "shape": {"type": "keyword"},
+                "shapes": {"type": "object", "enabled": False},
                 },
             },
         },
         ignore=400,)
 
-def create_index(client):
-    client.indices.create(
-        index="hcov19",
-        body={
-            "settings": {"number_of_shards": 100,
+hcov19_sort_fields = ["date_collected", "country_id"]
+hcov19_eager_global_ordinals = ["pangolin_lineage", "date_collected", "mutations.mutation"]
+
+def create_index(client, index="hcov19", number_of_shards=1, sort=True, eager_global_ordinals=True):
+    """
+    Parameters
+    ----------
+    client :
+        ElasticSearch client.
+    index : str
+        Name of the index.
+    number_of_shards : int
+        Primary shards, see plan_shards.
+    sort : bool
+        Sort segments on hcov19_sort_fields so documents of a date and
+        country are stored together. Clusters refusing index sorting on
+        indices with nested fields get an unsorted index.
+    eager_global_ordinals : bool
+        Build the global ordinals of hcov19_eager_global_ordinals on
+        refresh instead of on the first aggregation after it.
+    """
+    body={
+            "settings": {"number_of_shards": number_of_shards,
                 "analysis": {
                     "normalizer": {
                         "keyword_lowercase": {
@@ -405,14 +757,15 @@ def create_index(client):
                         "type" : {"type":"keyword"},
                         "gene" : {"type":"keyword"},
                         "ref_codon" : {"type":"keyword"},
-                        "pos" : {"type":"keyword"},
+                        "pos" : {"type":"integer"},
                         "alt_codon" : {"type":"keyword"},
                         "is_synonymous" : {"type":"keyword"},
                         "ref_aa" : {"type":"keyword"},
-                        "codon_num" : {"type":"keyword"},
+                        "codon_num" : {"type":"integer"},
+                        "codon_end" : {"type":"integer"},
                         "alt_aa" : {"type":"keyword"},
                         "absolute_coords" : {"type": "keyword"},
-                        "change_length_nt" : {"type": "keyword"},
+                        "change_length_nt" : {"type": "integer"},
                         "nt_map_coords" : {"type": "keyword"},
                         "aa_map_coords" : {"type": "keyword"},
                    },
@@ -423,11 +776,214 @@ def create_index(client):
                    "date_collected" : {"type":"keyword"},
                    "date_modified" : {"type":"keyword"},
                    "date_submitted" : {"type":"keyword"},
+                   "date_collected_dt" : {"type":"date", "format":"yyyy-MM-dd"},
+                   "date_modified_dt" : {"type":"date", "format":"yyyy-MM-dd"},
+                   "date_submitted_dt" : {"type":"date", "format":"yyyy-MM-dd"},
+                   "date_collected_valid" : {"type":"boolean"},
+                   "date_modified_valid" : {"type":"boolean"},
+                   "date_submitted_valid" : {"type":"boolean"},
             },
             },
-        },
-        ignore=400,)
+        }
+    if eager_global_ordinals:
+        for field in hcov19_eager_global_ordinals:
+            path = field.split(".")
+            properties = body["mappings"]["properties"]
+            for i in path[:-1]:
+                properties = properties[i]["properties"]
+            properties[path[-1]]["eager_global_ordinals"] = True
+    if sort:
+        body["settings"]["index.sort.field"] = hcov19_sort_fields
+        body["settings"]["index.sort.order"] = ["asc"] * len(hcov19_sort_fields)
+    response = client.indices.create(index=index, body=body, ignore=400)
+    if sort and "nested" in str(response.get("error", "")):
+        # ES 7 cannot sort indices with nested fields, and mutations have to stay nested
+        print("%s: index sorting is not supported with nested fields on this cluster, creating it unsorted" %index)
+        del body["settings"]["index.sort.field"], body["settings"]["index.sort.order"]
+        client.indices.create(index=index, body=body, ignore=400)
+
+bulk_index_settings = {"index.number_of_replicas": 0, "index.refresh_interval": "-1"}
+
+def get_alias_indices(client, alias="hcov19"):
+    """
+    Returns
+    -------
+    indices : list
+        Indices the alias points to, or [alias] if it is still a plain
+        index from an ingest before aliases were used.
+    """
+    if client.indices.exists_alias(name=alias):
+        return sorted(client.indices.get_alias(name=alias).keys())
+    if client.indices.exists(index=alias):
+        return [alias]
+    return []
+
+def create_versioned_index(client, alias="hcov19", number_of_shards=1):
+    """
+    Create a new index for a blue/green ingest behind alias, with replicas
+    and refreshes disabled while it is loaded.
+
+    Returns
+    -------
+    index : str
+        Name of the new index, the alias suffixed with the current time.
+    """
+    index = "%s_%s" %(alias, datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S"))
+    create_index(client, index, number_of_shards=number_of_shards)
+    client.indices.put_settings(index=index, body=bulk_index_settings)
+    return index
+
+def finish_versioned_index(client, index, replicas=1, refresh_interval="1s"):
+    """
+    Force-merge a loaded index into one segment per shard and restore the
+    serving settings, waiting until its primaries are allocated.
+    """
+    client.indices.refresh(index=index)
+    started = time.monotonic()
+    client.indices.forcemerge(index=index, max_num_segments=1, request_timeout=3600)
+    print("Force-merged %s in %.1fs" %(index, time.monotonic() - started))
+    client.indices.put_settings(index=index, body={
+        "index.number_of_replicas": replicas,
+        "index.refresh_interval": refresh_interval,
+    })
+    client.cluster.health(index=index, wait_for_status="yellow", request_timeout=600)
+
+def swap_aliases(client, targets):
+    """
+    Atomically point every alias of targets, a dict of alias to index, at
+    its index and delete the indices the aliases pointed to before. Plain
+    indices named like an alias are removed in the same request, so readers
+    never see a name missing or a mix of old and new indices.
+    """
+    actions = []
+    retired = []
+    for alias, index in targets.items():
+        actions.append({"add": {"index": index, "alias": alias}})
+        for old_index in get_alias_indices(client, alias):
+            if old_index == index:
+                continue
+            if old_index == alias:
+                actions.append({"remove_index": {"index": old_index}})
+            else:
+                actions.append({"remove": {"index": old_index, "alias": alias}})
+                retired.append(old_index)
+    client.indices.update_aliases(body={"actions": actions})
+    for alias, index in targets.items():
+        print("Alias %s now points to %s" %(alias, index))
+    for old_index in retired:
+        client.indices.delete(index=old_index, ignore=404)
+        print("Deleted %s" %old_index)
+
+def write_data_version(client, index="hcov19"):
+    # Version read by the API to invalidate its caches, delta ingests leave most @timestamps untouched
+    client.indices.put_mapping(index=index, body={"_meta": {"last_updated": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")}})
+
+
+def parse_int(value):
+    """
+    Positions are written as ints, floats or "None" by bjorn. Returns None
+    if the value is missing so that the integer field is left empty.
+    """
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    if np.isnan(value):
+        return None
+    return int(value)
+
+def parse_date(value):
+    """
+    Returns the date as YYYY-MM-DD, or None if it is partial (2021-03-XX,
+    2021-03) or malformed.
+    """
+    try:
+        return datetime.datetime.strptime(str(value), "%Y-%m-%d").strftime("%Y-%m-%d")
+    except ValueError:
+        return None
+
+def transform_row(row, line_number):
+    """
+    Parameters
+    ----------
+    row : dict
+        One parsed line of the bjorn output.
+    line_number : int
+        Line of the row in the file, the _id of rows without an accession_id.
 
+    Returns the document to index.
+    """
+    currentDT = datetime.datetime.utcnow() # UTC like the rollup and profile build times it is compared against
+    new_dict = {}
+    new_dict['@timestamp'] = currentDT.strftime("%Y-%m-%dT%H:%M:%SZ")
+    # Keyed like --delta ingests, so full and delta ingests replace each other's documents
+    new_dict['_id'] = str(row['accession_id']) if row.get('accession_id') else line_number
+    new_dict['strain'] = str(row['strain'])
+    new_dict['country'] = str(row['country'])
+    new_dict['originating_lab'] = str(row['originating_lab'])
+    new_dict['authors'] = str(row['authors'])
+    new_dict['country_id'] = str(row['country_id'])
+    new_dict['country_lower'] = str(row['country_lower'])
+    new_dict['division'] = str(row['division'])
+    new_dict['division_id'] = str(row['division_id'])
+    new_dict['division_lower'] = str(row['division_lower'])
+    new_dict['location'] = str(row['location'])
+    new_dict['location_id'] = str(row['location_id'])
+    new_dict['location_lower'] = str(row['location_lower'])
+    new_dict['accession_id'] = str(row['accession_id'])
+    new_dict['pangolin_lineage'] = str(row['pangolin_lineage'])
+    if 'pango_version' in row:
+        new_dict['pango_version'] = str(row['pango_version'])
+    if 'clade' in row:
+        new_dict['clade'] = str(row['clade'])
+    for field in ['date_submitted', 'date_collected', 'date_modified']:
+        new_dict[field] = str(row[field])
+        # Typed copy for date_histogram, left empty for partial dates such as 2021-03-XX
+        new_dict[field + '_dt'] = parse_date(row[field])
+        new_dict[field + '_valid'] = new_dict[field + '_dt'] is not None
+
+    if str(row['zipcode']).isdigit() and int(row['zipcode']) > 0:
+        new_dict['zipcode'] = str(row['zipcode'])
+    else:
+        new_dict['region'] = "None"
+        new_dict['zipcode'] = "None"
+    temp_list = []
+     
+    if row['mutations'] != None:
+        for mut in row['mutations']:
+            temp = {}
+            # Gene, amino acids and codon range are split from the key so that positions can be range queried
+            split = parse_mutation(mut['mutation'], synonymous = True)
+            # Deletions, insertions and ranges have no amino acid change, substitutions span a single codon
+            if split['type'] != "substitution" or "_" in mut['mutation'] or "ins" in mut['mutation'].lower():
+                split['ref_aa'] = split['alt_aa'] = None
+            if split['codon_end'] is None:
+                split['codon_end'] = split['codon_num']
+            temp['mutation'] = mut['mutation']
+            temp['type'] = mut['type']
+            temp['gene'] = mut['gene'] if mut['gene'] not in [None, "None"] else split['gene']
+            temp['ref_codon'] = mut['ref_codon']
+            temp['pos'] = parse_int(mut['pos'])
+            if 'alt_codon' in mut:
+                temp['alt_codon'] = mut['alt_codon']
+            temp['is_synonymous'] = mut['is_synonymous']
+            temp['ref_aa'] = mut['ref_aa'] if mut.get('ref_aa') not in [None, "None"] else split['ref_aa']
+            temp['codon_num'] = parse_int(mut['codon_num'])
+            if temp['codon_num'] is None:
+                temp['codon_num'] = split['codon_num']
+            temp['codon_end'] = split['codon_end'] if split['codon_num'] == temp['codon_num'] else temp['codon_num']
+            temp['alt_aa'] = mut['alt_aa'] if mut.get('alt_aa') not in [None, "None"] else split['alt_aa']
+            if 'absolute_coords' in mut:
+                temp['absolute_coords'] = mut['absolute_coords']
+            if 'change_length_nt' in mut:
+                temp['change_length_nt'] = parse_int(mut['change_length_nt'])
+            if 'nt_map_coords' in mut:
+                temp['nt_map_coords'] = mut['nt_map_coords']
+            if 'aa_map_coords'  in mut:
+                temp['aa_map_coords'] = mut['aa_map_coords']
+            temp_list.append(temp) 
+    new_dict['mutations'] = temp_list
+    return new_dict
 
 def generate_actions(json_filename):
     """
@@ -439,74 +995,555 @@ def generate_actions(json_filename):
     json_filename : str
         Full path to the json file containing metadata formatted in bjorn output style.
     """
-    test_mut_count = 0
     with open(json_filename, 'r') as jfile:
         for i, line in enumerate(jfile):
             row = json.loads(line)
-            currentDT = datetime.datetime.now()
-            new_dict = {}
-            new_dict['@timestamp'] = currentDT.strftime("%Y-%m-%dT%H:%M:%SZ")
-            new_dict['_id'] = i
-            new_dict['strain'] = str(row['strain'])
-            new_dict['country'] = str(row['country'])
-            new_dict['originating_lab'] = str(row['originating_lab'])
-            new_dict['authors'] = str(row['authors'])
             if str(row['country']) not in countries:
                 countries.append(str(row['country_id']))
-            new_dict['country_id'] = str(row['country_id'])
-            new_dict['country_lower'] = str(row['country_lower'])
-            new_dict['division'] = str(row['division'])
-            new_dict['division_id'] = str(row['division_id'])
-            new_dict['division_lower'] = str(row['division_lower'])
-            new_dict['location'] = str(row['location'])
-            new_dict['location_id'] = str(row['location_id'])
-            new_dict['location_lower'] = str(row['location_lower'])
-            new_dict['accession_id'] = str(row['accession_id'])
-            new_dict['pangolin_lineage'] = str(row['pangolin_lineage'])
-            if 'pango_version' in row:
-                new_dict['pango_version'] = str(row['pango_version'])
-            if 'clade' in row:
-                new_dict['clade'] = str(row['clade'])
-            new_dict['date_submitted'] = str(row['date_submitted'])
-            new_dict['date_collected'] = str(row['date_collected'])
-            new_dict['date_modified'] = str(row['date_modified'])
-
-            if str(row['zipcode']).isdigit() and int(row['zipcode']) > 0:
-                new_dict['zipcode'] = str(row['zipcode'])
+            yield transform_row(row, i)
+
+def get_json_loads(decoder = "auto"):
+    # orjson parses several times faster than json, "auto" uses it when installed
+    if decoder in ["auto", "orjson"]:
+        try:
+            import orjson
+            return orjson.loads
+        except ImportError:
+            if decoder == "orjson":
+                raise
+    return json.loads
+
+def split_jsonl(json_filename, chunk_bytes = 32 * 1024 * 1024):
+    """
+    Split a JSONL file into chunks of about chunk_bytes that end at line
+    boundaries.
+
+    Returns a list of (start offset, end offset, number of the first line).
+    Reads the file once, counting lines so chunks can keep line numbers
+    without being parsed in order.
+    """
+    chunks = []
+    start = 0
+    line = 0
+    with open(json_filename, 'rb') as f:
+        while True:
+            block = f.read(chunk_bytes)
+            if not block:
+                break
+            block += f.readline()
+            chunks.append((start, start + len(block), line))
+            line += block.count(b"\n") + (0 if block.endswith(b"\n") else 1)
+            start += len(block)
+    return chunks
+
+def parse_jsonl_chunk(json_filename, start, end, first_line, decoder = "auto"):
+    """
+    Parse and transform the lines between byte offsets start and end, run in
+    a worker process.
+
+    Returns the documents, the country ids seen and the CPU time spent.
+    """
+    began = time.process_time()
+    loads = get_json_loads(decoder)
+    with open(json_filename, 'rb') as f:
+        f.seek(start)
+        block = f.read(end - start)
+    lines = block.split(b"\n")
+    if block.endswith(b"\n"):
+        lines.pop()
+    docs = []
+    country_ids = set()
+    for i, line in enumerate(lines):
+        row = loads(line)
+        country_ids.add(str(row['country_id']))
+        docs.append(transform_row(row, first_line + i))
+    return docs, country_ids, time.process_time() - began
+
+def generate_actions_parallel(json_filename, workers = None, ordered = True, queue_size = None, chunk_bytes = 32 * 1024 * 1024, decoder = "auto", stats = None):
+    """
+    Same documents as generate_actions, parsed and transformed on a pool of
+    workers processes (one per CPU by default).
+
+    The file is split by byte offsets into chunks. At most queue_size
+    chunks (two per worker by default) are parsed or waiting to be sent at
+    a time, so memory stays bounded while the bulk sender catches up. With
+    ordered=False chunks are yielded as soon as they are parsed instead of
+    in file order.
+
+    stats, if given, is filled with the documents, parse wall and CPU time
+    and the time spent waiting for the parser.
+    """
+    workers = workers if workers else os.cpu_count()
+    queue_size = queue_size if queue_size else 2 * workers
+    stats = stats if stats is not None else {}
+    stats.update({"docs": 0, "chunks": 0, "parse_cpu": 0, "wait": 0})
+    started = time.monotonic()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+
+        def next_done():
+            wait_start = time.monotonic()
+            if ordered:
+                future = pending.popleft()
             else:
-                new_dict['region'] = "None"
-                new_dict['zipcode'] = "None"
-            temp_list = []
-             
-            if row['mutations'] != None:
-                for mut in row['mutations']:
-                    temp = {}
-                    temp['mutation'] = mut['mutation']
-                    temp['type'] = mut['type']
-                    temp['gene'] = mut['gene']     
-                    temp['ref_codon'] = mut['ref_codon']
-                    temp['pos'] = mut['pos']
-                    if 'alt_codon' in mut:
-                        temp['alt_codon'] = mut['alt_codon']
-                    temp['is_synonymous'] = mut['is_synonymous']
-                    if 'ref_aa' in mut:
-                        temp['ref_aa'] = mut['ref_aa']
-                    temp['codon_num'] = mut['codon_num']
-                    if 'alt_aa' in mut:
-                        temp['alt_aa'] = mut['alt_aa']
-                    if 'absolute_coords' in mut:
-                        temp['absolute_coords'] = mut['absolute_coords']
-                    if 'change_length_nt' in mut:
-                        temp['change_length_nt'] = mut['change_length_nt']
-                    if 'nt_map_coords' in mut:
-                        temp['nt_map_coords'] = mut['nt_map_coords']
-                    if 'aa_map_coords'  in mut:
-                        temp['aa_map_coords'] = mut['aa_map_coords']
-                    temp_list.append(temp) 
-            #print(temp_list)
-            new_dict['mutations'] = temp_list
-            #print(test_mut_count)    
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                future = done.pop()
+                pending.remove(future)
+            docs, country_ids, cpu_time = future.result()
+            stats["wait"] += time.monotonic() - wait_start
+            for i in country_ids:
+                if i not in countries:
+                    countries.append(i)
+            stats["docs"] += len(docs)
+            stats["chunks"] += 1
+            stats["parse_cpu"] += cpu_time
+            return docs
+
+        for chunk in split_jsonl(json_filename, chunk_bytes):
+            if len(pending) >= queue_size:
+                yield from next_done()
+            pending.append(executor.submit(parse_jsonl_chunk, json_filename, *chunk, decoder))
+        while pending:
+            yield from next_done()
+    stats["parse_wall"] = time.monotonic() - started
+    print("Parsed %s documents in %s chunks: %.0f docs/s wall, %.0f docs/s per worker, %.1fs waiting for the parser" %(
+        stats["docs"], stats["chunks"], stats["docs"] / max(stats["parse_wall"], 1e-9), stats["docs"] / max(stats["parse_cpu"], 1e-9), stats["wait"]))
+
+def get_indexed_versions(client, index="hcov19"):
+    """
+    Parameters
+    ----------
+    client :
+        ElasticSearch client.
+    index : str
+        Index with one document per sequence.
+
+    Returns
+    -------
+    versions : dict
+        (date_modified, date_collected, pangolin_lineage) of every indexed
+        document by _id, empty if the index does not exist.
+    """
+    versions = {}
+    if not client.indices.exists(index=index):
+        return versions
+    for hit in scan(client, index=index, query={"_source": ["date_modified", "date_collected", "pangolin_lineage"]}, size=10000):
+        source = hit["_source"]
+        # Dates and lineages repeat across millions of documents
+        versions[hit["_id"]] = (source.get("date_modified"), sys.intern(str(source.get("date_collected"))), sys.intern(str(source.get("pangolin_lineage"))))
+    return versions
+
+def generate_delta_actions(actions, versions, stats):
+    """
+    Turn the documents of a full ingest into a delta against the index.
+
+    Parameters
+    ----------
+    actions : iterable
+        Documents from generate_actions or generate_actions_parallel.
+    versions : dict
+        Indexed documents from get_indexed_versions, consumed as the
+        documents are compared.
+    stats : dict
+        Filled with the number of new, changed, unchanged and deleted
+        documents, and the collection dates and lineages the changed and
+        deleted documents had in the index.
+
+    Documents are keyed by accession_id and only sent when they are new or
+    their date_modified differs from the indexed one, replacing the indexed
+    document. Indexed documents missing from the input are deleted once the
+    input is exhausted.
+    """
+    stats.update({"new": 0, "changed": 0, "unchanged": 0, "deleted": 0, "dates": set(), "lineages": set()})
+    for doc in actions:
+        indexed = versions.pop(doc['_id'], None)
+        if indexed is None:
+            stats["new"] += 1
+        elif indexed[0] == doc['date_modified']:
+            stats["unchanged"] += 1
+            continue
+        else:
+            stats["changed"] += 1
+            stats["dates"].add(indexed[1])
+            stats["lineages"].add(indexed[2])
+        yield doc
+    while versions:
+        _id, (date_modified, date_collected, pangolin_lineage) = versions.popitem()
+        stats["deleted"] += 1
+        stats["dates"].add(date_collected)
+        stats["lineages"].add(pangolin_lineage)
+        yield {"_op_type": "delete", "_id": _id}
+
+def delete_stale_documents(client, before, index="hcov19"):
+    """
+    Delete the documents a full ingest did not write, those with an
+    @timestamp before it started: sequences dropped from the metadata, and
+    documents keyed on line numbers by ingests from before _id became the
+    accession_id.
+
+    Returns
+    -------
+    stats : dict
+        Number of deleted documents, and the collection dates and lineages
+        they had, to be recomputed in the rollup and lineage profiles.
+    """
+    client.indices.refresh(index=index)
+    query = {"range": {"@timestamp": {"lt": before}}}
+    resp = client.search(index=index, body={
+        "size": 0,
+        "query": query,
+        "aggs": {
+            "dates": {"terms": {"field": "date_collected", "size": 10000}},
+            "lineages": {"terms": {"field": "pangolin_lineage", "size": 10000}}
+        }
+    })
+    stats = {
+        "deleted": 0,
+        "dates": set(i["key"] for i in resp["aggregations"]["dates"]["buckets"]),
+        "lineages": set(i["key"] for i in resp["aggregations"]["lineages"]["buckets"])
+    }
+    if resp["hits"]["total"]["value"] > 0:
+        resp = client.delete_by_query(index=index, body={"query": query}, refresh=True, request_timeout=3600)
+        stats["deleted"] = resp["deleted"]
+    return stats
+
+rollup_key_fields = ["date_collected", "country", "country_id", "division", "division_id", "location", "location_id", "zipcode", "pangolin_lineage"]
+
+def create_rollup(client, index="hcov19_rollup"):
+    """
+    Creates the ES index holding daily sequence counts per location and lineage.
+
+    Parameters
+    ----------
+    client :
+        ElasticSearch client.
+    index : str
+        Name of the rollup index.
+    """
+    client.indices.create(
+        index=index,
+        body={
+            "settings": {"number_of_shards": 10,
+                "analysis": {
+                    "normalizer": {
+                        "keyword_lowercase": {
+                        "type": "custom",
+                        "filter": ["lowercase"]
+                        }
+                    }
+                }
+            },
+            "mappings": {
+            "properties": {
+                "@timestamp" : {"type" : "date", "format": "date_optional_time||epoch_millis" },
+                "date_collected" : {"type":"keyword"},
+                "date_collected_dt" : {"type":"date", "format":"yyyy-MM-dd"},
+                "date_collected_valid" : {"type":"boolean"},
+                "country": {"type":"keyword"},
+                "country_id" : {"type":"keyword"},
+                "division": {"type":"keyword"},
+                "division_id": {"type": "keyword"},
+                "location": {"type":"keyword"},
+                "location_id": {"type": "keyword"},
+                "zipcode" : {"type": "keyword"},
+                "pangolin_lineage" : {"type": "keyword", "normalizer":"keyword_lowercase"},
+                "count" : {"type": "integer"},
+                },
+            },
+        },
+        ignore=400,)
+
+def get_rollup_dates(client, source_index="hcov19", index="hcov19_rollup"):
+    """
+    Find the collection dates that need to be recomputed in the rollup index.
+
+    Parameters
+    ----------
+    client :
+        ElasticSearch client.
+    source_index : str
+        Index with one document per sequence.
+    index : str
+        Name of the rollup index.
+
+    Returns
+    -------
+    dates : list or None
+        Collection dates of sequences ingested since the last rollup build, or
+        None if the rollup is empty and has to be built from scratch.
+    """
+    resp = client.search(index=index, body={
+        "size": 0,
+        "aggs": {"last_build": {"max": {"field": "@timestamp"}}}
+    })
+    last_build = resp["aggregations"]["last_build"].get("value_as_string")
+    if last_build is None:
+        return None
+    resp = client.search(index=source_index, body={
+        "size": 0,
+        "query": {"range": {"@timestamp": {"gt": last_build}}},
+        "aggs": {"dates": {"terms": {"field": "date_collected", "size": 10000}}}
+    })
+    return [i["key"] for i in resp["aggregations"]["dates"]["buckets"]]
+
+def generate_rollup_actions(client, dates=None, source_index="hcov19"):
+    """
+    Aggregate the sequence index by date x location x lineage, yielding one
+    rollup document per non-empty combination.
+
+    Parameters
+    ----------
+    client :
+        ElasticSearch client.
+    dates : list
+        Restrict the rollup to these collection dates, all dates if None.
+    source_index : str
+        Index with one document per sequence.
+    """
+    build_time = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+    query = {
+        "size": 0,
+        "aggs": {
+            "rollup": {
+                "composite": {
+                    "size": 10000,
+                    "sources": [
+                        {field: {"terms": {"field": field, "missing_bucket": True}}}
+                        for field in rollup_key_fields
+                    ]
+                }
+            }
+        }
+    }
+    if dates is not None:
+        query["query"] = {"terms": {"date_collected": dates}}
+    while True:
+        resp = client.search(index=source_index, body=query)
+        for bucket in resp["aggregations"]["rollup"]["buckets"]:
+            new_dict = {field: bucket["key"][field] for field in rollup_key_fields}
+            new_dict["_id"] = hashlib.sha1(json.dumps([bucket["key"][field] for field in rollup_key_fields]).encode()).hexdigest()
+            new_dict["date_collected_dt"] = parse_date(new_dict["date_collected"])
+            new_dict["date_collected_valid"] = new_dict["date_collected_dt"] is not None
+            new_dict["@timestamp"] = build_time
+            new_dict["count"] = bucket["doc_count"]
             yield new_dict
+        if "after_key" not in resp["aggregations"]["rollup"]:
+            break
+        query["aggs"]["rollup"]["composite"]["after"] = resp["aggregations"]["rollup"]["after_key"]
+
+def update_rollup(client, source_index="hcov19", index="hcov19_rollup", stale_dates=None):
+    """
+    Bring the rollup index in line with the sequence index. Only dates with
+    newly ingested sequences are recomputed, unless the rollup is empty.
+
+    Parameters
+    ----------
+    client :
+        ElasticSearch client.
+    source_index : str
+        Index with one document per sequence.
+    index : str
+        Name of the rollup index.
+    stale_dates : iterable
+        Dates to recompute as well, those of sequences deleted or moved
+        to another date by a delta ingest.
+    """
+    create_rollup(client, index)
+    client.indices.refresh(index=source_index)
+    dates = get_rollup_dates(client, source_index, index)
+    if dates is not None:
+        dates = sorted(set(dates) | set(stale_dates or []))
+        if len(dates) == 0:
+            print("Rollup is up to date")
+            return
+        # Counts are recomputed from scratch for each affected date
+        client.delete_by_query(index=index, body={"query": {"terms": {"date_collected": dates}}}, refresh=True)
+        print("Updating rollup for %s dates" %len(dates))
+    else:
+        print("Building rollup")
+    successes = 0
+    for ok, action in streaming_bulk(
+        client=client, index=index, actions=generate_rollup_actions(client, dates, source_index),
+    ):
+        successes += ok
+    client.indices.refresh(index=index)
+    print("%s rollup documents indexed" %successes)
+
+def create_lineage_mutations(client, index="lineage_mutations"):
+    """
+    Creates the ES index holding one mutation frequency profile per lineage.
+
+    Parameters
+    ----------
+    client :
+        ElasticSearch client.
+    index : str
+        Name of the profile index.
+    """
+    client.indices.create(
+        index=index,
+        body={
+            "settings": {"number_of_shards": 1,
+                "analysis": {
+                    "normalizer": {
+                        "keyword_lowercase": {
+                        "type": "custom",
+                        "filter": ["lowercase"]
+                        }
+                    }
+                }
+            },
+            "mappings": {
+            "properties": {
+                "@timestamp" : {"type" : "date", "format": "date_optional_time||epoch_millis" },
+                "pangolin_lineage" : {"type": "keyword", "normalizer":"keyword_lowercase"},
+                "lineage_count" : {"type": "integer"},
+                "mutations" : {"type": "object", "enabled": False},
+                },
+            },
+        },
+        ignore=400,)
+
+def get_lineage_mutations_lineages(client, source_index="hcov19", index="lineage_mutations"):
+    """
+    Find the lineages whose profiles need to be recomputed.
+
+    Parameters
+    ----------
+    client :
+        ElasticSearch client.
+    source_index : str
+        Index with one document per sequence.
+    index : str
+        Name of the profile index.
+
+    Returns
+    -------
+    lineages : list or None
+        Lineages of sequences ingested since the last profile build, or None
+        if the profile index is empty and has to be built from scratch.
+    """
+    resp = client.search(index=index, body={
+        "size": 0,
+        "aggs": {"last_build": {"max": {"field": "@timestamp"}}}
+    })
+    last_build = resp["aggregations"]["last_build"].get("value_as_string")
+    if last_build is None:
+        return None
+    resp = client.search(index=source_index, body={
+        "size": 0,
+        "query": {"range": {"@timestamp": {"gt": last_build}}},
+        "aggs": {"lineages": {"terms": {"field": "pangolin_lineage", "size": 10000}}}
+    })
+    return [i["key"] for i in resp["aggregations"]["lineages"]["buckets"]]
+
+def generate_lineage_mutations_actions(client, lineages=None, source_index="hcov19"):
+    """
+    Count every mutation per lineage, yielding one profile document per
+    lineage with the mutation keys already parsed. Synonymous mutations are
+    left out and mutations are ordered by count, then name.
+
+    Parameters
+    ----------
+    client :
+        ElasticSearch client.
+    lineages : list
+        Restrict the profiles to these lineages, all lineages if None.
+    source_index : str
+        Index with one document per sequence.
+    """
+    build_time = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+    mutations_size = 10000
+    # Each lineage carries its composite and nested buckets plus up to mutations_size terms buckets, a page has to stay under search.max_buckets
+    lineages_size = max(get_max_buckets(client) // (mutations_size + 2), 1)
+    query = {
+        "size": 0,
+        "aggs": {
+            "lineages": {
+                "composite": {
+                    "size": lineages_size,
+                    "sources": [
+                        {"pangolin_lineage": {"terms": {"field": "pangolin_lineage"}}}
+                    ]
+                },
+                "aggs": {
+                    "mutations": {
+                        "nested": {
+                            "path": "mutations"
+                        },
+                        "aggs": {
+                            "mutations": {
+                                "terms": {
+                                    "field": "mutations.mutation",
+                                    "size": mutations_size
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
+    if lineages is not None:
+        query["query"] = {"terms": {"pangolin_lineage": lineages}}
+    while True:
+        resp = client.search(index=source_index, body=query)
+        for bucket in resp["aggregations"]["lineages"]["buckets"]:
+            mutations = []
+            for i in bucket["mutations"]["mutations"]["buckets"]:
+                parsed = parse_mutation(i["key"])
+                if parsed is not None:
+                    mutations.append(dict(mutation = i["key"], mutation_count = i["doc_count"], **parsed))
+            yield {
+                "_id": bucket["key"]["pangolin_lineage"],
+                "@timestamp": build_time,
+                "pangolin_lineage": bucket["key"]["pangolin_lineage"],
+                "lineage_count": bucket["doc_count"],
+                "mutations": sorted(mutations, key = lambda x: (-x["mutation_count"], x["mutation"]))
+            }
+        if "after_key" not in resp["aggregations"]["lineages"]:
+            break
+        query["aggs"]["lineages"]["composite"]["after"] = resp["aggregations"]["lineages"]["after_key"]
+
+def update_lineage_mutations(client, source_index="hcov19", index="lineage_mutations", stale_lineages=None):
+    """
+    Bring the lineage mutation profiles in line with the sequence index. Only
+    lineages with newly ingested sequences are recomputed, unless the profile
+    index is empty.
+
+    Parameters
+    ----------
+    client :
+        ElasticSearch client.
+    source_index : str
+        Index with one document per sequence.
+    index : str
+        Name of the profile index.
+    stale_lineages : iterable
+        Lineages to recompute as well, those of sequences deleted or
+        reassigned by a delta ingest.
+    """
+    create_lineage_mutations(client, index)
+    client.indices.refresh(index=source_index)
+    lineages = get_lineage_mutations_lineages(client, source_index, index)
+    if lineages is not None:
+        lineages = sorted(set(lineages) | set(stale_lineages or []))
+        if len(lineages) == 0:
+            print("Lineage mutation profiles are up to date")
+            return
+        # Lineages left without sequences would otherwise keep their old profile
+        client.delete_by_query(index=index, body={"query": {"terms": {"pangolin_lineage": lineages}}}, refresh=True)
+        print("Updating mutation profiles of %s lineages" %len(lineages))
+    else:
+        print("Building lineage mutation profiles")
+    successes = 0
+    # Profiles are keyed on the lineage, so recomputed ones replace the old documents
+    for ok, action in streaming_bulk(
+        client=client, index=index, actions=generate_lineage_mutations_actions(client, lineages, source_index), chunk_size=50,
+    ):
+        successes += ok
+    client.indices.refresh(index=index)
+    print("%s lineage mutation profiles indexed" %successes)
 
 def create_epi(client):
     """
@@ -563,6 +1600,15 @@ def main():
     parser.add_argument('-z','--zipcode', help='Full path to config file.', required=False)
     parser.add_argument('-c', '--config', help="Full path to config file.", required=False)
     parser.add_argument('--hostname', nargs="?",const="es",help='Hostname in case not being run via docker.', required=False)
+    parser.add_argument('--workers', type=int, default=0, help='Number of processes simplifying shapes, 0 starts one per CPU.', required=False)
+    parser.add_argument('--cache-dir', default='./cache', help='Directory caching GADM downloads and simplified shapes, empty to disable.', required=False)
+    parser.add_argument('--offline', action='store_true', help='Take GADM shapefiles from --cache-dir only.', required=False)
+    parser.add_argument('--parse-workers', type=int, default=0, help='Number of processes parsing the json metadata, 0 starts one per CPU, 1 parses in the main process.', required=False)
+    parser.add_argument('--unordered', action='store_true', help='Send parsed chunks as they finish instead of in file order.', required=False)
+    parser.add_argument('--delta', action='store_true', help='Key documents on accession_id and only send new, changed (by date_modified) and deleted ones.', required=False)
+    parser.add_argument('--json-decoder', choices=['auto', 'json', 'orjson'], default='auto', help='JSON decoder of the metadata, auto uses orjson when installed.', required=False)
+    parser.add_argument('--blue-green', action='store_true', help='Load into a new hcov19 index and swap the hcov19 alias to it once loaded.', required=False)
+    parser.add_argument('--replicas', type=int, default=1, help='Replicas of a --blue-green index once loaded.', required=False)
     
     args = parser.parse_args()
     
@@ -602,9 +1648,12 @@ def main():
         
     
 
+    #shard counts follow the size of the inputs
+    data_nodes = get_data_nodes(client)
+
     #if we have a zipcode file provided we process it
     if zipcodes is not None: 
-        create_zipcode(client)
+        create_zipcode(client, plan_shards(0, os.path.getsize(zipcodes), data_nodes))
         print("Indexing zipcodes...")
         successes = 0
         
@@ -613,40 +1662,127 @@ def main():
         ):
             successes += ok
         
-        
-    create_polygon(client)
        
     print("Indexing shapes...")
     successes = 0
        
     #handle geojson shapes not related to zipcode
     unique_countries = np.unique(countries)   
-    get_gpkg(unique_countries)
- 
-    for ok, action in streaming_bulk(
-        client=client, index="shape", actions=simplify_gpkg(),
-    ):
-        successes += 1
+    cache_dir = args.cache_dir if args.cache_dir else None
+    if args.offline and cache_dir is None:
+        parser.error("--offline needs --cache-dir")
+    get_gpkg(unique_countries, cache_dir=cache_dir, offline=args.offline)
+    #shapes are loaded into a new index and swapped in whole, so documents from earlier ingests
+    #(keyed on a counter before _ids became <file>_<i>) are never served next to the new ones
+    shape_index = "shape_%s" %datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S")
+    create_polygon(client, plan_shards(0, get_directory_size('./shapefiles'), data_nodes), shape_index)
+    try:
+        for ok, action in streaming_bulk(
+            client=client, index=shape_index, actions=simplify_gpkg(workers=args.workers, cache_dir=cache_dir),
+        ):
+            successes += ok
+        client.indices.refresh(index=shape_index)
+    except BaseException:
+        client.indices.delete(index=shape_index, ignore=404)
+        raise
+    if successes > 0:
+        swap_aliases(client, {"shape": shape_index})
+    else:
+        #an empty ./shapefiles must not replace the served shapes
+        print("No shapes loaded, keeping the current shape index")
+        client.indices.delete(index=shape_index, ignore=404)
 
     #handle hcov19 things
-    create_index(client)
-    client.indices.put_settings(index="hcov19", body={
-    "index.refresh_interval": "1s",
-    })    
+    records, nested = estimate_jsonl(json_filename)
+    number_of_shards = plan_shards(records * (1 + nested), os.path.getsize(json_filename), data_nodes)
+    print("Planned %s shards for about %s records with %.1f mutations each" %(number_of_shards, records, nested))
+    if args.blue_green:
+        if args.delta:
+            parser.error("--delta updates hcov19 in place and cannot be combined with --blue-green")
+        #readers keep using the old index until the new one is loaded and merged
+        index = create_versioned_index(client, number_of_shards=number_of_shards)
+        print("Loading %s" %index)
+    else:
+        index = "hcov19"
+        create_index(client, number_of_shards=number_of_shards)
+        client.indices.put_settings(index="hcov19", body={
+        "index.refresh_interval": "1s",
+        })    
     
-    #parallel bulk ingestion
+    #parallel bulk ingestion, failed documents are counted instead of raised so that a --blue-green index can be dropped
     success = 0
     fails = 0
-    for ok, action in parallel_bulk(
-        client=client, index="hcov19", actions=generate_actions(json_filename), \
-        thread_count=8, chunk_size=5000, queue_size=5
-    ):  
-        if ok:
-            success += 1
-        else:
-            fails += 1
-    print("%s documents successfully ingested" %success)
+    parse_stats = {}
+    if args.parse_workers == 1:
+        actions = generate_actions(json_filename)
+    else:
+        actions = generate_actions_parallel(json_filename, workers=args.parse_workers, ordered=not args.unordered, decoder=args.json_decoder, stats=parse_stats)
+    delta_stats = {}
+    if args.delta:
+        versions = get_indexed_versions(client)
+        print("%s documents indexed before the delta" %len(versions))
+        actions = generate_delta_actions(actions, versions, delta_stats)
+    ingest_started = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+    started = time.monotonic()
+    try:
+        for ok, action in parallel_bulk(
+            client=client, index=index, actions=actions, \
+            thread_count=8, chunk_size=5000, queue_size=5, raise_on_error=False, raise_on_exception=False
+        ):  
+            if ok:
+                success += 1
+            else:
+                fails += 1
+    except BaseException:
+        if args.blue_green:
+            client.indices.delete(index=index, ignore=404)
+            print("Deleted %s, hcov19 was left unchanged" %index)
+        raise
+    elapsed = time.monotonic() - started
+    print("%s documents successfully ingested in %.1fs, %.0f docs/s" %(success, elapsed, success / max(elapsed, 1e-9)))
     print("%s documented failed to ingest" %fails)
+    if args.delta:
+        total = delta_stats["new"] + delta_stats["changed"] + delta_stats["unchanged"]
+        print("Delta: %s new, %s changed, %s unchanged, %s deleted (%.1f%% of %s documents sent)" %(
+            delta_stats["new"], delta_stats["changed"], delta_stats["unchanged"], delta_stats["deleted"],
+            100 * (total - delta_stats["unchanged"] + delta_stats["deleted"]) / max(total, 1), total))
+
+    if args.blue_green:
+        if fails > 0:
+            client.indices.delete(index=index, ignore=404)
+            sys.exit("Deleted %s, hcov19 was left unchanged" %index)
+        #the rollup and profiles are built from the new index and swapped in together with it
+        suffix = index[len("hcov19_"):]
+        targets = {"hcov19": index, "hcov19_rollup": "hcov19_rollup_%s" %suffix, "lineage_mutations": "lineage_mutations_%s" %suffix}
+        try:
+            finish_versioned_index(client, index, replicas=args.replicas)
+            update_rollup(client, source_index=index, index=targets["hcov19_rollup"])
+            update_lineage_mutations(client, source_index=index, index=targets["lineage_mutations"])
+            write_data_version(client, index)
+        except BaseException:
+            for i in targets.values():
+                client.indices.delete(index=i, ignore=404)
+            print("Deleted %s, hcov19 was left unchanged" %", ".join(targets.values()))
+            raise
+        swap_aliases(client, targets)
+        return
+
+    #a full ingest in place replaces every document, the ones it did not write are stale
+    if not args.delta:
+        if fails > 0:
+            print("Kept documents from earlier ingests since %s documents failed" %fails)
+        else:
+            delta_stats = delete_stale_documents(client, ingest_started, index)
+            print("%s stale documents deleted" %delta_stats["deleted"])
+
+    #refresh the daily rollup read by the prevalence handlers
+    update_rollup(client, stale_dates=delta_stats.get("dates"))
+
+    #precompute the mutation profiles read by the lineage-mutations handler
+    update_lineage_mutations(client, stale_lineages=delta_stats.get("lineages"))
+
+    #written last, so no response is cached against a rollup or profiles still being rebuilt
+    write_data_version(client, index)
   
     #create_snapshot(client)
 
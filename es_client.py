@@ -0,0 +1,140 @@
+import time
+import asyncio
+import aiohttp
+from elasticsearch import AsyncElasticsearch
+from elasticsearch._async.http_aiohttp import AIOHttpConnection, ESClientResponse
+
+
+class ConnectionPoolStats:
+    """
+    Saturation and wait time of the aiohttp connection pool behind AsyncElasticsearch.
+
+    Filled from aiohttp trace hooks: a request is queued when all pool_size
+    connections are busy, and the time until it gets a connection is its wait.
+    """
+
+    def __init__(self, pool_size):
+        self.pool_size = pool_size
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.waiting = 0
+        self.waits = 0
+        self.wait_time_total = 0
+        self.wait_time_max = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+
+    def trace_config(self):
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self.on_request_start)
+        trace_config.on_request_end.append(self.on_request_end)
+        trace_config.on_request_exception.append(self.on_request_exception)
+        trace_config.on_connection_queued_start.append(self.on_queued_start)
+        trace_config.on_connection_queued_end.append(self.on_queued_end)
+        trace_config.on_connection_create_end.append(self.on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(self.on_connection_reuseconn)
+        return trace_config
+
+    async def on_request_start(self, session, ctx, params):
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    async def on_request_end(self, session, ctx, params):
+        self.in_flight -= 1
+
+    async def on_request_exception(self, session, ctx, params):
+        self.in_flight -= 1
+        self.failures += 1
+
+    async def on_queued_start(self, session, ctx, params):
+        self.waiting += 1
+        ctx.queued_at = time.monotonic()
+
+    async def on_queued_end(self, session, ctx, params):
+        wait_time = time.monotonic() - ctx.queued_at
+        self.waiting -= 1
+        self.waits += 1
+        self.wait_time_total += wait_time
+        self.wait_time_max = max(self.wait_time_max, wait_time)
+
+    async def on_connection_create_end(self, session, ctx, params):
+        self.connections_created += 1
+
+    async def on_connection_reuseconn(self, session, ctx, params):
+        self.connections_reused += 1
+
+    def stats(self):
+        return {
+            "pool_size": self.pool_size,
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "saturation": (self.in_flight - self.waiting) / self.pool_size if self.pool_size > 0 else None, # Share of connections busy
+            "requests": self.requests,
+            "failures": self.failures,
+            "waiting": self.waiting,
+            "waits": self.waits,
+            "wait_time_total": self.wait_time_total,
+            "wait_time_max": self.wait_time_max,
+            "wait_time_mean": self.wait_time_total / self.waits if self.waits > 0 else 0,
+            "connections_created": self.connections_created,
+            "connections_reused": self.connections_reused
+        }
+
+
+class PooledAIOHttpConnection(AIOHttpConnection):
+    """
+    AIOHttpConnection with a configurable keep-alive and pool statistics.
+
+    The stock connection creates its TCPConnector with aiohttp's defaults and
+    no trace hooks, so the session is built here instead.
+    """
+
+    def __init__(self, *args, keepalive_timeout = 15, pool_stats = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.keepalive_timeout = keepalive_timeout
+        self.pool_stats = pool_stats
+
+    async def _create_aiohttp_session(self):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        self.session = aiohttp.ClientSession(
+            headers=self.headers,
+            skip_auto_headers=("accept", "accept-encoding"),
+            auto_decompress=True,
+            cookie_jar=aiohttp.DummyCookieJar(),
+            response_class=ESClientResponse,
+            connector=aiohttp.TCPConnector(
+                limit=self._limit,
+                keepalive_timeout=self.keepalive_timeout if self.keepalive_timeout > 0 else None,
+                force_close=self.keepalive_timeout <= 0,
+                use_dns_cache=True,
+                ssl=self._ssl_context
+            ),
+            trace_configs=[self.pool_stats.trace_config()] if self.pool_stats is not None else None
+        )
+
+
+def create_es_client(hostname, pool_size = 10, keepalive_timeout = 15, timeout = 10, max_retries = 3, http_compress = False):
+    """
+    AsyncElasticsearch with one pool of pool_size connections per node.
+
+    timeout is the default per-request timeout in seconds, http_compress
+    gzips request bodies and asks ES for gzipped responses. Returns the
+    client and its ConnectionPoolStats.
+    """
+    pool_stats = ConnectionPoolStats(pool_size)
+    client = AsyncElasticsearch(
+        hosts=[{'host': '%s' %hostname}],
+        connection_class=PooledAIOHttpConnection,
+        maxsize=pool_size,
+        keepalive_timeout=keepalive_timeout,
+        pool_stats=pool_stats,
+        timeout=timeout,
+        max_retries=max_retries,
+        retry_on_timeout=True,
+        http_compress=http_compress
+    )
+    return client, pool_stats
@@ -1,7 +1,12 @@
-import pandas as pd
-from base import BaseHandler
+import json
+import time
+import tornado.web
+import tornado.httputil
+from urllib.parse import urlencode
+from base import BaseHandler, MsearchBatcher
 from tornado import gen
-from util import create_nested_mutation_query, parse_location_id_to_query
+from tornado.log import app_log
+from util import create_nested_mutation_query, parse_location_id_to_query, create_range_partitions, create_date_partitions, create_date_histogram_agg, create_shape_level_source, set_shape_level, get_sub_name
 
 class SequenceCountHandler(BaseHandler):
 
@@ -24,12 +29,7 @@ class SequenceCountHandler(BaseHandler):
         flattened_response = []
         if not query_cumulative:
             query["aggs"] = {
-                "date": {
-                    "terms": {
-                        "field": "date_collected",
-                        "size": self.size
-                    }
-                }
+                "date": create_date_histogram_agg(self.get_date_interval())
             }
             resp = yield self.asynchronous_fetch(query)
             path_to_results = ["aggregations", "date", "buckets"]
@@ -38,10 +38,9 @@ class SequenceCountHandler(BaseHandler):
                 buckets = buckets[i]
            
             flattened_response = [{
-                "date": i["key"],
+                "date": i["key_as_string"],
                 "total_count": i["doc_count"]
-            } for i in buckets if not (len(i["key"].split("-")) < 3 or "XX" in i["key"])]
-            flattened_response = sorted(flattened_response, key = lambda x: x["date"])
+            } for i in buckets]
         else:
             if query_return_loc:
                 query["aggs"] = {
@@ -149,7 +148,7 @@ class GisaidIDHandler(BaseHandler):
         self.write(resp)
 
 class MostRecentDateHandler(BaseHandler):
-    field = "date_collected"
+    field = "date_collected_dt"
 
     @gen.coroutine
     def get(self):
@@ -164,7 +163,8 @@ class MostRecentDateHandler(BaseHandler):
                 "date_collected": {
                     "terms": {
                         "field": self.field,
-                        "size": 10000
+                        "size": 1,
+                        "order": {"_key": "desc"}
                     }
                 }
             }
@@ -173,41 +173,24 @@ class MostRecentDateHandler(BaseHandler):
         query_obj = create_nested_mutation_query(lineages = query_pangolin_lineage, mutations = query_mutations, location_id = query_location)
         query["query"] = query_obj
         resp = yield self.asynchronous_fetch(query)
-        print(resp)
         path_to_results = ["aggregations", "date_collected", "buckets"]
         buckets = resp
         for i in path_to_results:
             buckets = buckets[i]
         if len(buckets) == 0:
             return {"success": True, "results": []}
-        flattened_response = []
-        for i in buckets:
-            if len(i["key"].split("-")) == 1 or "XX" in i["key"]:
-                continue
-            flattened_response.append({
-                "date": i["key"],
-                "date_count": i["doc_count"]
-            })
-        df_response = (
-            pd.DataFrame(flattened_response)
-            .assign(
-                date = lambda x: pd.to_datetime(x["date"], format="%Y-%m-%d"),
-                date_count = lambda x: x["date_count"].astype(int)
-            )
-            .sort_values("date")
-        )
-        df_response = df_response.iloc[-1]
-        df_response.loc["date"] = df_response["date"].strftime("%Y-%m-%d")
-        df_response.loc["date_count"] = int(df_response["date_count"])
-        dict_response = df_response.to_dict()
+        dict_response = {
+            "date": buckets[0]["key_as_string"],
+            "date_count": buckets[0]["doc_count"]
+        }
         resp = {"success": True, "results": dict_response}
         self.write(resp)
 
 class MostRecentCollectionDateHandler(MostRecentDateHandler):
-    field = "date_collected"
+    field = "date_collected_dt"
 
 class MostRecentSubmissionDateHandler(MostRecentDateHandler):
-    field = "date_submitted"
+    field = "date_submitted_dt"
 
 class LocationDetailsHandler(BaseHandler):
 
@@ -356,90 +339,132 @@ class Zipcode(BaseHandler):
             admin_level = 1 
             
         #print(query)
-        resp = yield self.asynchronous_fetch(query)
-        flattened_response.append(resp['hits']['hits'])
+        # Get all paginated results, partitioned by leading zipcode digit
+        partitions = create_range_partitions("zipcode", list("123456789"))
+        if self.is_streaming():
+            yield self.stream_records(query, partitions, query_location)
+            return
+        resp = yield self.asynchronous_fetch_composite(query, "sub_date_buckets", partitions = partitions)
+        flattened_response.append(resp['hits'])
                         
-        ctr = 0
-        buckets = resp["aggregations"]["sub_date_buckets"]["buckets"]
-         
-        # Get all paginated results
-        while "after_key" in resp["aggregations"]["sub_date_buckets"]:
-            query["aggs"]["sub_date_buckets"]["composite"]["after"] = resp["aggregations"]["sub_date_buckets"]["after_key"]
-            resp = yield self.asynchronous_fetch(query)
-            buckets.extend(resp["aggregations"]["sub_date_buckets"]["buckets"])
+        buckets = resp["buckets"]
         
         dict_response = {}
         
         if len(buckets) > 0:
-            flattened_response = []
-            for i in buckets:
-               
-                if i["key"]["sub"].lower().replace("-", "").replace(" ", "") == "outofstate":
-                    i["key"]["sub"] = "Out of state"
-                if i["key"]["sub"].lower() in ["none", "unknown"]:
-                    i["key"]["sub"] = "Unknown"
-                if i['key']['zipcode'] != 'None':
-                    rec = {
-                        "zipcode": i["key"]["zipcode"],
-                        "name": i["key"]["sub"],
-                        "id": i["key"]["sub_id"],
-                        "total_count": i["doc_count"],
-                   }
-                    rec["id"] = "_".join([query_location, i["key"]["zipcode"]])
-                    flattened_response.append(rec) 
+            flattened_response = self.flatten_buckets(buckets, query_location)
 
         resp = {"success": True, "results": flattened_response}
         self.write(resp)
 
+    def flatten_buckets(self, buckets, query_location):
+        flattened_response = []
+        for i in buckets:
+           
+            i["key"]["sub"] = get_sub_name(i["key"]["sub"])
+            if i['key']['zipcode'] != 'None':
+                rec = {
+                    "zipcode": i["key"]["zipcode"],
+                    "name": i["key"]["sub"],
+                    "id": i["key"]["sub_id"],
+                    "total_count": i["doc_count"],
+               }
+                rec["id"] = "_".join([query_location, i["key"]["zipcode"]])
+                flattened_response.append(rec) 
+        return flattened_response
+
+    async def stream_records(self, query, partitions, query_location):
+        async for buckets in self.iter_composite_pages(query, "sub_date_buckets", partitions = partitions):
+            await self.write_ndjson(self.flatten_buckets(buckets, query_location))
+
 class LabCounts(BaseHandler):
+    """
+    Sequence counts per originating lab, optionally filtered by location,
+    lineage and collection date. Either the top N labs by count or all labs
+    paged with a composite cursor.
+    """
+
     @gen.coroutine
     def get(self):
-        response = ''
-        flattened_response = []
-        results={}
+        query_location = self.get_argument("location_id", None)
+        query_pangolin_lineage = self.get_argument("pangolin_lineage", None)
+        query_pangolin_lineage = query_pangolin_lineage.split(",") if query_pangolin_lineage is not None else []
+        query_min_date = self.get_argument("min_date", None)
+        query_max_date = self.get_argument("max_date", None)
+        query_top = self.get_argument("top", None)
+        query_top = int(query_top) if query_top is not None else None
+        query_page_size = self.get_argument("page_size", None)
+        query_after = self.get_argument("after", None)
+        paged = query_page_size is not None or query_after is not None
+        query_page_size = int(query_page_size) if query_page_size is not None else self.size
         query = {
-            "query": {"bool": {
-                "must": []
+            "size": 0,
+            "query": {
+                "bool": {
+                    "filter": []
                 }
             }
         }
-        res = yield self.asynchronous_fetch_count(query)
-        size = res['count'] 
-        query["sort"]=[{"date_collected": "asc", "_id": "asc"}]
-        query['size'] = 10000
-        lab_counts = {}
-        resp = yield self.asynchronous_fetch(query)
-        #record the stuff
-        for thing in resp['hits']['hits']:
-            thing = thing["_source"]
-            if thing['originating_lab'] in lab_counts:
-                lab_counts[thing['originating_lab']]['count'] += 1
-            else:
-                lab_counts[thing['originating_lab']] = {}
-                lab_counts[thing['originating_lab']]['count'] = 1
-                lab_counts[thing['originating_lab']]['name'] = thing['originating_lab']
- 
-        bookmark = [resp['hits']['hits'][-1]['sort'][0], str(resp['hits']['hits'][-1]['sort'][1])]
-        query["search_after"]= bookmark   
-        while len(resp['hits']['hits']) < size:
-            res = yield self.asynchronous_fetch(query)
-            for el in res['hits']['hits']:
-                resp['hits']['hits'].append(el)
-                bookmark = [res['hits']['hits'][-1]['sort'][0], str(resp['hits']['hits'][-1]['sort'][1])]
-
-            
-                thing = el["_source"]
-                if thing['originating_lab'] in lab_counts:
-                    lab_counts[thing['originating_lab']]['count'] += 1
-                else:
-                    lab_counts[thing['originating_lab']] = {}
-                    lab_counts[thing['originating_lab']]['count'] = 1
-                    lab_counts[thing['originating_lab']]['name'] = thing['originating_lab']
-        return_counts = []
-        
-        for key, value in lab_counts.items():
-            return_counts.append(value)
+        if query_location is not None:
+            query["query"]["bool"]["filter"].append(parse_location_id_to_query(query_location))
+        if len(query_pangolin_lineage) > 0:
+            query["query"]["bool"]["filter"].append(create_nested_mutation_query(lineages = query_pangolin_lineage))
+        if query_min_date is not None or query_max_date is not None:
+            date_range = {}
+            if query_min_date is not None:
+                date_range["gte"] = query_min_date
+            if query_max_date is not None:
+                date_range["lte"] = query_max_date
+            query["query"]["bool"]["filter"].append({
+                "range": {
+                    "date_collected_dt": date_range
+                }
+            })
+        if query_top is not None:
+            query["aggs"] = {
+                "labs": {
+                    "terms": {
+                        "field": "originating_lab",
+                        "size": query_top
+                    }
+                }
+            }
+            resp = yield self.asynchronous_fetch(query)
+            return_counts = [{
+                "count": i["doc_count"],
+                "name": i["key"]
+            } for i in resp["aggregations"]["labs"]["buckets"]]
+            resp = {"success": True, "results": return_counts}
+            self.write(resp)
+            return
+        query["aggs"] = {
+            "labs": {
+                "composite": {
+                    "size": query_page_size,
+                    "sources": [
+                        {"originating_lab": { "terms": {"field": "originating_lab"}}}
+                    ]
+                }
+            }
+        }
+        if query_after is not None:
+            query["aggs"]["labs"]["composite"]["after"] = {"originating_lab": query_after}
+        after_key = None
+        if paged:
+            resp = yield self.asynchronous_fetch(query)
+            buckets = resp["aggregations"]["labs"]["buckets"]
+            after_key = resp["aggregations"]["labs"].get("after_key")
+        else:
+            resp = yield self.asynchronous_fetch_composite(query, "labs")
+            buckets = resp["buckets"]
+        return_counts = [{
+            "count": i["doc_count"],
+            "name": i["key"]["originating_lab"]
+        } for i in buckets]
         resp = {"success": True, "results": return_counts}
+        if paged:
+            # Cursor for the next page, None once all labs are returned
+            resp["next"] = after_key["originating_lab"] if after_key is not None and len(buckets) == query_page_size else None
         self.write(resp)
 
 class CaseCounts(BaseHandler):
@@ -524,31 +549,20 @@ class ShapeByZipcode(BaseHandler):
         query_location = self.get_argument("location_id", None)
         flattened_response = []
         results={}
+        shape_level = self.get_shape_level()
+        # Only the hits are returned, aggregating the shape strings was wasted work.
         query = {
-            "size": 1000,
-            "aggs": {
-                "sub_date_buckets": {
-                    "composite": {
-                        "size": 10000,
-                        "sources": [
-                            {"shape": { "terms": {"field": "shape"}}},
-                            {"zipcode_name": { "terms": {"field": "zipcode_name"}}}
-                        ]
-                    },
-                    
-                }
-            }
+            "size": 1000
         }
-
-    
-       
-        query["aggs"]["sub_date_buckets"]["composite"]["sources"].extend([
-            {"sub_id": { "terms": {"field": "zipcode"} }}
-        ])
+        if shape_level is not None:
+            query["_source"] = create_shape_level_source(shape_level)
          
         resp = yield self.asynchronous_fetch_sdzipcode(query)        
         
-        flattened_response.append(resp['hits']['hits'])
+        hits = resp['hits']['hits']
+        if shape_level is not None:
+            set_shape_level(hits, shape_level)
+        flattened_response.append(hits)
         #self.write(flattened_response)
         """ 
         ctr = 0
@@ -594,6 +608,7 @@ class Shape(BaseHandler):
         query_location = self.get_argument("location_id", None)
         flattened_response = []
         results={}
+        shape_level = self.get_shape_level()
         query = {
             "size": 1000,
             "aggs": {
@@ -601,13 +616,15 @@ class Shape(BaseHandler):
                     "composite": {
                         "size": 10000,
                         "sources": [
-                            {"date_collected": { "terms": {"field": "date_collected"}}}
+                            {"date_collected": { "date_histogram": {"field": "date_collected_dt", "calendar_interval": "day", "format": "yyyy-MM-dd"}}}
                         ]
                     },
                     
                 }
             }
         }
+        if shape_level is not None:
+            query["_source"] = create_shape_level_source(shape_level)
 
     
         if query_location is not None: # Global
@@ -637,49 +654,52 @@ class Shape(BaseHandler):
             ])
             admin_level = 1 
          
-        resp = yield self.asynchronous_fetch_shape(query)
-        flattened_response.append(resp['hits']['hits'])
-        
-        ctr = 0
-        buckets = resp["aggregations"]["sub_date_buckets"]["buckets"]
+        if self.is_streaming():
+            yield self.stream_records(query, query_location, admin_level)
+            return
         # Get all paginated results
-        while "after_key" in resp["aggregations"]["sub_date_buckets"]:
-            query["aggs"]["sub_date_buckets"]["composite"]["after"] = resp["aggregations"]["sub_date_buckets"]["after_key"]
-            resp = yield self.asynchronous_fetch_shape(query)
-            buckets.extend(resp["aggregations"]["sub_date_buckets"]["buckets"])
+        resp = yield self.asynchronous_fetch_composite(query, "sub_date_buckets", fetch = self.asynchronous_fetch_shape)
+        if shape_level is not None:
+            set_shape_level(resp['hits'], shape_level)
+        flattened_response.append(resp['hits'])
+        
+        buckets = resp["buckets"]
         dict_response = {}
         if len(buckets) > 0:
-            flattened_response = []
-            for i in buckets:
-                if len(i["key"]["date_collected"].split("-")) < 3 or "XX" in i["key"]["date_collected"]:
-                    continue
-                # Check for None and out of state
-
-                if i["key"]["sub"].lower().replace("-", "").replace(" ", "") == "outofstate":
-                    i["key"]["sub"] = "Out of state"
-                if i["key"]["sub"].lower() in ["none", "unknown"]:
-                    i["key"]["sub"] = "Unknown"
-                rec = {
-                    "date": i["key"]["date_collected"],
-                    "name": i["key"]["sub"],
-                    "id": i["key"]["sub_id"],
-                    "total_count": i["doc_count"],
-                    "lineage_count": i["lineage_count"]["doc_count"]
-                }
-                if admin_level == 1:
-                    rec["id"] = "_".join([query_location, self.country_iso3_to_iso2[query_location]+"-"+i["key"]["sub_id"] if query_location in self.country_iso3_to_iso2 else query_location + "-" + i["key"]["sub_id"]])
-                elif admin_level == 2:
-                    rec["id"] = "_".join([query_location, i["key"]["sub_id"]])
-                elif admin_level == "z":
-                    rec["id"] = "_".join([query_location, i["key"]["sub_id"]])
- 
-                flattened_response.append(rec) 
+            flattened_response = self.flatten_buckets(buckets, query_location, admin_level)
 
 
 
         resp = {"success": True, "results": flattened_response}
         self.write(resp)
 
+    def flatten_buckets(self, buckets, query_location, admin_level):
+        flattened_response = []
+        for i in buckets:
+            # Check for None and out of state
+
+            i["key"]["sub"] = get_sub_name(i["key"]["sub"])
+            rec = {
+                "date": i["key"]["date_collected"],
+                "name": i["key"]["sub"],
+                "id": i["key"]["sub_id"],
+                "total_count": i["doc_count"],
+                "lineage_count": i["lineage_count"]["doc_count"]
+            }
+            if admin_level == 1:
+                rec["id"] = "_".join([query_location, self.country_iso3_to_iso2[query_location]+"-"+i["key"]["sub_id"] if query_location in self.country_iso3_to_iso2 else query_location + "-" + i["key"]["sub_id"]])
+            elif admin_level == 2:
+                rec["id"] = "_".join([query_location, i["key"]["sub_id"]])
+            elif admin_level == "z":
+                rec["id"] = "_".join([query_location, i["key"]["sub_id"]])
+
+            flattened_response.append(rec) 
+        return flattened_response
+
+    async def stream_records(self, query, query_location, admin_level):
+        async for buckets in self.iter_composite_pages(query, "sub_date_buckets", fetch = self.asynchronous_fetch_shape):
+            await self.write_ndjson(self.flatten_buckets(buckets, query_location, admin_level))
+
 
 class LocationHandler(BaseHandler):
 
@@ -875,6 +895,107 @@ class MutationHandler(BaseHandler):
         resp = {"success": True, "results": flattened_response}
         self.write(resp)
 
+class MutationsInRangeHandler(BaseHandler):
+
+    @gen.coroutine
+    def get(self):
+        query_gene = self.get_argument("gene", None)
+        query_location = self.get_argument("location_id", None)
+        query_pangolin_lineage = self.get_argument("pangolin_lineage", None)
+        try:
+            codon_start = int(self.get_argument("codon_start")) if self.get_argument("codon_start", None) is not None else None
+            codon_end = int(self.get_argument("codon_end")) if self.get_argument("codon_end", None) is not None else None
+            pos_start = int(self.get_argument("pos_start")) if self.get_argument("pos_start", None) is not None else None
+            pos_end = int(self.get_argument("pos_end")) if self.get_argument("pos_end", None) is not None else None
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason = "Positions have to be integers")
+        # A mutation is in range if any of its codons codon_num..codon_end is
+        range_filter = []
+        if query_gene is not None:
+            range_filter.append({"term": {"mutations.gene": query_gene}})
+        if codon_start is not None:
+            range_filter.append({"range": {"mutations.codon_end": {"gte": codon_start}}})
+        if codon_end is not None:
+            range_filter.append({"range": {"mutations.codon_num": {"lte": codon_end}}})
+        if pos_start is not None or pos_end is not None:
+            pos_range = {}
+            if pos_start is not None:
+                pos_range["gte"] = pos_start
+            if pos_end is not None:
+                pos_range["lte"] = pos_end
+            range_filter.append({"range": {"mutations.pos": pos_range}})
+        query_obj = {
+            "bool": {
+                "must": []
+            }
+        }
+        parse_location_id_to_query(query_location, query_obj)
+        if query_pangolin_lineage is not None:
+            query_obj["bool"]["must"].append({
+                "term": {
+                    "pangolin_lineage": query_pangolin_lineage
+                }
+            })
+        query = {
+            "size": 0,
+            "track_total_hits": True,
+            "query": query_obj,
+            "aggs": {
+                "mutations": {
+                    "nested": {
+                        "path": "mutations"
+                    },
+                    "aggs": {
+                        "in_range": {
+                            "filter": {
+                                "bool": {
+                                    "filter": range_filter
+                                }
+                            },
+                            "aggs": {
+                                "by_name": {
+                                    "terms": {
+                                        "field": "mutations.mutation",
+                                        "size": 10000
+                                    },
+                                    "aggs": {
+                                        "by_nested": {
+                                            "top_hits": {"size": 1}
+                                        }
+                                    }
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        }
+        resp = yield self.asynchronous_fetch(query)
+        total_count = resp["hits"]["total"]["value"] if isinstance(resp["hits"]["total"], dict) else resp["hits"]["total"]
+        path_to_results = ["aggregations", "mutations", "in_range", "by_name", "buckets"]
+        buckets = resp
+        for i in path_to_results:
+            buckets = buckets[i]
+        flattened_response = []
+        for i in buckets:
+            tmp = i["by_nested"]["hits"]["hits"][0]["_source"]
+            flattened_response.append({
+                "mutation": i["key"],
+                "gene": tmp.get("gene"),
+                "ref_aa": tmp.get("ref_aa"),
+                "alt_aa": tmp.get("alt_aa"),
+                "codon_num": tmp.get("codon_num"),
+                "codon_end": tmp.get("codon_end"),
+                "pos": tmp.get("pos"),
+                "type": tmp.get("type"),
+                "mutation_count": i["doc_count"],
+                "total_count": total_count,
+                "prevalence": i["doc_count"] / total_count if total_count > 0 else 0
+            })
+        flattened_response.sort(key = lambda x: (x["codon_num"] if x["codon_num"] is not None else -1, x["mutation"]))
+        resp = {"success": True, "results": flattened_response}
+        self.write(resp)
+
 class SubmissionLagHandler(BaseHandler):
 
     @gen.coroutine
@@ -886,8 +1007,8 @@ class SubmissionLagHandler(BaseHandler):
                     "composite": {
                         "size": 10000,
                         "sources": [
-                            {"date_collected": { "terms": {"field": "date_collected"}}},
-                            {"date_submitted": { "terms": {"field": "date_submitted"} }}
+                            {"date_collected": { "date_histogram": {"field": "date_collected_dt", "calendar_interval": "day", "format": "yyyy-MM-dd"}}},
+                            {"date_submitted": { "date_histogram": {"field": "date_submitted_dt", "calendar_interval": "day", "format": "yyyy-MM-dd"}}}
                         ]
                     }
                 }
@@ -895,42 +1016,31 @@ class SubmissionLagHandler(BaseHandler):
         }
         if query_location is not None:
             query["query"] = parse_location_id_to_query(query_location)
-        resp = yield self.asynchronous_fetch(query)
-        path_to_results = ["aggregations", "date_collected_submitted_buckets", "buckets"]
-        buckets = resp
-        for i in path_to_results:
-            buckets = buckets[i]
-        while "after_key" in resp["aggregations"]["date_collected_submitted_buckets"]:
-            query["aggs"]["date_collected_submitted_buckets"]["composite"]["after"] = resp["aggregations"]["date_collected_submitted_buckets"]["after_key"]
-            resp = yield self.asynchronous_fetch(query)
-            buckets.extend(resp["aggregations"]["date_collected_submitted_buckets"]["buckets"])
-        flattened_response = [{
+        partitions = create_date_partitions("date_collected_dt", self.composite_partitions)
+        if self.is_streaming():
+            yield self.stream_records(query, partitions)
+            return
+        resp = yield self.asynchronous_fetch_composite(query, "date_collected_submitted_buckets", partitions = partitions)
+        flattened_response = self.flatten_buckets(resp["buckets"])
+        resp = {"success": True, "results": flattened_response}
+        self.write(resp)
+
+    def flatten_buckets(self, buckets):
+        return [{
             "date_collected": i["key"]["date_collected"],
             "date_submitted": i["key"]["date_submitted"],
             "total_count": i["doc_count"]
         } for i in buckets]
-        resp = {"success": True, "results": flattened_response}
-        self.write(resp)
+
+    async def stream_records(self, query, partitions):
+        async for buckets in self.iter_composite_pages(query, "date_collected_submitted_buckets", partitions = partitions):
+            await self.write_ndjson(self.flatten_buckets(buckets))
 
 class MetadataHandler(BaseHandler):
     @gen.coroutine
     def get(self):
-        query = {
-        "size": 1,
-        "query": {
-          "function_score": {
-             "functions": [
-                {
-                   "random_score": {
-                      "seed": "1477072619038"
-                   }
-                }
-              ]
-           }
-         }
-        }
-        resp = yield self.asynchronous_fetch(query)
-        res = {"lastUpdated" :resp['hits']['hits'][0]["_source"]["@timestamp"]}
+        last_updated = yield self.get_data_version()
+        res = {"lastUpdated": last_updated}
         
         #mapping = yield self.get_mapping()
         #mapping = mapping["hcov19"]["mappings"]
@@ -941,3 +1051,103 @@ class MetadataHandler(BaseHandler):
         #else:
         #    res = mapping
         self.write(res)
+
+class StatsHandler(BaseHandler):
+    cache_max_age = None
+
+    @gen.coroutine
+    def get(self):
+        resp = {"success": True, "results": {
+            "cache": self.cache.stats(),
+            "worker": self.worker_stats(),
+            "es_pool": self.es_pool_stats.stats() if self.es_pool_stats is not None else None
+        }}
+        self.write(resp)
+
+class MetricsHandler(BaseHandler):
+    cache_max_age = None
+
+    @gen.coroutine
+    def get(self):
+        # Histograms of this worker only, every worker started with --workers keeps its own
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(self.metrics.render({"worker": str(self.worker_id)}))
+
+class SubRequestConnection:
+    # Handlers run inside a batch never touch the connection, RequestHandler only registers a close callback on it.
+    def set_close_callback(self, callback):
+        pass
+
+class BatchHandler(BaseHandler):
+    """
+    Run several GET routes in one request, sending their searches together as msearch.
+
+    The body is {"requests": [{"route": "/hcov19/sequence-count", "params": {...}}, ...]}.
+    Every sub-request runs the handler of its route with its own post-processing,
+    results come back in request order with the handler's response or error and
+    its time in ms.
+    """
+
+    max_requests = 50
+
+    @gen.coroutine
+    def post(self):
+        try:
+            body = json.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason="Request body must be JSON")
+        sub_requests = body.get("requests") if isinstance(body, dict) else body
+        if not isinstance(sub_requests, list) or len(sub_requests) == 0:
+            raise tornado.web.HTTPError(400, reason="requests must be a non-empty list")
+        if len(sub_requests) > self.max_requests:
+            raise tornado.web.HTTPError(400, reason="At most {} requests per batch".format(self.max_requests))
+        yield self.get_data_version() # Checked once here instead of in every sub-request
+        batch = MsearchBatcher(self.es)
+        start = time.monotonic()
+        results = yield [self.run_sub_request(batch, i) for i in sub_requests]
+        self.write({
+            "success": True,
+            "results": results,
+            "took_ms": (time.monotonic() - start) * 1000,
+            "msearch": batch.stats()
+        })
+
+    def create_sub_handler(self, route, params, batch):
+        request = tornado.httputil.HTTPServerRequest(method="GET", uri=route + "?" + urlencode(params, doseq=True), connection=SubRequestConnection())
+        for rule in self.application.wildcard_router.rules:
+            if rule.matcher.match(request) is not None:
+                handler_class = rule.target
+                if not isinstance(handler_class, type) or not issubclass(handler_class, BaseHandler) or issubclass(handler_class, BatchHandler):
+                    break
+                handler = handler_class(self.application, request, **rule.target_kwargs)
+                handler.batch = batch
+                handler.batch_output = []
+                return handler
+        raise tornado.web.HTTPError(404, reason="Unknown route {}".format(route))
+
+    async def run_sub_request(self, batch, sub_request):
+        start = time.monotonic()
+        route = sub_request.get("route") if isinstance(sub_request, dict) else None
+        params = sub_request.get("params", {}) if isinstance(sub_request, dict) else {}
+        result = {"route": route, "params": params}
+        handler = None
+        try:
+            if not isinstance(route, str) or not isinstance(params, dict):
+                raise tornado.web.HTTPError(400, reason="Each request needs a route and a params object")
+            handler = self.create_sub_handler(route, params, batch)
+            await handler.get()
+            result["success"] = True
+            result["response"] = handler.batch_output[0] if len(handler.batch_output) == 1 else handler.batch_output
+        except tornado.web.HTTPError as e:
+            result["success"] = False
+            result["status"] = e.status_code
+            result["error"] = e.reason or e.log_message or tornado.httputil.responses.get(e.status_code, "Unknown")
+        except Exception as e:
+            app_log.exception("Batch request to %s failed", route)
+            result["success"] = False
+            result["status"] = 500
+            result["error"] = "{}: {}".format(type(e).__name__, e)
+        result["took_ms"] = (time.monotonic() - start) * 1000
+        if handler is not None:
+            handler.record_metrics(time.monotonic() - start)
+        return result
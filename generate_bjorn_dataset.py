@@ -0,0 +1,276 @@
+"""
+Write a synthetic bjorn-style JSONL file that generate_actions can ingest.
+
+Lineages form a tree that emerges over time. Each lineage circulates in a
+wave after its emergence date and carries the defining mutations of its
+ancestors plus a few of its own. Sequences also get some private mutations.
+Countries, divisions and locations follow heavy-tailed weights, so the
+distributions look like the real ones. Collection dates follow the lineage
+waves, and submission dates lag behind them.
+
+Records are generated in blocks with a seed derived from the block index,
+on a pool of worker processes. The output is the same whatever the number
+of workers, and memory stays bounded for 50M records.
+"""
+import sys
+import json
+import time
+import argparse
+import datetime
+import numpy as np
+from multiprocessing import Pool
+
+# (gene, first nucleotide, length in codons)
+genes = [
+    ("ORF1a", 266, 4405),
+    ("ORF1b", 13468, 2695),
+    ("S", 21563, 1273),
+    ("ORF3a", 25393, 275),
+    ("E", 26245, 75),
+    ("M", 26523, 222),
+    ("ORF6", 27202, 61),
+    ("ORF7a", 27394, 121),
+    ("ORF7b", 27756, 43),
+    ("ORF8", 27894, 121),
+    ("N", 28274, 419),
+    ("ORF10", 29558, 38)
+]
+
+amino_acids = "ACDEFGHIKLMNPQRSTVWY"
+bases = "ACGT"
+
+# Named lineages and the day they emerge, the rest of the tree is generated below them
+root_lineages = [
+    ("B.1", "2020-02-15", "20A"),
+    ("B.1.1", "2020-03-01", "20B"),
+    ("B.1.1.7", "2020-10-01", "20I"),
+    ("B.1.351", "2020-10-15", "20H"),
+    ("P.1", "2020-12-01", "20J"),
+    ("B.1.427", "2020-09-01", "20C"),
+    ("B.1.526", "2020-12-15", "21F"),
+    ("B.1.617.2", "2021-04-01", "21A"),
+    ("AY.4", "2021-05-15", "21J"),
+    ("AY.103", "2021-07-01", "21J"),
+    ("BA.1", "2021-11-15", "21K"),
+    ("BA.2", "2022-01-01", "21L"),
+    ("BA.4", "2022-03-15", "22A"),
+    ("BA.5", "2022-04-01", "22B"),
+    ("BQ.1", "2022-09-01", "22E"),
+    ("XBB", "2022-09-15", "22F"),
+    ("XBB.1.5", "2022-11-01", "23A")
+]
+
+# (country, iso3, weight, [(division, division id, weight), ...])
+countries = [
+    ("United States", "USA", 40, [("California", "CA", 12), ("Texas", "TX", 6), ("New York", "NY", 6), ("Florida", "FL", 5), ("Washington", "WA", 4), ("Massachusetts", "MA", 3), ("Illinois", "IL", 3), ("Minnesota", "MN", 2), ("Colorado", "CO", 2), ("Michigan", "MI", 2)]),
+    ("United Kingdom", "GBR", 25, [("England", "ENG", 20), ("Scotland", "SCT", 3), ("Wales", "WLS", 2), ("Northern Ireland", "NIR", 1)]),
+    ("Germany", "DEU", 6, [("Bavaria", "BY", 3), ("North Rhine-Westphalia", "NW", 3), ("Berlin", "BE", 1), ("Hamburg", "HH", 1)]),
+    ("Denmark", "DNK", 5, [("Hovedstaden", "84", 3), ("Midtjylland", "82", 2), ("Syddanmark", "83", 1)]),
+    ("Canada", "CAN", 4, [("Ontario", "ON", 3), ("Quebec", "QC", 2), ("British Columbia", "BC", 2), ("Alberta", "AB", 1)]),
+    ("Japan", "JPN", 3, [("Tokyo", "13", 3), ("Osaka", "27", 2), ("Kanagawa", "14", 1)]),
+    ("France", "FRA", 3, [("Ile-de-France", "IDF", 3), ("Auvergne-Rhone-Alpes", "ARA", 2), ("Occitanie", "OCC", 1)]),
+    ("India", "IND", 2, [("Maharashtra", "MH", 3), ("Delhi", "DL", 2), ("Karnataka", "KA", 2)]),
+    ("Brazil", "BRA", 2, [("Sao Paulo", "SP", 3), ("Rio de Janeiro", "RJ", 2), ("Amazonas", "AM", 1)]),
+    ("South Africa", "ZAF", 1, [("Gauteng", "GT", 3), ("Western Cape", "WC", 2), ("KwaZulu-Natal", "NL", 2)]),
+    ("Australia", "AUS", 1, [("New South Wales", "NSW", 3), ("Victoria", "VIC", 3), ("Queensland", "QLD", 1)])
+]
+
+labs = ["Public Health Laboratory", "University Hospital Virology", "Sanger Institute", "Centers for Disease Control", "State Laboratory", "Regional Sequencing Centre", "Andersen Lab", "Clinical Genomics Core"]
+
+def weighted(weights):
+    weights = np.asarray(weights, dtype = float)
+    return weights / weights.sum()
+
+def zipf_weights(n, exponent = 1.1):
+    return weighted(1 / np.arange(1, n + 1) ** exponent)
+
+def random_mutation(rng, gene_index):
+    """Mutation record of genes[gene_index] in the format of the bjorn output, with its key."""
+    gene, start, length = genes[gene_index]
+    codon = int(rng.integers(1, length + 1))
+    pos = start + (codon - 1) * 3
+    kind = rng.random()
+    if kind < 0.08:
+        end = min(codon + int(rng.integers(0, 3)), length)
+        return {
+            "mutation": "%s:del%d/%d" %(gene.lower(), codon, end),
+            "type": "deletion",
+            "gene": gene,
+            "ref_codon": "None",
+            "pos": "%.1f" %pos,
+            "is_synonymous": "None",
+            "codon_num": "%.1f" %codon,
+            "change_length_nt": "%.1f" %((end - codon + 1) * 3)
+        }
+    if kind < 0.1:
+        inserted = "".join(rng.choice(list(amino_acids), 3)).lower()
+        return {
+            "mutation": "%s:ins%d%s" %(gene.lower(), codon, inserted),
+            "type": "insertion",
+            "gene": gene,
+            "ref_codon": "None",
+            "pos": "%.1f" %pos,
+            "is_synonymous": "None",
+            "codon_num": "%.1f" %codon,
+            "change_length_nt": "9.0"
+        }
+    ref_aa = str(rng.choice(list(amino_acids)))
+    synonymous = kind > 0.95
+    alt_aa = ref_aa if synonymous else str(rng.choice([i for i in amino_acids if i != ref_aa]))
+    ref_codon = "".join(rng.choice(list(bases), 3))
+    return {
+        "mutation": "%s:%s%d%s" %(gene.lower(), ref_aa.lower(), codon, alt_aa.lower()),
+        "type": "substitution",
+        "gene": gene,
+        "ref_codon": ref_codon,
+        "pos": pos,
+        "alt_codon": ref_codon[:2] + str(rng.choice([i for i in bases if i != ref_codon[2]])),
+        "is_synonymous": synonymous,
+        "ref_aa": ref_aa,
+        "codon_num": codon,
+        "alt_aa": alt_aa,
+        "change_length_nt": "None"
+    }
+
+class DatasetModel:
+    """
+    Lineage tree, mutation pool and location weights shared by all blocks.
+
+    Built from a single seed, so every worker process rebuilds the same model.
+    """
+
+    def __init__(self, seed = 0, num_lineages = 1500, num_mutations = 20000, locations_per_division = 30, start = "2020-01-01", end = "2023-06-30"):
+        rng = np.random.default_rng(seed)
+        self.start = datetime.date.fromisoformat(start)
+        self.num_days = (datetime.date.fromisoformat(end) - self.start).days + 1
+        # Genes are hit in proportion to their length
+        self.mutations = [random_mutation(rng, i) for i in rng.choice(len(genes), num_mutations, p = weighted([i[2] for i in genes]))]
+        # Serialized once, records splice them in
+        self.mutation_json = [json.dumps(i) for i in self.mutations]
+        self.private_mutation_cdf = np.cumsum(zipf_weights(num_mutations, 0.8))
+
+        names = []
+        emergence = []
+        clades = []
+        defining = []
+        children = {}
+        root_depth = []
+        for name, date, clade in root_lineages:
+            names.append(name)
+            root_depth.append(name.count("."))
+            emergence.append((datetime.date.fromisoformat(date) - self.start).days)
+            clades.append(clade)
+            defining.append(sorted(set(rng.choice(num_mutations, int(rng.integers(8, 30)), replace = False).tolist())))
+        while len(names) < num_lineages:
+            # Popular lineages get more sublineages, names stop at four levels below the named ones like pango aliases
+            parent = int(rng.choice(len(names), p = zipf_weights(len(names), 0.7)))
+            if names[parent].count(".") >= root_depth[parent] + 4:
+                continue
+            children[parent] = children.get(parent, 0) + 1
+            names.append("%s.%d" %(names[parent], children[parent]))
+            root_depth.append(root_depth[parent])
+            emergence.append(min(emergence[parent] + int(rng.exponential(60)), self.num_days - 1))
+            clades.append(clades[parent])
+            defining.append(sorted(set(defining[parent]) | set(rng.choice(num_mutations, int(rng.integers(1, 4)), replace = False).tolist())))
+        self.lineages = names
+        self.lineage_clades = clades
+        self.lineage_emergence = np.array(emergence)
+        self.lineage_width = rng.uniform(20, 120, len(names))
+        self.lineage_weights = weighted(rng.permutation(zipf_weights(len(names), 0.9)))
+        self.lineage_mutations = defining
+
+        self.country_weights = weighted([i[2] for i in countries])
+        self.division_cdfs = [np.cumsum(weighted([j[2] for j in i[3]])) for i in countries]
+        self.location_weights = zipf_weights(locations_per_division, 1.0)
+        self.locations_per_division = locations_per_division
+
+    def generate_block(self, block, first_record, num_records, seed):
+        """JSONL lines of records first_record to first_record + num_records."""
+        rng = np.random.default_rng([seed, block])
+        lineage = rng.choice(len(self.lineages), num_records, p = self.lineage_weights)
+        collected = self.lineage_emergence[lineage] + np.abs(rng.normal(0, self.lineage_width[lineage]))
+        collected = np.clip(collected, 0, self.num_days - 1).astype(int)
+        submitted = np.minimum(collected + np.round(rng.lognormal(3, 0.7, num_records)).astype(int), self.num_days + 60)
+        modified = submitted + np.where(rng.random(num_records) < 0.1, rng.integers(1, 60, num_records), 0)
+        partial_date = rng.random(num_records) < 0.01
+        country = rng.choice(len(countries), num_records, p = self.country_weights)
+        location = rng.choice(self.locations_per_division, num_records, p = self.location_weights)
+        division_draw = rng.random(num_records)
+        num_private = rng.poisson(2, num_records)
+        private = np.minimum(np.searchsorted(self.private_mutation_cdf, rng.random(num_private.sum()), side = "right"), len(self.mutations) - 1)
+        private_offsets = np.concatenate([[0], np.cumsum(num_private)])
+        lines = []
+        for i in range(num_records):
+            country_name, country_id, _, divisions = countries[country[i]]
+            division_cdf = self.division_cdfs[country[i]]
+            division, division_code, _ = divisions[min(int(np.searchsorted(division_cdf, division_draw[i], side = "right")), len(divisions) - 1)]
+            location_name = "%s County %d" %(division, location[i] + 1)
+            collected_date = self.start + datetime.timedelta(days = int(collected[i]))
+            date_collected = collected_date.strftime("%Y-%m-XX") if partial_date[i] else collected_date.isoformat()
+            # Most defining mutations are called, a few drop out for low coverage
+            defining = self.lineage_mutations[lineage[i]]
+            mutations = [j for j, keep in zip(defining, rng.random(len(defining)) > 0.03) if keep]
+            mutations = sorted(set(mutations) | set(private[private_offsets[i]:private_offsets[i + 1]].tolist()))
+            record_id = first_record + i
+            row = {
+                "strain": "%s/%s-%d/%d" %(country_name.replace(" ", ""), division_code, record_id, collected_date.year),
+                "country": country_name,
+                "originating_lab": labs[record_id % len(labs)],
+                "authors": "%s et al" %labs[(record_id // 7) % len(labs)].split(" ")[0],
+                "country_id": country_id,
+                "country_lower": country_name.lower(),
+                "division": division,
+                "division_id": division_code,
+                "division_lower": division.lower(),
+                "location": location_name,
+                "location_id": "%s%03d" %(division_code, location[i] + 1),
+                "location_lower": location_name.lower(),
+                "accession_id": "EPI_ISL_%d" %(402124 + record_id),
+                "pangolin_lineage": self.lineages[lineage[i]],
+                "pango_version": "PLEARN-v1.2.133",
+                "clade": self.lineage_clades[lineage[i]],
+                "date_collected": date_collected,
+                "date_submitted": (self.start + datetime.timedelta(days = int(submitted[i]))).isoformat(),
+                "date_modified": (self.start + datetime.timedelta(days = int(modified[i]))).isoformat(),
+                "zipcode": str(90001 + int(location[i]) * 37) if division_code == "CA" and country_id == "USA" else "None"
+            }
+            line = json.dumps(row)
+            lines.append(line[:-1] + ', "mutations": [' + ", ".join(self.mutation_json[j] for j in mutations) + "]}\n")
+        return "".join(lines)
+
+model = None
+
+def init_worker(model_args):
+    global model
+    model = DatasetModel(**model_args)
+
+def generate_block(args):
+    return model.generate_block(*args)
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic bjorn-style JSONL dataset.')
+    parser.add_argument('-o', '--output', help='Output file, - for stdout.', required=True)
+    parser.add_argument('-n', '--records', type=int, default=10000, help='Number of records.')
+    parser.add_argument('--lineages', type=int, default=1500, help='Number of lineages.')
+    parser.add_argument('--mutations', type=int, default=20000, help='Number of distinct mutations.')
+    parser.add_argument('--block-size', type=int, default=20000, help='Records per block.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes generating blocks.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    model_args = {"seed": args.seed, "num_lineages": args.lineages, "num_mutations": args.mutations}
+    blocks = [(i, first, min(args.block_size, args.records - first), args.seed) for i, first in enumerate(range(0, args.records, args.block_size))]
+    start = time.perf_counter()
+    output = sys.stdout if args.output == "-" else open(args.output, "w")
+    try:
+        with Pool(args.workers, initializer = init_worker, initargs = (model_args,)) as pool:
+            # imap keeps the file in block order
+            for c, block in enumerate(pool.imap(generate_block, blocks)):
+                output.write(block)
+                print("%s/%s blocks, %.0f records/s" %(c + 1, len(blocks), min((c + 1) * args.block_size, args.records) / (time.perf_counter() - start)), file = sys.stderr)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+if __name__ == "__main__":
+    main()
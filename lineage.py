@@ -1,9 +1,8 @@
 from base import BaseHandler
 from tornado import gen
 import pandas as pd
-from util import create_nested_mutation_query, calculate_proportion, parse_location_id_to_query, create_lineage_concat_query
+from util import create_nested_mutation_query, calculate_proportion, parse_location_id_to_query, create_lineage_concat_query, create_filters_agg, split_filters_buckets, parse_mutation, merge_lineage_mutation_profiles, format_lineage_mutations
 
-import re
 
 class LineageByCountryHandler(BaseHandler):
 
@@ -189,21 +188,6 @@ class LineageHandler(BaseHandler):
 
 class LineageMutationsHandler(BaseHandler):
 
-    gene_mapping = {
-        "orf1a" : "ORF1a",
-        "orf1b" : "ORF1b",
-        "s" : "S",
-        "orf3a" : "ORF3a",
-        "e": "E",
-        "m" : "M",
-        "orf6": "ORF6",
-        "orf7a" : "ORF7a",
-        "orf7b" : "ORF7b",
-        "orf8" : "ORF8",
-        "n" : "N",
-        "orf10" : "ORF10"
-    }
-
     @gen.coroutine
     def get(self):
         pangolin_lineage = self.get_argument("pangolin_lineage", None)
@@ -211,11 +195,37 @@ class LineageMutationsHandler(BaseHandler):
         frequency = float(frequency) if frequency != None else 0.8
         dict_response = {}
         # Query structure: Lineage 1 OR Lineage 2 OR Lineage 3 AND Mutation 1 AND Mutation 2, Lineage 4 AND Mutation 2, Lineage 5 ....
+        queries = []
         for query_lineage in pangolin_lineage.split(","):
+            query_lineage_split = query_lineage.split(" AND ")
+            query_pangolin_lineage = query_lineage_split[0].split(" OR ") # First parameter always lineages separated by commas
+            query_mutations = query_lineage_split[1:] # First parameter is always lineage
+            queries.append((query_lineage, query_pangolin_lineage, query_mutations))
+        # Lineages without mutations are answered from the per-lineage profiles built at ingest
+        profile_lineages = list({i.lower() for query_lineage, query_pangolin_lineage, query_mutations in queries if len(query_mutations) == 0 for i in query_pangolin_lineage})
+        profiles = {}
+        if len(profile_lineages) > 0:
+            resp = yield self.asynchronous_fetch_lineage_mutations({
+                "size": len(profile_lineages),
+                "query": {
+                    "terms": {
+                        "pangolin_lineage": profile_lineages
+                    }
+                }
+            })
+            profiles = {i["_source"]["pangolin_lineage"].lower(): i["_source"] for i in resp["hits"]["hits"]}
+        for query_lineage, query_pangolin_lineage, query_mutations in queries:
+            if len(query_mutations) == 0:
+                lineage_profiles = [profiles[i.lower()] for i in query_pangolin_lineage if i.lower() in profiles]
+                if len(lineage_profiles) > 0:
+                    lineage_count, mutations = merge_lineage_mutation_profiles(lineage_profiles)
+                    dict_response[query_lineage] = format_lineage_mutations(query_lineage, lineage_count, mutations, frequency)
+                continue
+            # Co-occurring mutations are not in the profiles, so these still go to hcov19
             query = {
                 "size": 0,
-                "query": {
-                },
+                "track_total_hits": True,
+                "query": create_nested_mutation_query(lineages = query_pangolin_lineage, mutations = query_mutations),
                 "aggs": {
                     "mutations": {
                         "nested": {
@@ -232,40 +242,20 @@ class LineageMutationsHandler(BaseHandler):
                     }
                 }
             }
-            query_lineage_split = query_lineage.split(" AND ")
-            query_mutations = []
-            query_pangolin_lineage = query_lineage_split[0].split(" OR ") # First parameter always lineages separated by commas
-            if len(query_lineage_split) > 1:
-                query_mutations = query_lineage_split[1:] # First parameter is always lineage
-            query["query"] = create_nested_mutation_query(lineages = query_pangolin_lineage, mutations = query_mutations)
             resp = yield self.asynchronous_fetch(query)
             path_to_results = ["aggregations", "mutations", "mutations", "buckets"]
             buckets = resp
             for i in path_to_results:
                 buckets = buckets[i]
-            flattened_response = [{
-                "mutation": i["key"],
-                "mutation_count": i["doc_count"],
-                "lineage_count": resp["hits"]["total"]["value"] if isinstance(resp["hits"]["total"], dict) else resp["hits"]["total"], # To account for difference in ES versions 7.12.0 vs 6.8.13
-                "lineage": query_lineage
-            } for i in buckets]
-            if len(flattened_response) > 0:
-                df_response = (
-                    pd.DataFrame(flattened_response)
-                    .assign(
-                        gene = lambda x: x["mutation"].apply(lambda k: self.gene_mapping[k.split(":")[0]] if k.split(":")[0] in self.gene_mapping else k.split(":")[0]),
-                        ref_aa = lambda x: x["mutation"].apply(lambda k: re.findall("[A-Za-z*]+", k.split(":")[1])[0] if "DEL" not in k and "del" not in k and "_" not in k else k).str.upper(),
-                        alt_aa = lambda x: x["mutation"].apply(lambda k: re.findall("[A-Za-z*]+", k.split(":")[1])[1] if "DEL" not in k and "del" not in k and "_" not in k else k.split(":")[1]).str.upper(),
-                        codon_num = lambda x: x["mutation"].apply(lambda k: int(re.findall("[0-9]+", k.split(":")[1])[0])),
-                        codon_end = lambda x: x["mutation"].apply(lambda k: int(re.findall("[0-9]+", k.split(":")[1])[1]) if "/" in k and ("DEL" in k or "del" in k) else None),
-                        type = lambda x: x["mutation"].apply(lambda k: "deletion" if "DEL" in k or "del" in k else "substitution")
-                    )
-                )
-                df_response = df_response[df_response["ref_aa"] != df_response["alt_aa"]]
-                df_response.loc[:, "prevalence"] = df_response["mutation_count"]/df_response["lineage_count"]
-                df_response.loc[~df_response["codon_end"].isna(), "change_length_nt"] = ((df_response["codon_end"] - df_response["codon_num"]) + 1) * 3
-                df_response = df_response[df_response["prevalence"] >= frequency].fillna("None")
-                dict_response[query_lineage] = df_response.to_dict(orient="records")
+            if len(buckets) == 0:
+                continue
+            lineage_count = resp["hits"]["total"]["value"] if isinstance(resp["hits"]["total"], dict) else resp["hits"]["total"] # To account for difference in ES versions 7.12.0 vs 6.8.13
+            mutations = []
+            for i in buckets:
+                parsed = parse_mutation(i["key"])
+                if parsed is not None:
+                    mutations.append(dict(mutation = i["key"], mutation_count = i["doc_count"], **parsed))
+            dict_response[query_lineage] = format_lineage_mutations(query_lineage, lineage_count, mutations, frequency)
         resp = {"success": True, "results": dict_response}
         self.write(resp)
 
@@ -316,8 +306,8 @@ class MutationDetailsHandler(BaseHandler):
             for j in i["by_nested"]["hits"]["hits"]:
                 tmp = j["_source"]
                 for k in ["change_length_nt", "codon_num", "pos"]:
-                    if tmp[k] != "None":
-                        tmp[k] = int(float(tmp[k]))
+                    if tmp.get(k) is None:
+                        tmp[k] = "None"
                 flattened_response.append(tmp)
         resp = {"success": True, "results": flattened_response}
         self.write(resp)
@@ -332,43 +322,45 @@ class MutationsByLineage(BaseHandler):
         query_frequency_threshold = self.get_argument("frequency", None)
         query_frequency_threshold = float(query_frequency_threshold) if query_frequency_threshold is not None else 0
         results = {}
-        for muts in query_mutations: # For multiple sets of mutations, create multiple ES queries. Since AND queries are possible doing one ES query with aggregations is cumbersome. Must look for better solution here.
-            query = {
-                "size": 0,
-                "aggs": {
-	            "lineage": {
-                        "terms": {"field": "pangolin_lineage", "size": self.size},
-                        "aggs": {
-                            "mutations": {
-                                "filter": {}
-			    }
-                        }
+        if len(query_mutations) == 0:
+            self.write({"success": True, "results": results})
+            return
+        query = {
+            "size": 0,
+            "aggs": {
+                "lineage": {
+                    "terms": {"field": "pangolin_lineage", "size": self.size},
+                    "aggs": {
+                        "mutations": {}
                     }
                 }
             }
-            if query_location is not None:
-                query["query"] = parse_location_id_to_query(query_location)
-            if query_pangolin_lineage is not None:
-                if "query" in query: # Only query added will be bool for location
-                    query["query"]["bool"]["must"].append({
-                        "term": {
-                            "pangolin_lineage": query_pangolin_lineage
-                        }
-                    })
-                else:
-                    query["query"] = {
-                        "term": {
-                            "pangolin_lineage": query_pangolin_lineage
-                        }
+        }
+        if query_location is not None:
+            query["query"] = parse_location_id_to_query(query_location)
+        if query_pangolin_lineage is not None:
+            if "query" in query: # Only query added will be bool for location
+                query["query"]["bool"]["must"].append({
+                    "term": {
+                        "pangolin_lineage": query_pangolin_lineage
                     }
-            query["aggs"]["lineage"]["aggs"]["mutations"]["filter"] = create_nested_mutation_query(mutations = muts)
-            resp = yield self.asynchronous_fetch(query)
-            path_to_results = ["aggregations", "lineage", "buckets"]
-            buckets = resp
-            for i in path_to_results:
-                buckets = buckets[i]
+                })
+            else:
+                query["query"] = {
+                    "term": {
+                        "pangolin_lineage": query_pangolin_lineage
+                    }
+                }
+        # One named filter per set of mutations, counted within the same lineage buckets
+        query["aggs"]["lineage"]["aggs"]["mutations"] = create_filters_agg([create_nested_mutation_query(mutations = muts) for muts in query_mutations])
+        resp = yield self.asynchronous_fetch(query)
+        path_to_results = ["aggregations", "lineage", "buckets"]
+        buckets = resp
+        for i in path_to_results:
+            buckets = buckets[i]
+        for muts, mut_buckets in zip(query_mutations, split_filters_buckets(buckets, "mutations", len(query_mutations))):
             flattened_response = []
-            for i in buckets:
+            for i in mut_buckets:
                 if not i["mutations"]["doc_count"] > 0 or i["key"] == "none":
                     continue
                 flattened_response.append({
@@ -377,11 +369,13 @@ class MutationsByLineage(BaseHandler):
                     "mutation_count": i["mutations"]["doc_count"]
                 })
             df_response = pd.DataFrame(flattened_response)
-            if df_response.shape[0] > 0:
-                prop = calculate_proportion(df_response["mutation_count"], df_response["lineage_count"])
-                df_response.loc[:, "proportion"] = prop[0]
-                df_response.loc[:, "proportion_ci_lower"] = prop[1]
-                df_response.loc[:, "proportion_ci_upper"] = prop[2]
+            if df_response.shape[0] == 0:
+                results[",".join(muts)] = []
+                continue
+            prop = calculate_proportion(df_response["mutation_count"], df_response["lineage_count"])
+            df_response.loc[:, "proportion"] = prop[0]
+            df_response.loc[:, "proportion_ci_lower"] = prop[1]
+            df_response.loc[:, "proportion_ci_upper"] = prop[2]
             df_response = df_response[df_response["proportion"] >= query_frequency_threshold]
             results[",".join(muts)] = df_response.to_dict(orient="records")
         resp = {"success": True, "results": results}
@@ -1,8 +1,8 @@
-from util import transform_prevalence, transform_prevalence_by_location_and_tiime, compute_rolling_mean, create_nested_mutation_query, get_major_lineage_prevalence, compute_total_count, compute_rolling_mean_all_lineages, expand_dates, parse_location_id_to_query, create_iterator
+from util import calculate_proportion, transform_prevalence, transform_prevalence_by_location_and_tiime, compute_rolling_mean, create_nested_mutation_query, transform_prevalence_all_lineages, parse_location_id_to_query, create_iterator, create_filters_agg, split_filters_buckets, add_rollup_count_aggs, apply_rollup_counts, create_date_partitions, create_date_histogram_agg, set_date_keys, create_date_window_filter, add_query_filter, get_sub_name, merged_sub_names
 from base import BaseHandler
 from tornado import gen
+import numpy as np
 import pandas as pd
-from datetime import timedelta, datetime as dt
 
 # Get global prevalence of lineage by date
 class GlobalPrevalenceByTimeHandler(BaseHandler):
@@ -13,29 +13,32 @@ class GlobalPrevalenceByTimeHandler(BaseHandler):
         query_mutations = self.get_argument("mutations", None)
         cumulative = self.get_argument("cumulative", None)
         cumulative = True if cumulative == "true" else False
+        query_rollup = self.get_argument("rollup", None)
+        query_rollup = True if query_rollup == "true" else False
+        interval = self.get_date_interval()
         query = {
             "size": 0,
             "aggs": {
-                "prevalence": {
-                    "terms": {
-                        "field": "date_collected",
-                        "size": self.size
-                    },
-                    "aggs": {
-                        "lineage_count": {
-                            "filter": {}
-                        }
+                "prevalence": dict(create_date_histogram_agg(interval), aggs = {
+                    "lineage_count": {
+                        "filter": {}
                     }
-                }
+                })
             }
         }
         query_mutations = query_mutations.split(",") if query_mutations is not None else []
         query_pangolin_lineage = query_pangolin_lineage.split(",") if query_pangolin_lineage is not None else []
         query_obj = create_nested_mutation_query(lineages = query_pangolin_lineage, mutations = query_mutations)
         query["aggs"]["prevalence"]["aggs"]["lineage_count"]["filter"] = query_obj
-        resp = yield self.asynchronous_fetch(query)
+        if query_rollup and len(query_mutations) == 0: # Rollup has no mutations
+            add_rollup_count_aggs(query["aggs"]["prevalence"])
+            resp = yield self.asynchronous_fetch_rollup(query)
+            apply_rollup_counts(resp["aggregations"]["prevalence"]["buckets"])
+        else:
+            resp = yield self.asynchronous_fetch(query)
         path_to_results = ["aggregations", "prevalence", "buckets"]
-        resp = transform_prevalence(resp, path_to_results, cumulative)
+        set_date_keys(resp["aggregations"]["prevalence"]["buckets"])
+        resp = transform_prevalence(resp, path_to_results, cumulative, interval)
         self.write({
             "success": True,
             "results": resp
@@ -52,47 +55,59 @@ class PrevalenceByLocationAndTimeHandler(BaseHandler):
         query_mutations = query_mutations.split(" AND ") if query_mutations is not None else []
         cumulative = self.get_argument("cumulative", None)
         cumulative = True if cumulative == "true" else False
+        query_rollup = self.get_argument("rollup", None)
+        query_rollup = True if query_rollup == "true" else False
+        interval = self.get_date_interval()
         results = {}
-        for i,j in create_iterator(query_pangolin_lineage, query_mutations):
-            query = {
-                "size": 0,
-                "aggs": {
-                    "prevalence": {
-                        "filter": {
-                            "bool": {
-                                "must": []
-                            }
-                        },
-                        "aggs": {
-                            "count": {
-                                "terms": {
-                                    "field": "date_collected",
-                                    "size": self.size
-                                },
-                                "aggs": {
-                                    "lineage_count": {
-                                        "filter": {}
-                                    }
-                                }
-                            }
+        combinations = list(create_iterator(query_pangolin_lineage, query_mutations))
+        if len(combinations) == 0:
+            self.write({
+                "success": True,
+                "results": results
+            })
+            return
+        query = {
+            "size": 0,
+            "aggs": {
+                "prevalence": {
+                    "filter": {
+                        "bool": {
+                            "must": []
                         }
+                    },
+                    "aggs": {
+                        "count": dict(create_date_histogram_agg(interval), aggs = {
+                            "lineage_count": {}
+                        })
                     }
                 }
             }
-            parse_location_id_to_query(query_location, query["aggs"]["prevalence"]["filter"])
+        }
+        parse_location_id_to_query(query_location, query["aggs"]["prevalence"]["filter"])
+        # One named filter per lineage/mutation combination, all counted in the same date buckets
+        res_keys = []
+        query_objs = []
+        for i,j in combinations:
             lineages = i.split(" OR ") if i is not None else []
-            query_obj = create_nested_mutation_query(lineages = lineages, mutations = j, location_id = query_location)
-            print(query_obj)
-            query["aggs"]["prevalence"]["aggs"]["count"]["aggs"]["lineage_count"]["filter"] = query_obj
-            resp = yield self.asynchronous_fetch(query)
-            path_to_results = ["aggregations", "prevalence", "count", "buckets"]
-            resp = transform_prevalence(resp, path_to_results, cumulative)
+            query_objs.append(create_nested_mutation_query(lineages = lineages, mutations = j, location_id = query_location))
             res_key = None
             if len(query_pangolin_lineage) > 0:
                 res_key = " OR ".join(lineages)
             if len(query_mutations) > 0:
                 res_key = "({}) AND ({})".format(res_key, " AND ".join(query_mutations)) if res_key is not None else " AND ".join(query_mutations)
-            results[res_key] = resp
+            res_keys.append(res_key)
+        query["aggs"]["prevalence"]["aggs"]["count"]["aggs"]["lineage_count"] = create_filters_agg(query_objs)
+        use_rollup = query_rollup and len(query_mutations) == 0 # Rollup has no mutations
+        if use_rollup:
+            add_rollup_count_aggs(query["aggs"]["prevalence"]["aggs"]["count"])
+            resp = yield self.asynchronous_fetch_rollup(query)
+        else:
+            resp = yield self.asynchronous_fetch(query)
+        buckets = set_date_keys(resp["aggregations"]["prevalence"]["count"]["buckets"])
+        for res_key, key_buckets in zip(res_keys, split_filters_buckets(buckets, "lineage_count", len(query_objs))):
+            if use_rollup:
+                apply_rollup_counts(key_buckets)
+            results[res_key] = transform_prevalence(key_buckets, [], cumulative, interval)
         self.write({
             "success": True,
             "results": results
@@ -113,112 +128,178 @@ class CumulativePrevalenceByLocationHandler(BaseHandler):
         query_detected = True if query_detected == "true" else False
         query_ndays = self.get_argument("ndays", None)
         query_ndays = int(query_ndays) if query_ndays is not None else None
+        query_rollup = self.get_argument("rollup", None)
+        query_rollup = True if query_rollup == "true" else False
         results = {}
-        for query_lineage, query_mutation in create_iterator(query_pangolin_lineage, query_mutations):
-            query = {
-                "size": 0,
-                "aggs": {
-                    "sub_date_buckets": {
-                        "composite": {
-                            "size": 10000,
-                            "sources": [
-                                {"date_collected": { "terms": {"field": "date_collected"}}}
-                            ]
-                        },
-                        "aggregations": {
-                            "lineage_count": {
-                                "filter": {}
-                            }
-                        }
+        combinations = list(create_iterator(query_pangolin_lineage, query_mutations))
+        if len(combinations) == 0:
+            self.write({
+                "success": True,
+                "results": results
+            })
+            return
+        query = {
+            "size": 0,
+            "aggs": {
+                "sub_date_buckets": {
+                    "composite": {
+                        "size": 10000,
+                        "sources": [
+                            {"date_collected": { "date_histogram": {"field": "date_collected_dt", "calendar_interval": "day", "format": "yyyy-MM-dd"}}}
+                        ]
+                    },
+                    "aggregations": {
+                        "lineage_count": {}
                     }
                 }
             }
-            if query_location is not None: # Global
-                query["query"] = parse_location_id_to_query(query_location)
+        }
+        if query_location is not None: # Global
+            query["query"] = parse_location_id_to_query(query_location)
+        admin_level = 0
+        if query_location is None:
+            query["aggs"]["sub_date_buckets"]["composite"]["sources"].extend([
+                {"sub": { "terms": {"field": "country"} }},
+                {"sub_id": { "terms": {"field": "country_id"} }}
+            ])
             admin_level = 0
-            if query_location is None:
-                query["aggs"]["sub_date_buckets"]["composite"]["sources"].extend([
-                    {"sub": { "terms": {"field": "country"} }},
-                    {"sub_id": { "terms": {"field": "country_id"} }}
-                ])
-                admin_level = 0
-            elif len(query_location.split("_")) == 2:
-                query["aggs"]["sub_date_buckets"]["composite"]["sources"].extend([
-                    {"sub_id": { "terms": {"field": "location_id"} }},
-                    {"sub": { "terms": {"field": "location"} }}
-                ])
-                admin_level = 2
-            elif len(query_location.split("_")) == 1:
-                query["aggs"]["sub_date_buckets"]["composite"]["sources"].extend([
-                    {"sub_id": { "terms": {"field": "division_id"} }},
-                    {"sub": { "terms": {"field": "division"} }}
-                ])
-                admin_level = 1
-            
-            #include the location
-            elif len(query_location.split("_")) == 3:
-                query["aggs"]["sub_date_buckets"]["composite"]["sources"].extend([
-                    {"sub_id": { "terms": {"field": "zipcode"} }},
-                    {"sub": { "terms": {"field": "zipcode"}}},
-                ])
-                admin_level = "z"
- 
-            
+        elif len(query_location.split("_")) == 2:
+            query["aggs"]["sub_date_buckets"]["composite"]["sources"].extend([
+                {"sub_id": { "terms": {"field": "location_id"} }},
+                {"sub": { "terms": {"field": "location"} }}
+            ])
+            admin_level = 2
+        elif len(query_location.split("_")) == 1:
+            query["aggs"]["sub_date_buckets"]["composite"]["sources"].extend([
+                {"sub_id": { "terms": {"field": "division_id"} }},
+                {"sub": { "terms": {"field": "division"} }}
+            ])
+            admin_level = 1
+
+        #include the location
+        elif len(query_location.split("_")) == 3:
+            query["aggs"]["sub_date_buckets"]["composite"]["sources"].extend([
+                {"sub_id": { "terms": {"field": "zipcode"} }},
+                {"sub": { "terms": {"field": "zipcode"}}},
+            ])
+            admin_level = "z"
+
+        # One named filter per lineage/mutation combination, all counted in the same composite buckets
+        res_keys = []
+        query_objs = []
+        for query_lineage, query_mutation in combinations:
             query_lineages = query_lineage.split(" OR ") if query_lineage is not None else []
-            query_obj = create_nested_mutation_query(lineages = query_lineages, mutations = query_mutation)
-            query["aggs"]["sub_date_buckets"]["aggregations"]["lineage_count"]["filter"] = query_obj
-            print(query)
-            resp = yield self.asynchronous_fetch(query)
-            
-            ctr = 0
-            buckets = resp["aggregations"]["sub_date_buckets"]["buckets"]
-            # Get all paginated results
-            while "after_key" in resp["aggregations"]["sub_date_buckets"]:
-                query["aggs"]["sub_date_buckets"]["composite"]["after"] = resp["aggregations"]["sub_date_buckets"]["after_key"]
-                resp = yield self.asynchronous_fetch(query)
-                buckets.extend(resp["aggregations"]["sub_date_buckets"]["buckets"])
-            dict_response = {}
-            if len(buckets) > 0:
-                flattened_response = []
-                
-                for i in buckets:
-                    if len(i["key"]["date_collected"].split("-")) < 3 or "XX" in i["key"]["date_collected"]:
-                        continue
-                    # Check for None and out of state                   
-                    if i["key"]["sub"].lower().replace("-", "").replace(" ", "") == "outofstate":
-                        i["key"]["sub"] = "Out of state"
-                    if i["key"]["sub"].lower() in ["none", "unknown"]:
-                        i["key"]["sub"] = "Unknown"
-                    
-                    rec = {
-                        "date": i["key"]["date_collected"],
-                        "name": i["key"]["sub"],
-                        "id": i["key"]["sub_id"],
-                        "total_count": i["doc_count"],
-                        "lineage_count": i["lineage_count"]["doc_count"]
-                    }
-                    if admin_level == 1:
-                        rec["id"] = "_".join([query_location, self.country_iso3_to_iso2[query_location]+"-"+i["key"]["sub_id"] if query_location in self.country_iso3_to_iso2 else query_location + "-" + i["key"]["sub_id"]])
-                    elif admin_level == 2:
-                        rec["id"] = "_".join([query_location, i["key"]["sub_id"]])
-                    elif admin_level == "z":
-                        if i['key']['sub_id'] != "None":
-                           rec["id"] = i["key"]["sub_id"]
-                    
-                    flattened_response.append(rec)
-                dict_response = transform_prevalence_by_location_and_tiime(flattened_response, query_ndays, query_detected)
+            query_objs.append(create_nested_mutation_query(lineages = query_lineages, mutations = query_mutation))
             res_key = None
-            
             if query_lineage is not None: # create_iterator will never return empty list for lineages
                 res_key = " OR ".join(query_lineages)
             if len(query_mutations) > 0:
                 res_key = "({}) AND ({})".format(res_key, " AND ".join(query_mutations)) if res_key is not None else " AND ".join(query_mutations)
+            res_keys.append(res_key)
+        query["aggs"]["sub_date_buckets"]["aggregations"]["lineage_count"] = create_filters_agg(query_objs)
+        use_rollup = query_rollup and len(query_mutations) == 0 # Rollup has no mutations
+        fetch = self.asynchronous_fetch
+        if use_rollup:
+            add_rollup_count_aggs(query["aggs"]["sub_date_buckets"])
+            fetch = self.asynchronous_fetch_rollup
+        partitions = create_date_partitions("date_collected_dt", self.composite_partitions)
+        if query_ndays is not None and not query_detected: # Detected lineages are looked up over all dates
+            window_filter = create_date_window_filter(query_ndays)
+            add_query_filter(query, window_filter)
+            partitions = create_date_partitions("date_collected_dt", self.composite_partitions, start = window_filter["range"]["date_collected_dt"]["gt"])
+        if self.is_streaming():
+            yield self.stream_records(query, fetch, use_rollup, res_keys, query_location, admin_level, query_detected)
+            return
+        # Get all paginated results
+        resp = yield self.asynchronous_fetch_composite(query, "sub_date_buckets", fetch = fetch, partitions = partitions)
+        for res_key, buckets in zip(res_keys, split_filters_buckets(resp["buckets"], "lineage_count", len(query_objs))):
+            if use_rollup:
+                apply_rollup_counts(buckets)
+            dict_response = {}
+            if len(buckets) > 0:
+                flattened_response = [self.flatten_bucket(i, query_location, admin_level) for i in buckets]
+                dict_response = transform_prevalence_by_location_and_tiime(flattened_response, query_ndays, query_detected)
             results[res_key] = dict_response
         self.write({
             "success": True,
             "results": results
         })
 
+    def flatten_bucket(self, i, query_location, admin_level):
+        # Check for None and out of state
+        i["key"]["sub"] = get_sub_name(i["key"]["sub"])
+
+        rec = {
+            "date": i["key"]["date_collected"],
+            "name": i["key"]["sub"],
+            "id": i["key"]["sub_id"],
+            "total_count": i["doc_count"],
+            "lineage_count": i["lineage_count"]["doc_count"]
+        }
+        if admin_level == 1:
+            rec["id"] = "_".join([query_location, self.country_iso3_to_iso2[query_location]+"-"+i["key"]["sub_id"] if query_location in self.country_iso3_to_iso2 else query_location + "-" + i["key"]["sub_id"]])
+        elif admin_level == 2:
+            rec["id"] = "_".join([query_location, i["key"]["sub_id"]])
+        elif admin_level == "z":
+            if i['key']['sub_id'] != "None":
+               rec["id"] = i["key"]["sub_id"]
+        return rec
+
+    async def stream_records(self, query, fetch, use_rollup, res_keys, query_location, admin_level, query_detected):
+        """
+        Write one NDJSON line per lineage key and subregion name with its
+        counts on the last date and the cumulative counts, or with
+        detected=true one line per subregion the lineage was seen in.
+        Subregions are grouped by name as in the JSON response.
+
+        The subregion name source is moved first and the date source last,
+        so all dates of a name arrive together and it is written out as soon
+        as the next one starts. Names that several spellings are merged
+        into, such as Unknown, are kept until the last page.
+        """
+        sources = query["aggs"]["sub_date_buckets"]["composite"]["sources"]
+        sources.sort(key = lambda x: ["sub", "sub_id", "date_collected"].index(list(x)[0]))
+        state = [{} for i in res_keys]
+        detected = [set() for i in res_keys]
+
+        def close_subregions(j, keep = merged_sub_names):
+            names = [i for i in state[j] if i not in keep]
+            return [] if query_detected else [state[j].pop(i) for i in names]
+
+        async def write_records(records):
+            if len(records) > 0 and not query_detected:
+                d = calculate_proportion(np.array([i["cum_lineage_count"] for i in records]), np.array([i["cum_total_count"] for i in records]))
+                for i, proportion, ci_lower, ci_upper in zip(records, *d):
+                    i["proportion"], i["proportion_ci_lower"], i["proportion_ci_upper"] = proportion, ci_lower, ci_upper
+            await self.write_ndjson(records)
+
+        async for page in self.iter_composite_pages(query, "sub_date_buckets", fetch = fetch):
+            records = []
+            for j, buckets in enumerate(split_filters_buckets(page, "lineage_count", len(res_keys))):
+                if use_rollup:
+                    apply_rollup_counts(buckets)
+                for i in buckets:
+                    rec = dict(key = res_keys[j], **self.flatten_bucket(i, query_location, admin_level))
+                    if query_detected:
+                        if rec["lineage_count"] > 0 and rec["name"] not in detected[j]:
+                            detected[j].add(rec["name"])
+                            records.append({"key": res_keys[j], "name": rec["name"]})
+                        continue
+                    if rec["name"] not in state[j]:
+                        records.extend(close_subregions(j))
+                    previous = state[j].get(rec["name"])
+                    rec["cum_total_count"] = rec["total_count"] + (previous["cum_total_count"] if previous is not None else 0)
+                    rec["cum_lineage_count"] = rec["lineage_count"] + (previous["cum_lineage_count"] if previous is not None else 0)
+                    if previous is not None and previous["date"] > rec["date"]:
+                        # Merged names see the dates of each spelling in turn, the record of the last date is kept
+                        rec = dict(previous, cum_total_count = rec["cum_total_count"], cum_lineage_count = rec["cum_lineage_count"])
+                    state[j][rec["name"]] = rec
+            await write_records(records)
+        records = []
+        for j in range(len(res_keys)):
+            records.extend(close_subregions(j, keep = []))
+        await write_records(records)
+
 class PrevalenceAllLineagesByLocationHandler(BaseHandler):
 
     @gen.coroutine
@@ -236,69 +317,41 @@ class PrevalenceAllLineagesByLocationHandler(BaseHandler):
         query_other_exclude = query_other_exclude.split(",") if query_other_exclude is not None else []
         query_cumulative = self.get_argument("cumulative", None)
         query_cumulative = True if query_cumulative == "true" else False
+        interval = self.get_date_interval()
         query = {
             "size": 0,
             "query": {},
             "aggs": {
-                "count": {
-                    "terms": {
-                        "field": "date_collected",
-                        "size": self.size
-                    },
-                    "aggs": {
-                        "lineage_count": {
-                            "terms": {
-                                "field": "pangolin_lineage",
-                                "size": self.size
-                            }
+                "count": dict(create_date_histogram_agg(interval), aggs = {
+                    "lineage_count": {
+                        "terms": {
+                            "field": "pangolin_lineage",
+                            "size": self.size
                         }
                     }
-                }
+                })
             }
         }
         query["query"] = parse_location_id_to_query(query_location)
+        if query_window is not None: # ndays only decides which lineages are grouped into other, so all dates in the window are needed
+            add_query_filter(query, create_date_window_filter(query_window))
         resp = yield self.asynchronous_fetch(query)
         buckets = resp
         path_to_results = ["aggregations", "count", "buckets"]
         for i in path_to_results:
             buckets = buckets[i]
-        flattened_response = []
+        dates = []
+        total_counts = []
+        lineages = []
+        lineage_counts = []
         for i in buckets:
-            if len(i["key"].split("-")) == 1 or "XX" in i["key"]:
-                continue
             for j in i["lineage_count"]["buckets"]:
-                flattened_response.append({
-                    "date": i["key"],
-                    "total_count": i["doc_count"],
-                    "lineage_count": j["doc_count"],
-                    "lineage": j["key"]
-                })  
-        df_response = (
-            pd.DataFrame(flattened_response)
-            .assign(
-                date = lambda x: pd.to_datetime(x["date"], format="%Y-%m-%d"),
-                prevalence = lambda x: x["lineage_count"]/x["total_count"]
-            )
-            .sort_values("date")
-        )
-        if query_window is not None:
-            df_response = df_response[df_response["date"] >= (dt.now() - timedelta(days = query_window))]
-       
-        df_response = get_major_lineage_prevalence(df_response, "date", query_other_exclude, query_other_threshold, query_nday_threshold, query_ndays)
-        if not query_cumulative:
-            df_response = df_response.groupby("lineage").apply(compute_rolling_mean_all_lineages, "date", "lineage_count", "lineage_count_rolling", "lineage").reset_index()
-            df_response = df_response.groupby("date").apply(compute_total_count, "lineage_count_rolling", "total_count_rolling")
-            df_response.loc[:, "prevalence_rolling"] = df_response["lineage_count_rolling"]/df_response["total_count_rolling"]
-            df_response.loc[df_response["prevalence_rolling"].isna(), "prevalence_rolling"] = 0 # Prevalence is 0 if total_count_rolling == 0.
-            df_response.loc[:,"date"] = df_response["date"].apply(lambda x: x.strftime("%Y-%m-%d"))
-            df_response = df_response.fillna("None")
-            df_response = df_response[["date", "total_count", "lineage_count", "lineage", "prevalence", "prevalence_rolling"]]
-        else:
-            df_response = df_response.groupby("lineage").apply(expand_dates, df_response["date"].min(), df_response["date"].max(), "date", "lineage").reset_index()
-            df_response = df_response.groupby("date").apply(compute_total_count, "lineage_count", "total_count").reset_index()
-            df_response = df_response.groupby("lineage").agg({"total_count": "sum", "lineage_count": "sum"}).reset_index()
-            df_response.loc[:,"prevalence"] = df_response["lineage_count"]/df_response["total_count"]
-        resp = {"success": True, "results": df_response.to_dict(orient="records")}
+                dates.append(i["key_as_string"])
+                total_counts.append(i["doc_count"])
+                lineages.append(j["key"])
+                lineage_counts.append(j["doc_count"])
+        dict_response = transform_prevalence_all_lineages(dates, total_counts, lineages, lineage_counts, query_window, query_other_exclude, query_other_threshold, query_nday_threshold, query_ndays, query_cumulative, interval)
+        resp = {"success": True, "results": dict_response}
         self.write(resp)
 
 class PrevalenceByAAPositionHandler(BaseHandler):
@@ -312,6 +365,7 @@ class PrevalenceByAAPositionHandler(BaseHandler):
         # query_division = self.get_argument("division", None)
         query_gene = query_str.split(":")[0]
         query_aa_position = int(query_str.split(":")[1])
+        interval = self.get_date_interval()
         # Get ref codon
         query = {
             "size": 0,
@@ -325,8 +379,8 @@ class PrevalenceByAAPositionHandler(BaseHandler):
                             "filter": {
                                 "bool": {
                                     "must": [
-                                        {"match": {"mutations.codon_num": query_aa_position}},
-                                        {"match": {"mutations.gene": query_gene}}
+                                        {"term": {"mutations.codon_num": query_aa_position}},
+                                        {"term": {"mutations.gene": query_gene}}
                                     ]
                                 }
                             },
@@ -348,10 +402,7 @@ class PrevalenceByAAPositionHandler(BaseHandler):
             query = {
 	        "aggs": {
 	            "by_date": {
-		        "terms": {
-                            "field": "date_collected",
-                            "size": self.size
-                        },
+		        "date_histogram": create_date_histogram_agg(interval)["date_histogram"],
                         "aggs": {
                             "by_mutations": {
                                 "nested": {
@@ -362,8 +413,8 @@ class PrevalenceByAAPositionHandler(BaseHandler):
                                         "filter": {
                                             "bool": {
                                                 "must": [
-                                                    {"match": {"mutations.codon_num": query_aa_position}},
-                                                    {"match": {"mutations.gene": query_gene}}
+                                                    {"term": {"mutations.codon_num": query_aa_position}},
+                                                    {"term": {"mutations.gene": query_gene}}
                                                 ]
                                             }
                                         },
@@ -380,7 +431,7 @@ class PrevalenceByAAPositionHandler(BaseHandler):
 	        }
             }
             if query_location is not None:
-                query["query"] = parse_location_id_to_query(query_location, query["aggs"]["prevalence"]["filter"])
+                query["query"] = parse_location_id_to_query(query_location)
             if query_lineage is not None:
                 if "query" in query:
                     query["query"]["bool"]["must"].append({
@@ -399,6 +450,7 @@ class PrevalenceByAAPositionHandler(BaseHandler):
             path_to_results = ["aggregations", "by_date", "buckets"]
             for i in path_to_results:
                 buckets = buckets[i]
+            set_date_keys(buckets)
             flattened_response = []
             for d in buckets:
                 alt_count = 0
@@ -426,7 +478,7 @@ class PrevalenceByAAPositionHandler(BaseHandler):
                 )
                 .sort_values("date")
             )
-            df_response = df_response.groupby("aa").apply(compute_rolling_mean, "date", "prevalence", "prevalence_rolling")
+            df_response = df_response.groupby("aa").apply(compute_rolling_mean, "date", "prevalence", "prevalence_rolling", interval)
             df_response.loc[:,"date"] = df_response["date"].apply(lambda x: x.strftime("%Y-%m-%d"))
             dict_response = df_response.to_dict(orient="records")
         resp = {"success": True, "results": dict_response}
@@ -1,49 +1,173 @@
+import os
+import sys
+import time
+import signal
+import asyncio
 import argparse
 import tornado.ioloop
 import tornado.web
+import tornado.netutil
+import tornado.httpserver
+from tornado.log import app_log
 from general import LocationHandler, Shape, Zipcode, ShapeByZipcode
-from elasticsearch import AsyncElasticsearch, Elasticsearch
 from lineage import LineageByCountryHandler, LineageByDivisionHandler, LineageAndCountryHandler, LineageAndDivisionHandler, LineageHandler, LineageMutationsHandler, MutationDetailsHandler, MutationsByLineage
 from prevalence import GlobalPrevalenceByTimeHandler, PrevalenceByLocationAndTimeHandler, CumulativePrevalenceByLocationHandler, PrevalenceAllLineagesByLocationHandler, PrevalenceByAAPositionHandler
-from general import LocationHandler, LocationDetailsHandler, MetadataHandler, MutationHandler, SubmissionLagHandler, SequenceCountHandler, MostRecentSubmissionDateHandler, MostRecentCollectionDateHandler, GisaidIDHandler, CaseCounts, LabCounts
+from general import LocationHandler, LocationDetailsHandler, MetadataHandler, MutationHandler, SubmissionLagHandler, SequenceCountHandler, MostRecentSubmissionDateHandler, MostRecentCollectionDateHandler, GisaidIDHandler, CaseCounts, LabCounts, StatsHandler, MetricsHandler, BatchHandler, MutationsInRangeHandler
+from base import BaseHandler, ResponseCache, ContentEncoding
+from es_client import create_es_client
 
 parser = argparse.ArgumentParser(description='Start tornado server.')
 parser.add_argument('--hostname', nargs="?",const="es",help='Hostname in case not being run via docker.', required=False)
+parser.add_argument('--port', type=int, default=8000, help='Port to listen on.', required=False)
+parser.add_argument('--cache-size', type=int, default=2048, help='Maximum number of cached responses, 0 disables the cache.', required=False)
+parser.add_argument('--cache-ttl', type=int, default=600, help='Seconds a cached response stays valid.', required=False)
+parser.add_argument('--max-age', type=int, default=600, help='Cache-Control max-age in seconds sent with GET responses.', required=False)
+parser.add_argument('--es-pool-size', type=int, default=10, help='Maximum number of concurrent connections to ES per worker.', required=False)
+parser.add_argument('--es-keepalive', type=float, default=15, help='Seconds an idle ES connection is kept open, 0 closes connections after each request.', required=False)
+parser.add_argument('--es-timeout', type=float, default=10, help='Timeout in seconds for each ES request.', required=False)
+parser.add_argument('--es-max-retries', type=int, default=3, help='Number of retries of a failed or timed out ES request.', required=False)
+parser.add_argument('--es-compress', action='store_true', help='Gzip ES request and response bodies.', required=False)
+parser.add_argument('--workers', type=int, default=1, help='Number of worker processes sharing the port, 0 starts one per CPU.', required=False)
+parser.add_argument('--max-restarts', type=int, default=100, help='Number of crashed workers that are restarted before giving up.', required=False)
+parser.add_argument('--shutdown-timeout', type=float, default=30, help='Seconds to wait for in-flight requests on SIGTERM/SIGINT.', required=False)
 args = parser.parse_args()
 hostname = args.hostname
 
-es = AsyncElasticsearch(hosts=[{'host': '%s' %hostname}], retry_on_timeout=True)
-na = Elasticsearch(hosts=[{'host': '%s' %hostname}], retry_on_timeout=True)
-if __name__ == "__main__":
-    application = tornado.web.Application([
-        (r"/shape/shape", Shape, dict(db=es, db2=na)),
-        (r"/zipcodes/shape", ShapeByZipcode, dict(db=es,db2=na)),
-        (r"/epi/casecounts", CaseCounts, dict(db=es,db2=na)),
-        (r"/hcov19/get-zipcodes", Zipcode, dict(db=es, db2=na)),
-        (r"/hcov19/labcounts", LabCounts, dict(db=es, db2=na)),
-        (r"/hcov19/location", LocationHandler, dict(db=es,db2=na)),
-        (r"/hcov19/lineage-by-country", LineageByCountryHandler, dict(db=es,db2=na)),
-        (r"/hcov19/lineage-and-country", LineageAndCountryHandler, dict(db=es,db2=na)),
-        (r"/hcov19/lineage-by-division", LineageByDivisionHandler, dict(db=es,db2=na)),
-        (r"/hcov19/lineage-and-division", LineageAndDivisionHandler, dict(db=es,db2=na)),
-        (r"/hcov19/sequence-count", SequenceCountHandler, dict(db=es,db2=na)),
-        (r"/hcov19/global-prevalence", GlobalPrevalenceByTimeHandler, dict(db=es,db2=na)),
-        (r"/hcov19/prevalence-by-location", PrevalenceByLocationAndTimeHandler, dict(db=es, db2=na)),
-        (r"/hcov19/prevalence-by-location-all-lineages", PrevalenceAllLineagesByLocationHandler, dict(db=es,db2=na)),
-        (r"/hcov19/prevalence-by-position", PrevalenceByAAPositionHandler, dict(db=es, db2=na)),
-        (r"/hcov19/lineage-by-sub-admin-most-recent", CumulativePrevalenceByLocationHandler, dict(db=es,db2=na)),
-        (r"/hcov19/most-recent-collection-date-by-location", MostRecentCollectionDateHandler, dict(db=es,db2=na)),
-        (r"/hcov19/most-recent-submission-date-by-location", MostRecentSubmissionDateHandler, dict(db=es,db2=na)),
-        (r"/hcov19/mutation-details", MutationDetailsHandler, dict(db=es,db2=na)),
-        (r"/hcov19/mutations-by-lineage", MutationsByLineage, dict(db=es,db2=na)),
-        (r"/hcov19/lineage-mutations", LineageMutationsHandler, dict(db=es,db2=na)),
-        (r"/hcov19/collection-submission", SubmissionLagHandler, dict(db=es,db2=na)),
-        (r"/hcov19/lineage", LineageHandler, dict(db=es,db2=na)),
-        (r"/hcov19/location", LocationHandler, dict(db=es,db2=na)),
-        (r"/hcov19/location-lookup", LocationDetailsHandler, dict(db=es,db2=na)),
-        (r"/hcov19/mutations", MutationHandler, dict(db=es,db2=na)),
-        (r"/hcov19/metadata", MetadataHandler, dict(db=es,db2=na)),
+BaseHandler.cache = ResponseCache(max_entries=args.cache_size, ttl=args.cache_ttl)
+BaseHandler.cache_max_age = args.max_age
+
+def make_app(es):
+    return tornado.web.Application([
+        (r"/shape/shape", Shape, dict(db=es)),
+        (r"/zipcodes/shape", ShapeByZipcode, dict(db=es)),
+        (r"/epi/casecounts", CaseCounts, dict(db=es)),
+        (r"/hcov19/get-zipcodes", Zipcode, dict(db=es)),
+        (r"/hcov19/labcounts", LabCounts, dict(db=es)),
+        (r"/hcov19/location", LocationHandler, dict(db=es)),
+        (r"/hcov19/lineage-by-country", LineageByCountryHandler, dict(db=es)),
+        (r"/hcov19/lineage-and-country", LineageAndCountryHandler, dict(db=es)),
+        (r"/hcov19/lineage-by-division", LineageByDivisionHandler, dict(db=es)),
+        (r"/hcov19/lineage-and-division", LineageAndDivisionHandler, dict(db=es)),
+        (r"/hcov19/sequence-count", SequenceCountHandler, dict(db=es)),
+        (r"/hcov19/global-prevalence", GlobalPrevalenceByTimeHandler, dict(db=es)),
+        (r"/hcov19/prevalence-by-location", PrevalenceByLocationAndTimeHandler, dict(db=es)),
+        (r"/hcov19/prevalence-by-location-all-lineages", PrevalenceAllLineagesByLocationHandler, dict(db=es)),
+        (r"/hcov19/prevalence-by-position", PrevalenceByAAPositionHandler, dict(db=es)),
+        (r"/hcov19/lineage-by-sub-admin-most-recent", CumulativePrevalenceByLocationHandler, dict(db=es)),
+        (r"/hcov19/most-recent-collection-date-by-location", MostRecentCollectionDateHandler, dict(db=es)),
+        (r"/hcov19/most-recent-submission-date-by-location", MostRecentSubmissionDateHandler, dict(db=es)),
+        (r"/hcov19/mutation-details", MutationDetailsHandler, dict(db=es)),
+        (r"/hcov19/mutations-by-lineage", MutationsByLineage, dict(db=es)),
+        (r"/hcov19/lineage-mutations", LineageMutationsHandler, dict(db=es)),
+        (r"/hcov19/collection-submission", SubmissionLagHandler, dict(db=es)),
+        (r"/hcov19/lineage", LineageHandler, dict(db=es)),
+        (r"/hcov19/location", LocationHandler, dict(db=es)),
+        (r"/hcov19/location-lookup", LocationDetailsHandler, dict(db=es)),
+        (r"/hcov19/mutations", MutationHandler, dict(db=es)),
+        (r"/hcov19/mutations-in-range", MutationsInRangeHandler, dict(db=es)),
+        (r"/hcov19/metadata", MetadataHandler, dict(db=es)),
         (r"/hcov19/gisaid-id-lookup", GisaidIDHandler, dict(db=es)),
-    ])
-    application.listen(8000)
-    tornado.ioloop.IOLoop.current().start()
+        (r"/hcov19/batch", BatchHandler, dict(db=es)),
+        (r"/stats", StatsHandler, dict(db=es)),
+        (r"/metrics", MetricsHandler, dict(db=es)),
+    ], transforms=[ContentEncoding])
+
+def fork_workers(num_workers, max_restarts):
+    """
+    Fork num_workers children and supervise them, returning the worker id in each child.
+
+    Workers that crash (non-zero exit or killed by a signal) are replaced
+    under the same id, at most max_restarts times in total. SIGTERM/SIGINT
+    are forwarded to all workers, and the parent exits once they are gone.
+    """
+    children = {}
+    stopping = False
+
+    def start_worker(worker_id):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            return True
+        children[pid] = worker_id
+        return False
+
+    def forward_signal(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    for i in range(num_workers):
+        if start_worker(i):
+            return i
+    signal.signal(signal.SIGTERM, forward_signal)
+    signal.signal(signal.SIGINT, forward_signal)
+    app_log.info("Started %d workers", num_workers)
+    restarts = 0
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        if pid not in children:
+            continue
+        worker_id = children.pop(pid)
+        if os.WIFSIGNALED(status):
+            app_log.warning("Worker %d (pid %d) killed by signal %d", worker_id, pid, os.WTERMSIG(status))
+        elif os.WEXITSTATUS(status) != 0:
+            app_log.warning("Worker %d (pid %d) exited with status %d", worker_id, pid, os.WEXITSTATUS(status))
+        else:
+            app_log.info("Worker %d (pid %d) exited normally", worker_id, pid)
+            continue
+        if stopping:
+            continue
+        restarts += 1
+        if restarts > max_restarts:
+            for i in children:
+                os.kill(i, signal.SIGTERM)
+            raise RuntimeError("Too many worker restarts, giving up")
+        if start_worker(worker_id):
+            return worker_id
+    sys.exit(0)
+
+def serve(sockets, worker_id, shutdown_timeout):
+    BaseHandler.worker_id = worker_id
+    es, BaseHandler.es_pool_stats = create_es_client(hostname, pool_size=args.es_pool_size, keepalive_timeout=args.es_keepalive, timeout=args.es_timeout, max_retries=args.es_max_retries, http_compress=args.es_compress)
+    server = tornado.httpserver.HTTPServer(make_app(es))
+    server.add_sockets(sockets)
+    io_loop = tornado.ioloop.IOLoop.current()
+    shutting_down = False
+
+    async def shutdown():
+        # Stop accepting, let in-flight requests finish, then close the ES clients.
+        server.stop()
+        deadline = time.monotonic() + shutdown_timeout
+        while BaseHandler.requests_started > BaseHandler.requests_finished and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        await server.close_all_connections()
+        await es.close()
+        io_loop.stop()
+
+    def handle_signal(signum, frame):
+        nonlocal shutting_down
+        if shutting_down:
+            return
+        shutting_down = True
+        app_log.info("Worker %s shutting down on signal %d", worker_id, signum)
+        io_loop.add_callback_from_signal(shutdown)
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+    io_loop.start()
+
+if __name__ == "__main__":
+    sockets = tornado.netutil.bind_sockets(args.port)
+    num_workers = args.workers if args.workers > 0 else os.cpu_count()
+    worker_id = 0
+    if num_workers > 1:
+        worker_id = fork_workers(num_workers, args.max_restarts)
+    serve(sockets, worker_id, args.shutdown_timeout)
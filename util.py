@@ -1,11 +1,64 @@
 from datetime import timedelta, datetime as dt
+import re
 from scipy.stats import beta
+import numpy as np
 import pandas as pd
 
+class JeffreysIntervalTable:
+    """
+    Jeffreys intervals cached for integer (x, n) pairs.
+
+    Pairs with 0 <= x <= n <= max_n live at index n * (n + 1) / 2 + x of two
+    flat arrays that are filled lazily. All misses of a call, plus any pairs
+    that cannot be cached, are computed in a single vectorized beta.interval
+    call, so results are identical to calling beta.interval directly.
+    """
+
+    def __init__(self, max_n = 1024, alpha = 0.05):
+        self.max_n = max_n
+        self.alpha = alpha
+        size = (max_n + 1) * (max_n + 2) // 2
+        self.lower = np.full(size, np.nan)
+        self.upper = np.full(size, np.nan)
+
+    def compute(self, x, n):
+        return beta.interval(1 - self.alpha, x + 0.5, n - x + 0.5)
+
+    def interval(self, x, n):
+        x = np.asarray(x, dtype = float)
+        n = np.asarray(n, dtype = float)
+        x, n = np.broadcast_arrays(x, n)
+        ci_low = np.empty(x.shape)
+        ci_upp = np.empty(x.shape)
+        cacheable = np.isfinite(x) & np.isfinite(n) & (x >= 0) & (x <= n) & (n <= self.max_n) & (x == np.floor(x)) & (n == np.floor(n))
+        x_cached = x[cacheable].astype(np.int64)
+        n_cached = n[cacheable].astype(np.int64)
+        idx = n_cached * (n_cached + 1) // 2 + x_cached
+        missing = np.isnan(self.lower[idx])
+        missing_idx, first = np.unique(idx[missing], return_index = True)
+        x_uncached = x[~cacheable]
+        n_uncached = n[~cacheable]
+        if missing_idx.shape[0] + x_uncached.shape[0] > 0:
+            low, upp = self.compute(
+                np.concatenate([x_cached[missing][first], x_uncached]).astype(float),
+                np.concatenate([n_cached[missing][first], n_uncached]).astype(float)
+            )
+            low = np.atleast_1d(low)
+            upp = np.atleast_1d(upp)
+            self.lower[missing_idx] = low[:missing_idx.shape[0]]
+            self.upper[missing_idx] = upp[:missing_idx.shape[0]]
+            ci_low[~cacheable] = low[missing_idx.shape[0]:]
+            ci_upp[~cacheable] = upp[missing_idx.shape[0]:]
+        ci_low[cacheable] = self.lower[idx]
+        ci_upp[cacheable] = self.upper[idx]
+        return ci_low, ci_upp
+
+jeffreys_intervals = JeffreysIntervalTable()
+
 def calculate_proportion(_x, _n):
     x = _x.round()
     n = _n.round()
-    ci_low, ci_upp = beta.interval(1 - 0.05, x + 0.5, n - x + 0.5) # Jeffreys Interval
+    ci_low, ci_upp = jeffreys_intervals.interval(x, n) # Jeffreys Interval
     est_proportion = _x/_n
     return est_proportion, ci_low, ci_upp
 
@@ -48,16 +101,18 @@ def compute_rolling_mean_all_lineages(df, index_col, col, new_col, grp_col):
     )
     return df
 
-def compute_rolling_mean(df, index_col, col, new_col):
+def compute_rolling_mean(df, index_col, col, new_col, interval = "day"):
+    # A week or month bucket already spans the 7 day window, so it is its own rolling value
+    window = "7d" if interval == "day" else "1d"
     df = (
         df
         .set_index(index_col)
-        .assign(**{new_col: lambda x: x[col].rolling("7d").mean()})
+        .assign(**{new_col: lambda x: x[col].rolling(window).mean()})
         .reset_index()
     )
     return df
 
-def transform_prevalence(resp, path_to_results = [], cumulative = False):
+def transform_prevalence(resp, path_to_results = [], cumulative = False, interval = "day"):
     buckets = resp
     for i in path_to_results:
         buckets = buckets[i]
@@ -67,7 +122,7 @@ def transform_prevalence(resp, path_to_results = [], cumulative = False):
         "date": i["key"],
         "total_count": i["doc_count"],
         "lineage_count": i["lineage_count"]["doc_count"]
-    } for i in buckets if len(i["key"].split("-")) > 1 and "XX" not in i["key"]]
+    } for i in buckets]
     df_response = (
         pd.DataFrame(flattened_response)
         .assign(date = lambda x: pd.to_datetime(x["date"], format="%Y-%m-%d"))
@@ -77,8 +132,8 @@ def transform_prevalence(resp, path_to_results = [], cumulative = False):
     dict_response = {}
     if not cumulative:
         df_response = df_response[df_response["date"] >= first_date - pd.to_timedelta(6, unit='d')] # Go back 6 days for total_rolling
-        df_response = compute_rolling_mean(df_response, "date", "total_count", "total_count_rolling")
-        df_response = compute_rolling_mean(df_response, "date", "lineage_count", "lineage_count_rolling")
+        df_response = compute_rolling_mean(df_response, "date", "total_count", "total_count_rolling", interval)
+        df_response = compute_rolling_mean(df_response, "date", "lineage_count", "lineage_count_rolling", interval)
         df_response = df_response[df_response["date"] >= first_date] # Revert back to first date after total_rolling calculations are complete
         d = calculate_proportion(df_response["lineage_count_rolling"], df_response["total_count_rolling"])
         df_response.loc[:, "proportion"] = d[0]
@@ -109,6 +164,17 @@ def transform_prevalence(resp, path_to_results = [], cumulative = False):
             }
     return dict_response
 
+# Names that several spellings of a subregion are reported under
+merged_sub_names = ["Out of state", "Unknown"]
+
+def get_sub_name(sub):
+    # Name a subregion is reported and grouped under, with None and out of state spellings merged.
+    if sub.lower().replace("-", "").replace(" ", "") == "outofstate":
+        return "Out of state"
+    if sub.lower() in ["none", "unknown"]:
+        return "Unknown"
+    return sub
+
 def compute_cumulative(grp, cols):
     grp = grp.sort_values("date")
     if grp.shape[0] != 0:
@@ -218,6 +284,113 @@ def get_major_lineage_prevalence(df, index_col, keep_lineages = [], prevalence_t
     df.loc[:,"prevalence"] = df["lineage_count"]/df["total_count"]
     return df
 
+interval_days = {"day": 1, "week": 7} # Months are stepped by calendar month
+
+def transform_prevalence_all_lineages(dates, total_counts, lineages, lineage_counts, window = None, keep_lineages = [], prevalence_threshold = 0.05, nday_threshold = 10, ndays = 180, cumulative = False, interval = "day"):
+    """
+    Prevalence of every lineage over a dense date x lineage matrix.
+
+    Takes one entry per date_collected x pangolin_lineage bucket and returns
+    the same records as get_major_lineage_prevalence followed by the
+    per-lineage rolling means (or cumulative sums), without any per-group
+    apply. Minor lineages are collapsed into "other" before the matrix is
+    built, so its width is the number of retained lineages.
+
+    Rows of the matrix are steps of interval. Daily rows are averaged over
+    7 days, week and month buckets already span that window and are their
+    own rolling value.
+    """
+    date_codes, date_keys = pd.factorize(np.asarray(dates, dtype = object))
+    dates = pd.to_datetime(pd.Series(date_keys), format = "%Y-%m-%d").to_numpy()[date_codes]
+    total_counts = np.asarray(total_counts, dtype = np.int64)
+    lineages = np.asarray(lineages, dtype = object)
+    lineage_counts = np.asarray(lineage_counts, dtype = np.int64)
+    if window is not None:
+        in_window = dates >= np.datetime64(dt.now() - timedelta(days = window))
+        dates, total_counts, lineages, lineage_counts = dates[in_window], total_counts[in_window], lineages[in_window], lineage_counts[in_window]
+    if dates.shape[0] == 0:
+        return []
+    # Factorized after the window, so lineages only seen outside it get no column
+    lineage_codes, lineage_keys = pd.factorize(lineages)
+
+    # Collapse lineages that are not prevalent enough on enough recent days into "other"
+    date_limit = np.datetime64(dt.today() - timedelta(days = ndays))
+    recent = dates >= date_limit
+    prevalence = lineage_counts/total_counts
+    retained_days = np.bincount(lineage_codes[recent & (prevalence >= prevalence_threshold)], minlength = lineage_keys.shape[0])
+    num_unique_dates = np.unique(dates[recent]).shape[0]
+    if num_unique_dates < nday_threshold:
+        nday_threshold = round((nday_threshold/ndays) * num_unique_dates)
+    retained = ((retained_days > 0) & (retained_days >= nday_threshold)) | np.isin(lineage_keys, np.asarray(keep_lineages, dtype = object))
+    collapsed = np.where(retained & (lineage_keys != "none"), lineage_keys, "other")
+    lineage_names, collapsed_idx = np.unique(collapsed, return_inverse = True) # Sorted like groupby("lineage")
+    lineage_idx = collapsed_idx.reshape(-1)[lineage_codes]
+
+    date_min = dates.min()
+    if interval == "month":
+        day_idx = (dates.astype("datetime64[M]") - date_min.astype("datetime64[M]")).astype(np.int64)
+    else:
+        day_idx = ((dates - date_min) // np.timedelta64(interval_days[interval], "D")).astype(np.int64)
+    num_days = int(day_idx.max()) + 1
+    rolling_steps = 7 if interval == "day" else 1
+    num_lineages = lineage_names.shape[0]
+    cell_idx = day_idx * num_lineages + lineage_idx
+    counts = np.bincount(cell_idx, weights = lineage_counts, minlength = num_days * num_lineages).astype(np.int64).reshape(num_days, num_lineages)
+    present = np.zeros(num_days * num_lineages, dtype = bool)
+    present[cell_idx] = True
+    present = present.reshape(num_days, num_lineages)
+    daily_total = np.zeros(num_days, dtype = np.int64)
+    daily_total[day_idx] = total_counts
+
+    if cumulative:
+        lineage_total = counts.sum(axis = 0)
+        total = int(lineage_total.sum())
+        return [{
+            "lineage": lineage,
+            "total_count": total,
+            "lineage_count": lineage_count,
+            "prevalence": prevalence
+        } for lineage, lineage_count, prevalence in zip(lineage_names.tolist(), lineage_total.tolist(), (lineage_total/total).tolist())]
+
+    # Each lineage spans the days between its first and last bucket
+    days = np.arange(num_days)[:, None]
+    first_day = present.argmax(axis = 0)
+    last_day = num_days - 1 - present[::-1].argmax(axis = 0)
+    in_range = (days >= first_day) & (days <= last_day)
+    cumsum = np.cumsum(counts, axis = 0)
+    rolling_sum = cumsum.copy()
+    rolling_sum[rolling_steps:] -= cumsum[:-rolling_steps]
+    rolling = rolling_sum / np.clip(days - first_day + 1, 1, rolling_steps) # A 7d window only averages the days since the lineage's first bucket
+
+    # Sum each day's in-range lineages as a contiguous row in lineage order, so the floating point
+    # totals match summing every date group separately. Days are batched by their number of lineages.
+    total_rolling = np.zeros(num_days)
+    lineages_per_day = in_range.sum(axis = 1)
+    for n in np.unique(lineages_per_day[lineages_per_day > 0]):
+        rows = np.flatnonzero(lineages_per_day == n)
+        total_rolling[rows] = rolling[rows][in_range[rows]].reshape(rows.shape[0], n).sum(axis = 1)
+
+    lineage_idx, day_idx = np.nonzero(in_range.T) # Lineage-major, dates ascending
+    lineage_count = counts[day_idx, lineage_idx]
+    lineage_present = present[day_idx, lineage_idx]
+    total_count = np.where(lineage_present, daily_total[day_idx], 0)
+    prevalence = np.zeros(lineage_count.shape[0])
+    prevalence[lineage_present] = lineage_count[lineage_present]/total_count[lineage_present]
+    lineage_count_rolling = rolling[day_idx, lineage_idx]
+    total_count_rolling = total_rolling[day_idx]
+    prevalence_rolling = np.zeros(lineage_count.shape[0])
+    nonzero_total = total_count_rolling != 0 # Prevalence is 0 if total_count_rolling == 0.
+    prevalence_rolling[nonzero_total] = lineage_count_rolling[nonzero_total]/total_count_rolling[nonzero_total]
+    date_labels = np.asarray(pd.date_range(date_min, periods = num_days, freq = "MS" if interval == "month" else "{}D".format(interval_days[interval])).strftime("%Y-%m-%d"), dtype = object)
+    return [{
+        "date": date,
+        "total_count": total,
+        "lineage_count": count,
+        "lineage": lineage,
+        "prevalence": prev,
+        "prevalence_rolling": prev_rolling
+    } for date, total, count, lineage, prev, prev_rolling in zip(date_labels[day_idx].tolist(), total_count.tolist(), lineage_count.tolist(), lineage_names[lineage_idx].tolist(), prevalence.tolist(), prevalence_rolling.tolist())]
+
 def parse_location_id_to_query(query_id, query_obj = None):
     if query_id == None:
         return None
@@ -275,3 +448,221 @@ def create_iterator(lineages, mutations):
     if len(lineages) == 0 and len(mutations) > 0:
         return zip([None], [mutations])
     return zip([], [])
+
+def create_filters_agg(filters):
+    # Named buckets "0", "1", ... in the order of filters
+    return {
+        "filters": {
+            "filters": {str(i): j for i, j in enumerate(filters)}
+        }
+    }
+
+def split_filters_buckets(buckets, agg_name, num_filters):
+    # One list of buckets per named filter, shaped as if agg_name were a single filter aggregation.
+    return [
+        [dict(i, **{agg_name: i[agg_name]["buckets"][str(j)]}) for i in buckets]
+        for j in range(num_filters)
+    ]
+
+def add_rollup_count_aggs(agg):
+    # Rollup documents carry a count per date x location x lineage, so doc_count has to be replaced by the sum of count.
+    sub_aggs = agg["aggregations"] if "aggregations" in agg else agg.setdefault("aggs", {})
+    if "lineage_count" in sub_aggs:
+        sub_aggs["lineage_count"]["aggs"] = {
+            "rollup_count": {"sum": {"field": "count"}}
+        }
+    sub_aggs["rollup_count"] = {"sum": {"field": "count"}}
+    return agg
+
+def apply_rollup_counts(buckets):
+    for i in buckets:
+        i["doc_count"] = int(i["rollup_count"]["value"])
+        if "lineage_count" in i:
+            i["lineage_count"]["doc_count"] = int(i["lineage_count"]["rollup_count"]["value"])
+    return buckets
+
+def create_date_histogram_agg(interval = "day", field = "date_collected_dt"):
+    # Empty buckets are left out, like the terms aggregation on the keyword dates
+    return {
+        "date_histogram": {
+            "field": field,
+            "calendar_interval": interval,
+            "format": "yyyy-MM-dd",
+            "min_doc_count": 1
+        }
+    }
+
+def create_date_window_filter(ndays, field = "date_collected_dt"):
+    # Dates after today - ndays, the ones kept by comparing against dt.today() - timedelta(days = ndays) in pandas
+    return {
+        "range": {
+            field: {
+                "gt": (dt.today() - timedelta(days = ndays)).strftime("%Y-%m-%d")
+            }
+        }
+    }
+
+def add_query_filter(query, clause):
+    # AND clause into the query of a search body
+    query["query"] = {
+        "bool": {
+            "filter": [clause] + ([query["query"]] if query.get("query") is not None else [])
+        }
+    }
+    return query
+
+def set_date_keys(buckets):
+    # date_histogram keys are epoch millis, the formatted date is used as key instead
+    for i in buckets:
+        i["key"] = i["key_as_string"]
+    return buckets
+
+def create_range_partitions(field, boundaries):
+    # Contiguous ranges (-inf, b0), [b0, b1), ..., [bn, inf) covering every value of field in ascending order.
+    boundaries = sorted(set(boundaries))
+    if len(boundaries) == 0:
+        return [None]
+    partitions = []
+    lower = None
+    for upper in boundaries + [None]:
+        bounds = {}
+        if lower is not None:
+            bounds["gte"] = lower
+        if upper is not None:
+            bounds["lt"] = upper
+        partitions.append({
+            "range": {
+                field: bounds
+            }
+        })
+        lower = upper
+    return partitions
+
+def create_date_partitions(field, num_partitions, start = "2019-12-01"):
+    start = dt.strptime(start, "%Y-%m-%d")
+    step = (dt.today() - start) / num_partitions
+    boundaries = [(start + step * i).strftime("%Y-%m-%d") for i in range(1, num_partitions)]
+    return create_range_partitions(field, boundaries)
+
+mutation_gene_mapping = {
+    "orf1a" : "ORF1a",
+    "orf1b" : "ORF1b",
+    "s" : "S",
+    "orf3a" : "ORF3a",
+    "e": "E",
+    "m" : "M",
+    "orf6": "ORF6",
+    "orf7a" : "ORF7a",
+    "orf7b" : "ORF7b",
+    "orf8" : "ORF8",
+    "n" : "N",
+    "orf10" : "ORF10"
+}
+
+def parse_mutation(mutation, synonymous = False):
+    """
+    Split a mutation key such as "s:d614g" or "s:del69/70" into gene, amino
+    acids, codons and type, as the lineage-mutations handlers report them:
+    deletions and ranges keep the upper-cased key as ref_aa and the change as
+    alt_aa, and codon_end is only set for deletion ranges.
+
+    Returns None for synonymous mutations (ref_aa == alt_aa), which are never
+    reported, unless synonymous is set. Keys that cannot be parsed, such as
+    ones without a gene, get None fields, so a malformed key never aborts an
+    ingest, and are not reported either.
+    """
+    gene, separator, change = mutation.partition(":")
+    codons = [int(i) for i in re.findall("[0-9]+", change)]
+    aa = re.findall("[A-Za-z*]+", change)
+    is_deletion = "DEL" in mutation or "del" in mutation
+    parsed = {
+        "gene": mutation_gene_mapping.get(gene.lower(), gene) if separator else None,
+        "ref_aa": None,
+        "alt_aa": None,
+        "codon_num": codons[0] if len(codons) > 0 else None,
+        "codon_end": codons[1] if len(codons) > 1 and "/" in mutation and is_deletion else None,
+        "type": "deletion" if is_deletion else "substitution",
+        "change_length_nt": None
+    }
+    if not separator or parsed["codon_num"] is None:
+        parsed.update(codon_num = None, codon_end = None, type = None)
+    elif is_deletion or "_" in mutation:
+        parsed.update(ref_aa = mutation.upper(), alt_aa = change.upper())
+    elif len(aa) >= 2:
+        parsed.update(ref_aa = aa[0].upper(), alt_aa = aa[1].upper())
+    if parsed["codon_end"] is not None:
+        parsed["change_length_nt"] = (parsed["codon_end"] - parsed["codon_num"] + 1) * 3
+    if not synonymous and parsed["ref_aa"] == parsed["alt_aa"]:
+        return None
+    return parsed
+
+def merge_lineage_mutation_profiles(profiles):
+    """
+    Mutation counts of the union of lineages from their per-lineage profiles.
+    Lineages never share a sequence, so counts add up. Mutations are ordered
+    by count, then name, like a terms aggregation.
+    """
+    if len(profiles) == 1:
+        return profiles[0]["lineage_count"], profiles[0]["mutations"]
+    lineage_count = 0
+    mutations = {}
+    for profile in profiles:
+        lineage_count += profile["lineage_count"]
+        for i in profile["mutations"]:
+            if i["mutation"] in mutations:
+                mutations[i["mutation"]] = dict(mutations[i["mutation"]], mutation_count = mutations[i["mutation"]]["mutation_count"] + i["mutation_count"])
+            else:
+                mutations[i["mutation"]] = i
+    return lineage_count, sorted(mutations.values(), key = lambda x: (-x["mutation_count"], x["mutation"]))
+
+def format_lineage_mutations(lineage, lineage_count, mutations, frequency):
+    # Records of mutations with prevalence >= frequency, missing codon_end/change_length_nt written as "None" like fillna("None")
+    records = []
+    for i in mutations:
+        prevalence = i["mutation_count"] / lineage_count
+        if prevalence < frequency:
+            continue
+        records.append({
+            "mutation": i["mutation"],
+            "mutation_count": i["mutation_count"],
+            "lineage_count": lineage_count,
+            "lineage": lineage,
+            "gene": i["gene"],
+            "ref_aa": i["ref_aa"],
+            "alt_aa": i["alt_aa"],
+            "codon_num": i["codon_num"],
+            "codon_end": i["codon_end"] if i["codon_end"] is not None else "None",
+            "type": i["type"],
+            "prevalence": prevalence,
+            "change_length_nt": i["change_length_nt"] if i["change_length_nt"] is not None else "None"
+        })
+    return records
+
+# Levels of detail stored per shape at ingest, coarsest first: (simplify tolerance in degrees, decimals kept)
+shape_levels = [
+    (0.05, 2),
+    (0.01, 3),
+    (0.002, 3),
+    (0.0005, 4),
+    (0.0001, 5)
+]
+
+def get_shape_level_for_zoom(zoom):
+    # Coarsest level whose tolerance is below one 256px web map tile pixel at zoom, the finest one past the last level
+    pixel_size = 360 / (256 * 2 ** zoom)
+    for level, (tolerance, decimals) in enumerate(shape_levels):
+        if tolerance <= pixel_size:
+            return level
+    return len(shape_levels) - 1
+
+def create_shape_level_source(level):
+    # _source filter that only returns the geometry of one level
+    return {
+        "excludes": ["shape"] + ["shapes.{}".format(i) for i in range(len(shape_levels)) if i != level]
+    }
+
+def set_shape_level(hits, level):
+    # Geometry of the level is returned as "shape", like the full resolution one
+    for i in hits:
+        i["_source"]["shape"] = i["_source"].pop("shapes", {}).get(str(level))
+    return hits